@@ -0,0 +1,871 @@
+import sys
+import time
+import random
+import argparse
+import tracemalloc
+from data.float_tb import FloatTimeBuffer
+
+# Benchmarks for the buffer layer. Run from the shedder directory:
+#
+#   python benchmark.py storage
+#
+HAN_PERIOD = 2          # Seconds between HAN frames
+HOURS_7 = 7*3600
+DAYS_32 = 32*24*3600
+
+###########################################################
+# Synthetic 2 second HAN power series
+#
+def han_series(duration, start=1670796000, period=HAN_PERIOD, seed=1):
+    rnd = random.Random(seed)
+    return [(start + i*period, float(rnd.randint(500, 9000))) for i in range(int(duration/period))]
+
+###########################################################
+# Average time per call in microseconds
+#
+def timeit(fn, n):
+    t0 = time.perf_counter()
+    for i in range(n):
+        fn(i)
+    return 1e6*(time.perf_counter() - t0)/n
+
+###########################################################
+# Build buffer from samples, return (buffer, bytes allocated)
+#
+def build(samples, storage, accumulated=False):
+    tracemalloc.start()
+    buffer = FloatTimeBuffer(storage=storage, accumulated=accumulated)
+    buffer.sorted_list = samples
+    (current, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return (buffer, current)
+
+###########################################################
+# Memory and query speed per storage backend
+#
+def bench_storage(args):
+    for (name, duration) in (('7h', HOURS_7), ('32d', DAYS_32)):
+        samples = han_series(duration)
+        t_first = samples[0][0]
+        t_last = samples[-1][0]
+        rnd = random.Random(2)
+        points = [rnd.uniform(t_first, t_last) for i in range(1000)]
+
+        for storage in ('list', 'columns'):
+            (b, nbytes) = build(samples, storage)
+            span = min(3600, duration)
+            res = {
+                'bytes/sample': nbytes/len(samples),
+                'get_index': timeit(lambda i: b.get_index(points[i % 1000]), 20000),
+                'insert_sorted': timeit(lambda i: b.insert_sorted(points[i % 1000]+0.5, 1.0), 1000),
+                'get_interval 1h': timeit(lambda i: b.get_interval(points[i % 1000]-span, points[i % 1000]), 50),
+                'integrate 1h': timeit(lambda i: b.integrate(points[i % 1000]-span, points[i % 1000]), 50),
+                'get_max 1h': timeit(lambda i: b.get_max(points[i % 1000]-span, points[i % 1000]), 50),
+            }
+            print('{:>4} {:>8} n={:<8} '.format(name, storage, len(samples)) +
+                  '  '.join('{}={:.1f}{}'.format(k, v, '' if k.startswith('bytes') else 'us') for (k, v) in res.items()))
+
+###########################################################
+# Per-insert cost of in-order appends into a full buffer (every insert
+# expires one sample) as the buffer grows
+#
+def bench_append(args):
+    n_insert = 5000
+    for duration in (2000, HOURS_7, 3*24*3600, DAYS_32):
+        now = int(time.time())
+        samples = han_series(duration, start=now-duration)
+        for storage in ('list', 'columns'):
+            b = FloatTimeBuffer(age=duration, storage=storage)
+            b.sorted_list = samples
+            b.save = lambda: None       # Persistence is measured separately
+            us = timeit(lambda i: b.insert_sorted(now+i*0.001, 1.0), n_insert)
+            print('n={:<8} {:>8} append+expire={:.2f}us'.format(len(samples), storage, us))
+
+###########################################################
+# Startup restore time, YAML backup vs binary snapshot + journal
+#
+def bench_restore(args):
+    import os
+    import tempfile
+    from data.persistence import PersistenceWorker
+
+    tmp_dir = tempfile.mkdtemp()
+    worker = PersistenceWorker()
+    for (name, duration) in (('7h', HOURS_7), ('3d', 3*24*3600), ('32d', DAYS_32)):
+        samples = han_series(duration)
+        for backup_format in ('yaml', 'binary'):
+            if backup_format == 'yaml' and duration > args.yaml_max:
+                continue
+            filename = os.path.join(tmp_dir, '{}_{}.{}'.format(name, backup_format, 'yaml' if backup_format == 'yaml' else 'tsb'))
+            b = FloatTimeBuffer(backup_filename=filename, backup_format=backup_format, persistence=worker)
+            b.sorted_list = samples
+            if backup_format == 'binary':
+                b.backup.compact(b.storage)
+                # Typical journal: one backup interval per 4% of the buffer
+                for (ts, value) in samples[-len(samples)//25:]:
+                    b.backup.record(ts + duration, value)
+                b.backup.write(b.storage)
+            else:
+                b.flush()
+
+            t0 = time.perf_counter()
+            r = FloatTimeBuffer(backup_filename=filename, backup_format=backup_format)
+            dt = time.perf_counter() - t0
+            size = sum(os.path.getsize(os.path.join(tmp_dir, f)) for f in os.listdir(tmp_dir) if f.startswith(os.path.basename(filename)))
+            print('{:>4} {:>7} n={:<8} restore={:.3f}s  size={:.1f}MB'.format(name, backup_format, len(r.storage), dt, size/1e6))
+
+###########################################################
+# integrate/avg over the windows period_status uses, interleaved with
+# in-order appends (index maintained incrementally)
+#
+def bench_integrate(args):
+    for (name, duration) in (('7h', HOURS_7), ('32d', DAYS_32)):
+        samples = han_series(duration)
+        b = FloatTimeBuffer()
+        b.save = lambda: None
+        b.sorted_list = samples
+        t_last = samples[-1][0]
+
+        def tick(i):
+            ts = t_last + 2*(i+1)
+            b.insert_sorted(ts, 1000.0)
+            b.integrate(ts - 3600, ts)
+            b.avg(ts - 300, ts)
+            b.avg(ts - 60, ts)
+
+        t0 = time.perf_counter()
+        b.integral.ensure()
+        rebuild = time.perf_counter() - t0
+        res = {
+            'rebuild': 1e6*rebuild,
+            'integrate 1h': timeit(lambda i: b.integrate(t_last - 3600 - i, t_last - i), 2000),
+            'integrate all': timeit(lambda i: b.integrate(samples[0][0], t_last), 2000),
+            'append+3 queries': timeit(tick, 2000),
+        }
+        print('{:>4} n={:<8} '.format(name, len(samples)) + '  '.join('{}={:.1f}us'.format(k, v) for (k, v) in res.items()))
+
+###########################################################
+# get_max/get_min and the daily max list over a month, interleaved with
+# in-order appends (index maintained incrementally)
+#
+def bench_extremes(args):
+    for accumulated in (False, True):
+        samples = han_series(DAYS_32)
+        if accumulated:
+            total = 0.0
+            for (i, (ts, value)) in enumerate(samples):
+                total += value/1800000
+                samples[i] = (ts, total)
+        b = FloatTimeBuffer(accumulated=accumulated)
+        b.save = lambda: None
+        b.sorted_list = samples
+        t_first = samples[0][0]
+        t_last = samples[-1][0]
+
+        def tick(i):
+            ts = t_last + 2*(i+1)
+            b.insert_sorted(ts, samples[-1][1] + i)
+            b.get_max(ts - 24*3600, ts)
+
+        res = {
+            'get_max 1d': timeit(lambda i: b.get_max(t_last - 24*3600 - i, t_last - i), 200),
+            'get_min 1d': timeit(lambda i: b.get_min(t_last - 24*3600 - i, t_last - i), 200),
+            'period_max_list 30d': timeit(lambda i: b.get_period_max_list(int(t_first), int(t_first) + 30*24*3600), 5),
+            'append+get_max 1d': timeit(tick, 200),
+        }
+        print('accumulated={!s:<5} n={:<8} '.format(accumulated, len(samples)) + '  '.join('{}={:.1f}us'.format(k, v) for (k, v) in res.items()))
+
+###########################################################
+# EnergyCalculator.monthly_status with an hourly energy register, one
+# new register reading per call
+#
+def bench_monthly(args):
+    import tempfile
+    from data.energy_calc import EnergyCalculator
+    from data.persistence import PersistenceWorker
+
+    for (name, period) in (('hourly', 3600), ('10s', 10)):
+        now = int(time.time())
+        c = EnergyCalculator(log_dir=tempfile.mkdtemp(), persistence=PersistenceWorker())
+        c.energy_buffer.save = lambda: None
+        c.energy_buffer.sorted_list = [(ts, i*0.001*period/3600) for (i, (ts, v)) in enumerate(han_series(DAYS_32-3600, start=now-DAYS_32+3600, period=period))]
+        c.capacity.save = lambda: None
+
+        def tick(i):
+            c.insert_energy(now + i, c.energy_buffer.get_last_tuple()[1] + 1)
+            c.monthly_status()
+
+        print('{:>6} n={:<8} monthly_status={:.1f}us'.format(name, len(c.energy_buffer.storage), timeit(tick, 200)))
+
+###########################################################
+# Batch queries vs. one scalar call per timestamp/window
+#
+def bench_batch(args):
+    samples = han_series(DAYS_32)
+    b = FloatTimeBuffer()
+    b.sorted_list = samples
+    b.integral.ensure()
+    rnd = random.Random(3)
+    n = 10000
+    points = [rnd.uniform(samples[0][0], samples[-1][0]) for i in range(n)]
+    ends = [p + 3600 for p in points]
+
+    def run(fn):
+        t0 = time.perf_counter()
+        fn()
+        return 1e3*(time.perf_counter() - t0)
+
+    res = {
+        'get_value x{}'.format(n): run(lambda: [b.get_value(p, 'inter') for p in points]),
+        'get_values': run(lambda: b.get_values(points, 'inter')),
+        'integrate x{}'.format(n): run(lambda: [b.integrate(p, e) for (p, e) in zip(points, ends)]),
+        'integrate_many': run(lambda: b.integrate_many(points, ends)),
+    }
+    print('n={:<8} '.format(len(samples)) + '  '.join('{}={:.1f}ms'.format(k, v) for (k, v) in res.items()))
+
+###########################################################
+# Tiered retention: a year of power rolled up through the minute and
+# hour tiers, tier memory and query error vs. the raw samples
+#
+def bench_retention(args):
+    from data.storage import IntervalView
+    from data.rollup import RollupTier, TieredBuffer
+
+    period = 10
+    now = int(time.time())
+    samples = han_series(365*24*3600, start=now-365*24*3600, period=period)
+    exact = FloatTimeBuffer()
+    exact.sorted_list = samples
+
+    raw = FloatTimeBuffer(age=HOURS_7)
+    hours = RollupTier(resolution=3600, age=400*24*3600)
+    minutes = RollupTier(resolution=60, age=7*24*3600, next_tier=hours)
+    tiered = TieredBuffer(raw, [minutes, hours])
+
+    # Feed what auto_crop would have expired, one day at a time
+    t0 = time.perf_counter()
+    expire_idx = exact.get_index(now - HOURS_7)
+    for k in range(0, expire_idx, 8640):
+        tiered.on_expire(IntervalView(exact.storage, k, min(k+8640, expire_idx)))
+    raw.sorted_list = samples[expire_idx:]
+    feed = time.perf_counter() - t0
+
+    print('samples={} raw={:.1f}MB tiers={:.2f}MB ({} minute + {} hour buckets) rollup={:.1f}s'.format(
+        len(samples), 16*len(samples)/1e6, tiered.tier_bytes()/1e6, len(minutes), len(hours), feed))
+    for (name, span) in (('1h', 3600), ('1d', 24*3600), ('30d', 30*24*3600), ('300d', 300*24*3600)):
+        (f, t) = (now - span - 3*3600, now - 3*3600)
+        (a, b) = (tiered.integrate(f, t), exact.integrate(f, t))
+        us = timeit(lambda i: tiered.integrate(f, t), 100)
+        print('{:>5} integrate={:.1f}us error={:.2e} max={} exact_max={}'.format(
+            name, us, abs(a - b)/b, tiered.get_max(f, t)[1], exact.get_max(f, t)[1]))
+
+###########################################################
+# Compressed storage: bytes/sample and query slowdown vs. columns for
+# 32 days of power and of an energy register
+#
+def bench_compression(args):
+    from data.storage import CHUNK_SIZE
+
+    for (name, accumulated) in (('power', False), ('energy', True)):
+        samples = han_series(DAYS_32)
+        if accumulated:
+            register = 0.0
+            for (i, (ts, v)) in enumerate(samples):
+                register = round(register + v*HAN_PERIOD/3600e3, 3)
+                samples[i] = (ts, register)
+        rnd = random.Random(2)
+        points = [rnd.uniform(samples[0][0], samples[-1][0]) for i in range(1000)]
+
+        for storage in ('columns', 'gorilla'):
+            t0 = time.perf_counter()
+            b = FloatTimeBuffer(storage=storage, accumulated=accumulated)
+            b.sorted_list = samples
+            if storage == 'gorilla':
+                # Seal everything now instead of over the next appends
+                while len(b.storage.ts) >= 2*CHUNK_SIZE:
+                    b.storage.seal()
+            load = time.perf_counter() - t0
+            nbytes = b.storage.nbytes() if storage == 'gorilla' else 16*len(b.storage)
+            b.get_max(points[0], points[0]+3600)
+            res = {
+                'bytes/sample': nbytes/len(samples),
+                'load+seal(s)': load,
+                'get_value': timeit(lambda i: b.get_value(points[i % 1000]), 2000),
+                'get_max 1h': timeit(lambda i: b.get_max(points[i % 1000], points[i % 1000]+3600), 1000),
+                'get_max 1h recent': timeit(lambda i: b.get_max(samples[-1][0]-3600-i, samples[-1][0]-i), 1000),
+                'insert_sorted': timeit(lambda i: b.insert_sorted(samples[-1][0]+1+i, samples[-1][1]), 1000),
+            }
+            print('{:>6} {:<8} '.format(name, storage) + '  '.join('{}={:.2f}'.format(k, v) for (k, v) in res.items()))
+
+###########################################################
+# Partitioned storage: period summaries, expiry and per-partition
+# backup writes vs. columns with a binary backup
+#
+def bench_partitions(args):
+    import tempfile
+    import os
+
+    samples = han_series(DAYS_32)
+    rnd = random.Random(2)
+    points = [rnd.uniform(samples[0][0], samples[-1][0] - 24*3600) for i in range(100)]
+    for (storage, backup_format) in (('columns', 'binary'), ('partitioned', 'partitioned')):
+        b = FloatTimeBuffer(storage=storage, backup_filename=os.path.join(tempfile.mkdtemp(), 'buffer'), backup_format=backup_format)
+        b.save = lambda: None
+        b.sorted_list = samples
+        b.flush()
+
+        def tick(i):
+            b.insert_sorted(samples[-1][0] + HAN_PERIOD*(i+1), 1000.0)
+            return b.flush()
+        nbytes = [tick(i) for i in range(10)]
+        res = {
+            'summary 1d': timeit(lambda i: b.summary(points[i % 100], points[i % 100] + 24*3600), 100),
+            'drop 1h': timeit(lambda i: b.storage.drop_head(1800), 100),
+            'flush bytes': sum(nbytes)/len(nbytes),
+        }
+        print('{:<12} '.format(storage) + '  '.join('{}={:.1f}'.format(k, v) for (k, v) in res.items()))
+
+###########################################################
+# Differential check of the storage backends against 'columns':
+# random appends, late inserts (also in front of the expired head),
+# overwrites, expiry and compaction. Views taken on the way must keep
+# the samples they were taken with. Reports the first mismatch per
+# backend.
+#
+def bench_backends(args):
+    from data.storage import create_storage
+
+    rnd = random.Random(3)
+    errors = []
+    for kind in ('list', 'columns', 'gorilla', 'partitioned'):
+        ref = create_storage('columns')
+        storage = create_storage(kind)
+        views = []
+        ts = 7200.0
+        t0 = time.perf_counter()
+        for step in range(10000):
+            if step % 53 == 0:
+                view = storage.view()
+                views = views[-3:] + [(view, view.to_list(), view.columns())]
+            op = rnd.random()
+            if op < 0.7 or len(ref) == 0:
+                ts += rnd.choice((1, 2, 2, 2, 10, 900))
+                sample = (ts, float(rnd.randint(0, 9000)))
+            elif op < 0.99:
+                sample = (float(rnd.randint(0, int(ts))), float(rnd.randint(0, 9000)))
+            else:
+                n = rnd.randint(0, min(len(ref), 100))
+                for s in (ref, storage):
+                    s.drop_head(n)
+                    if op > 0.999:
+                        s.compact()
+                continue
+
+            for s in (ref, storage):
+                if len(s) == 0 or sample[0] > s.ts_at(len(s)-1):
+                    s.append(*sample)
+                    continue
+                idx = s.bisect_left(sample[0])
+                if idx < len(s) and s.ts_at(idx) == sample[0]:
+                    s.replace(idx, *sample)
+                else:
+                    s.insert(idx, *sample)
+
+            if step % 251 == 0 and storage.to_list() != ref.to_list():
+                errors.append('{} differs after step {}'.format(kind, step))
+                break
+            if step % 251 == 0 and any(v.to_list() != items or v.columns() != columns for (v, items, columns) in views):
+                errors.append('{} view changed after step {}'.format(kind, step))
+                break
+        if storage.to_list() != ref.to_list() and not any(e.startswith(kind) for e in errors):
+            errors.append('{} differs at the end'.format(kind))
+        print('{:<12} n={:<6} {:.1f}s'.format(kind, len(ref), time.perf_counter() - t0))
+    print('errors: {}'.format(errors if len(errors) > 0 else 'none'))
+
+###########################################################
+# Concurrency stress test: one MQTT-like writer, readers running the
+# status queries on snapshots, periodic crops and a persistence worker
+# flushing all the time. Checks snapshot consistency while running and
+# that a restore from the backups matches the live buffers at the end.
+#
+def bench_stress(args):
+    import tempfile
+    import threading
+    from math import fsum
+    from data.energy_calc import EnergyCalculator
+    from data.persistence import PersistenceWorker
+
+    log_dir = tempfile.mkdtemp()
+    worker = PersistenceWorker(tick=0.01)
+    c = EnergyCalculator(log_dir=log_dir, backup_interval=0, persistence=worker)
+    worker.start()
+    stop = threading.Event()
+    counts = {'inserts': 0, 'queries': 0, 'snapshots': 0, 'crops': 0}
+    errors = []
+
+    def run(name, fn):
+        def loop():
+            try:
+                while not stop.is_set():
+                    fn()
+            except Exception as e:
+                errors.append('{}: {!r}'.format(name, e))
+                stop.set()
+        return threading.Thread(target=loop, name=name)
+
+    register = [0.0]
+    def insert():
+        ts = time.time()
+        register[0] += 0.001
+        c.insert_power(ts, float(random.randint(500, 9000)))
+        c.insert_energy(ts, register[0])
+        counts['inserts'] += 1
+
+    def query():
+        c.period_status(max_energy=8000)
+        c.monthly_status()
+        c.history_status(time.time() - 3600, time.time())
+        counts['queries'] += 1
+
+    def check():
+        for b in (c.power_buffer, c.energy_buffer):
+            snap = b.snapshot()
+            (ts, values) = snap.storage.columns()
+            if len(ts) != len(snap.storage) or any(t1 <= t0 for (t0, t1) in zip(ts, ts[1:])):
+                raise AssertionError('inconsistent snapshot of {}'.format(b.backup_filename))
+            if b is c.power_buffer and len(ts) > 1:
+                exact = fsum(v*(t1 - t0) for (t0, t1, v) in zip(ts, ts[1:], values))
+                if abs(snap.integrate(ts[0], ts[-1]) - exact) > 1e-6*max(1.0, abs(exact)):
+                    raise AssertionError('snapshot integral mismatch')
+        counts['snapshots'] += 1
+        time.sleep(0.01)
+
+    def crop():
+        time.sleep(0.5)
+        c.power_buffer.crop_interval(from_ts=time.time() - 3600)
+        counts['crops'] += 1
+
+    threads = [run('writer', insert), run('reader', query), run('checker', check), run('cropper', crop)]
+    for t in threads:
+        t.start()
+    deadline = time.time() + args.duration
+    while time.time() < deadline and not stop.is_set():
+        time.sleep(0.5)
+    stop.set()
+    for t in threads:
+        t.join()
+    worker.stop()
+
+    restored = EnergyCalculator(log_dir=log_dir, persistence=PersistenceWorker())
+    for (live, copy) in ((c.power_buffer, restored.power_buffer), (c.energy_buffer, restored.energy_buffer)):
+        if live.storage.columns() != copy.storage.columns():
+            errors.append('restore mismatch for {}'.format(live.backup_filename))
+
+    print('  '.join('{}={}'.format(k, v) for (k, v) in counts.items()) + '  ' + str(worker.metrics()))
+    print('errors: {}'.format(errors if len(errors) > 0 else 'none'))
+
+###########################################################
+# Backfill a day of HAN samples: insert_sorted per sample vs. one
+# insert_many, in order and shuffled into an existing day
+#
+def bench_bulk(args):
+    day = han_series(24*3600, start=int(time.time()) - 2*24*3600)
+    older = han_series(24*3600, start=int(time.time()) - 3*24*3600 + 1)
+    shuffled = list(day)
+    random.Random(4).shuffle(shuffled)
+
+    for storage in ('columns', 'gorilla'):
+        for (name, existing, batch) in (('in order', [], day), ('shuffled', older + day[::2], shuffled)):
+            res = {}
+            for method in ('insert_sorted', 'insert_many'):
+                b = FloatTimeBuffer(age=DAYS_32, storage=storage)
+                b.save = lambda: None
+                b.sorted_list = existing
+                t0 = time.perf_counter()
+                if method == 'insert_sorted':
+                    for (ts, v) in batch:
+                        b.insert_sorted(ts, v)
+                else:
+                    b.insert_many(batch)
+                res[method] = time.perf_counter() - t0
+            print('{:<8} {:<9} n={:<7} '.format(storage, name, len(batch)) + '  '.join('{}={:.3f}s'.format(k, v) for (k, v) in res.items()))
+
+###########################################################
+# period_status window and period metrics on a 7 hour power buffer:
+# queries vs. the continuous aggregates, one new sample and snapshot per
+# call
+#
+def bench_aggregates(args):
+    from data.aggregates import RollingMean, RollingExtreme, EWMA, PeriodIntegral
+
+    for storage in ('columns', 'gorilla'):
+        samples = han_series(HOURS_7)
+        t_last = samples[-1][0]
+        res = {}
+        for method in ('query', 'aggregate'):
+            b = FloatTimeBuffer(storage=storage)
+            b.save = lambda: None
+            b.sorted_list = samples
+            b.register_aggregate('avg_1m', RollingMean, 60)
+            b.register_aggregate('avg_5m', RollingMean, 300)
+            b.register_aggregate('max_5m', RollingExtreme, 300)
+            b.register_aggregate('ewma', EWMA, 60)
+            b.register_aggregate('hour', PeriodIntegral, 3600)
+
+            def tick(i):
+                ts = t_last + 2*(i+1)
+                b.insert_sorted(ts, 1000.0 + i % 7)
+                s = b.snapshot()
+                if method == 'query':
+                    s.avg(ts - 60, ts)
+                    s.avg(ts - 300, ts)
+                    s.get_max(ts - 300, ts)
+                    s.integrate(3600*int(ts/3600), ts)
+                    s.integrate(3600*int(ts/3600) - 3600, 3600*int(ts/3600))
+                else:
+                    s.aggregate('avg_1m', ts)
+                    s.aggregate('avg_5m', ts)
+                    s.aggregate('max_5m', ts)
+                    s.aggregate('ewma', ts)
+                    s.aggregate('hour', ts)
+
+            tick(0)
+            res[method] = timeit(lambda i: tick(i+1), 500)
+        print('{:<8} n={:<7} '.format(storage, len(samples)) + '  '.join('{}={:.1f}us'.format(k, v) for (k, v) in res.items()))
+
+###########################################################
+# Timestamp formatting and month bounds: datetime with the zone looked
+# up per call (the old helpers) vs. the cached local calendar
+#
+def bench_calendar(args):
+    import datetime
+    from data.local_calendar import LocalCalendar
+
+    calendar = LocalCalendar()
+    now = int(time.time())
+
+    def old_format(i):
+        local_zone = datetime.datetime.now().astimezone().tzinfo
+        ts = now - 7*i
+        datetime.datetime.fromtimestamp(ts, local_zone).strftime('%Y.%m.%d')
+        datetime.datetime.fromtimestamp(ts, local_zone).strftime('%H:%M:%S')
+
+    def old_month(i):
+        local_zone = datetime.datetime.now().astimezone().tzinfo
+        from_date = datetime.datetime.fromtimestamp(now - 7*i, local_zone).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        (from_date + datetime.timedelta(days=32)).replace(day=1).timestamp()
+
+    res = {
+        'ymd+hms old': timeit(old_format, 10000),
+        'ymd+hms cached': timeit(lambda i: calendar.ymd_hms(now - 7*i), 10000),
+        'month old': timeit(old_month, 10000),
+        'month cached': timeit(lambda i: calendar.month_bounds(now - 7*i), 10000),
+    }
+    print('zone={} '.format(calendar.zone) + '  '.join('{}={:.2f}us'.format(k, v) for (k, v) in res.items()))
+
+###########################################################
+# Main loop status calls (monthly_status + period_status) every 5 s on
+# a 7 hour power buffer with 2 s HAN samples and a month of hourly
+# energy register readings, with and without the status cache. Only
+# the status calls are timed.
+#
+def bench_status(args):
+    import tempfile
+    from data.energy_calc import EnergyCalculator
+    from data.persistence import PersistenceWorker
+
+    now = int(time.time()) - 4*3600     # Ticks run up to the present
+    res = {}
+    for cached in (False, True):
+        c = EnergyCalculator(log_dir=tempfile.mkdtemp(), persistence=PersistenceWorker())
+        for b in (c.power_buffer, c.energy_buffer):
+            b.save = lambda: None
+        c.capacity.save = lambda: None
+        c.power_buffer.sorted_list = han_series(HOURS_7, start=now-HOURS_7)
+        c.energy_buffer.sorted_list = [(ts, i*0.001) for (i, (ts, v)) in enumerate(han_series(DAYS_32-3600, start=now-DAYS_32+3600, period=3600))]
+
+        elapsed = 0.0
+        n = 0
+        for i in range(2*3600):
+            ts = now + 2*i
+            c.insert_power(ts, 1000.0 + i % 7)
+            if ts % 3600 < 2:
+                c.insert_energy(ts, c.energy_buffer.get_last_tuple()[1] + 0.001)
+            if i % 3 == 0:
+                if not cached:
+                    c.status_cache.clear()
+                t0 = time.perf_counter()
+                c.monthly_status(ts)
+                c.period_status(5, ts)
+                elapsed += time.perf_counter() - t0
+                n += 1
+
+        res['uncached' if not cached else 'cached'] = '{:.1f}us'.format(1e6*elapsed/n)
+    res.update(c.status_cache.metrics())
+    print('  '.join('{}={}'.format(k, v) for (k, v) in res.items()))
+
+###########################################################
+# Two gateways delivering the same 2 s frames with jitter: insert_sorted
+# per frame vs. the reorder buffer in front of insert_many, with an
+# integral and max query every 5 frames (out-of-order inserts make the
+# indexes rebuild)
+#
+def bench_ingest(args):
+    from data.ingest import ReorderBuffer
+
+    now = int(time.time())
+    rnd = random.Random(3)
+    frames = han_series(3600, start=now - 3600)
+    arrivals = sorted((ts + rnd.choice((0, 0, 1, 3)) + rnd.random(), ts, v) for (ts, v) in frames for gateway in range(2))
+
+    for storage in ('columns', 'gorilla'):
+        res = {}
+        for method in ('insert_sorted', 'reorder'):
+            b = FloatTimeBuffer(age=HOURS_7, storage=storage)
+            b.save = lambda: None
+            b.sorted_list = han_series(HOURS_7 - 3600, start=now - HOURS_7)
+            r = ReorderBuffer(sink=lambda batch: b.insert_many(batch), late=lambda ts, v: b.insert_sorted(ts, v))
+            t0 = time.perf_counter()
+            for (i, (arrival, ts, v)) in enumerate(arrivals):
+                if method == 'insert_sorted':
+                    b.insert_sorted(ts, v)
+                else:
+                    r.add(ts, v)
+                if i % 5 == 0:
+                    b.integrate(arrival - 3600, arrival)
+                    b.get_max(arrival - 3600, arrival)
+            r.flush()
+            res[method] = '{:.1f}us'.format(1e6*(time.perf_counter() - t0)/len(arrivals))
+        res.update(r.metrics())
+        print('{:<8} '.format(storage) + '  '.join('{}={}'.format(k, v) for (k, v) in res.items()))
+
+#################################################################
+# Power frame ingest: one FloatTimeBuffer per value (P_pos, P_neg) vs
+# one FrameBuffer for all ten channels of a HAN frame
+#
+def bench_frames(args):
+    from data.frame_buffer import FrameBuffer
+
+    now = int(time.time())
+    samples = han_series(HOURS_7 - 60, start=now - HOURS_7)
+    channels = ['P_pos', 'P_neg', 'Q_pos', 'Q_neg', 'I1', 'I2', 'I3', 'U1', 'U2', 'U3']
+    frames = [(ts, dict({c: v*(i+1)/10 for (i, c) in enumerate(channels)}, P_neg=0.0)) for (ts, v) in samples]
+
+    t0 = time.perf_counter()
+    buffers = {c: FloatTimeBuffer(age=HOURS_7) for c in ('P_pos', 'P_neg')}
+    for (ts, frame) in frames:
+        for (c, b) in buffers.items():
+            b.insert(ts, frame[c])
+    t_split = time.perf_counter() - t0
+    size_split = sum(len(b.storage.ts)*16 for b in buffers.values())
+
+    print('2 buffers, 2 channels:     {:.2f}us/frame  {:.0f}kB'.format(1e6*t_split/len(frames), size_split/1024))
+    for n in (2, len(channels)):
+        t0 = time.perf_counter()
+        fb = FrameBuffer({c: False for c in channels[:n]}, age=HOURS_7)
+        for (ts, frame) in frames:
+            fb.insert(ts, frame)
+        t_frames = time.perf_counter() - t0
+        size_frames = len(fb.storage.ts)*8*(1 + n)
+        print('frame buffer, {:>2} channels: {:.2f}us/frame  {:.0f}kB'.format(n, 1e6*t_frames/len(frames), size_frames/1024))
+
+    b = buffers['P_pos']
+    v = fb.channel('P_pos')
+    for (name, q) in (('FloatTimeBuffer', b), ('FrameBuffer view', v)):
+        t = timeit(lambda i: (q.integrate(now - 3600, now), q.get_max(now - 3600, now)), 200)
+        print('{:<17} integrate+max 1h: {:.1f}us'.format(name, t))
+
+#################################################################
+# Quantile digests: per-sample cost of feeding a day digest, month
+# query (merge of the days) and bytes per day vs. the raw samples
+#
+def bench_quantiles(args):
+    from data.quantiles import TDigest
+
+    samples = han_series(DAYS_32)
+    days = {}
+    t0 = time.perf_counter()
+    for ((ts, v), (ts_next, v_next)) in zip(samples, samples[1:]):
+        day = ts - ts % 86400
+        if day not in days:
+            days[day] = TDigest()
+        days[day].add(v, ts_next - ts)
+    t_add = time.perf_counter() - t0
+    centroids = max(len(d) for d in days.values())
+
+    def month(i):
+        return TDigest().merge(*days.values()).quantile(0.99)
+    t_month = timeit(month, 20)
+
+    values = sorted(v for (ts, v) in samples)
+    t_sort = timeit(lambda i: sorted(v for (ts, v) in samples)[int(0.99*len(samples))], 3)
+    print('add: {:.2f}us/sample  month P99 from {} day digests: {:.0f}us (sorting samples: {:.0f}us)'.format(1e6*t_add/len(samples), len(days), t_month, t_sort))
+    print('day digest: {} centroids, {} bytes (raw day: {} bytes)'.format(centroids, centroids*16, 16*86400//HAN_PERIOD))
+    print('P99 month: digest {:.0f}  exact {:.0f}'.format(month(0), values[int(0.99*len(values))]))
+
+#################################################################
+# SQLite long-term store: range queries over a year of per-minute
+# samples vs. the same queries on an in-memory FloatTimeBuffer
+#
+def bench_sqlite(args):
+    import os
+    import tempfile
+    from data.sqlite_store import SqliteBuffer
+
+    class NoPersistence:
+        def mark_dirty(self, buffer):
+            pass
+
+    now = int(time.time()) // 86400 * 86400
+    year = 365*24*3600
+    samples = han_series(year, start=now - year, period=60)
+    with tempfile.TemporaryDirectory() as d:
+        store = SqliteBuffer(os.path.join(d, 'bench.sqlite'), 'power', persistence=NoPersistence())
+        t0 = time.perf_counter()
+        for k in range(0, len(samples), 10000):
+            store.insert_many(samples[k:k+10000])
+            store.flush()
+        t_insert = time.perf_counter() - t0
+        db_bytes = sum(os.path.getsize(os.path.join(d, f)) for f in os.listdir(d))
+
+        (b, nbytes) = build(samples, 'columns')
+        print('{} samples: insert {:.2f}us/sample, {:.1f}MB on disk ({:.1f}MB in memory as columns)'.format(len(samples), 1e6*t_insert/len(samples), db_bytes/1e6, nbytes/1e6))
+
+        rnd = random.Random(1)
+        def query(q, name):
+            t_from = lambda i: now - year + rnd.randrange(year - 32*86400)
+            queries = {
+                'get_value': lambda i: q.get_value(t_from(i) + 0.5),
+                'get_interval 1d': lambda i: q.get_interval(*(lambda f: (f, f + 86400))(t_from(i))),
+                'integrate 1d': lambda i: q.integrate(*(lambda f: (f, f + 86400))(t_from(i))),
+                'integrate 30d': lambda i: q.integrate(*(lambda f: (f, f + 30*86400))(t_from(i))),
+                'get_max 30d': lambda i: q.get_max(*(lambda f: (f, f + 30*86400))(t_from(i))),
+                'period max list 30d': lambda i: q.get_period_max_list(*(lambda f: (f, f + 30*86400))(t_from(i))),
+            }
+            print('{:<8} '.format(name) + '  '.join('{}={:.0f}us'.format(k, timeit(fn, 20)) for (k, fn) in queries.items()))
+        query(b, 'memory')
+        query(store, 'sqlite')
+
+#################################################################
+# Columnar export: writing 32 days of register readings as daily
+# Parquet/Arrow files and reading them back, vs. the YAML backup
+#
+def bench_export(args):
+    import os
+    import tempfile
+    import yaml
+    from data.export import ColumnarExporter, pyarrow
+    from data.local_calendar import default_calendar
+
+    if pyarrow is None:
+        print('pyarrow not installed')
+        return
+
+    now = int(time.time())
+    samples = han_series(DAYS_32, start=now - DAYS_32)
+    (b, nbytes) = build(samples, 'columns', accumulated=True)
+    with tempfile.TemporaryDirectory() as d:
+        for format in ('parquet', 'arrow'):
+            exporter = ColumnarExporter(os.path.join(d, format), lambda: {'energy': b}, default_calendar(), format=format)
+            t0 = time.perf_counter()
+            files = exporter.run(now=now + 3600)
+            t_export = time.perf_counter() - t0
+            nbytes = exporter.metrics()['bytes_written']
+
+            t0 = time.perf_counter()
+            if format == 'parquet':
+                import pyarrow.parquet
+                table = pyarrow.parquet.read_table(os.path.join(d, format))
+            else:
+                import pyarrow.dataset
+                table = pyarrow.dataset.dataset(os.path.join(d, format), format='ipc', partitioning='hive').to_table()
+            t_read = time.perf_counter() - t0
+            print('{:<8} {} files: export {:.2f}us/sample, {:.1f}MB ({:.2f} bytes/sample), read {} rows {:.0f}ms'.format(
+                format, files, 1e6*t_export/len(samples), nbytes/1e6, nbytes/len(samples), table.num_rows, 1000*t_read))
+
+        if DAYS_32 <= args.yaml_max:
+            t0 = time.perf_counter()
+            data = yaml.dump(b.storage.to_list())
+            t_dump = time.perf_counter() - t0
+            t0 = time.perf_counter()
+            yaml.load(data, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+            t_load = time.perf_counter() - t0
+            print('yaml     dump {:.2f}us/sample, {:.1f}MB, load {:.0f}ms'.format(1e6*t_dump/len(samples), len(data)/1e6, 1000*t_load))
+
+###########################################################
+# Control step of a per-meter site before its first meter is known
+# (fresh start): the site status must be offline at emulated max power
+# and the step must turn a vehicle down, as with one meter without
+# readings
+#
+def bench_site(args):
+    import logging
+    import tempfile
+    import shedder
+    from data.site import MeterShards, SiteCalculator
+    from replay import MockVehicle
+    from charge_controller import ChargeController
+
+    log_dir = tempfile.mkdtemp()
+    shedder.settings = shedder.get_settings('../conf')
+    shedder.settings.set('buffers', 'per_meter', 'true')
+    shedder.loop_settings = shedder.get_loop_settings(shedder.settings)
+    shedder.dynamic_settings = shedder.get_dynamic_settings(log_dir)
+    shedder.logger = logging.getLogger('site')
+    meters = MeterShards(lambda meter_id: None)
+    shedder.calculator_import = SiteCalculator(lambda: [m['import'] for m in meters.values()])
+    shedder.calculator_export = SiteCalculator(lambda: [m['export'] for m in meters.values()])
+
+    home_location = {'lat': 0.0, 'lon': 0.0}
+    vehicles = [MockVehicle(vin, shedder.default_clock(), random.Random(1), home_location) for vin in shedder.dynamic_settings['control']['included_cars']]
+    cc = ChargeController(vehicles=vehicles, settings=shedder.dynamic_settings, home_location=home_location,
+                          update_period=5, log_dir=log_dir, log_level='WARNING')
+
+    errors = []
+    t0 = time.perf_counter()
+    (status_import, status_export) = shedder.period_statuses()
+    decisions = shedder.control(cc, status_import, status_export, {'last_adjust': 0, 'last_adjust_sun': 0})
+    elapsed = time.perf_counter() - t0
+
+    max_power = 3600*shedder.dynamic_settings['control']['max_energy']/shedder.loop_settings['calculation_period_duration']
+    if not status_import['metering_offline'] or status_import['power_avg_1m'] != max_power:
+        errors.append('site status not offline at max power: {}'.format(status_import))
+    if [d['mode'] for d in decisions] != ['offline'] or decisions[0]['action'] != 'down':
+        errors.append('no offline adjustment: {}'.format(decisions))
+
+    print('meters={}  step={:.0f}us  decisions={}'.format(len(meters.ids()), 1e6*elapsed, decisions))
+    print('errors: {}'.format(errors if len(errors) > 0 else 'none'))
+
+BENCHMARKS = {
+    'storage': bench_storage,
+    'append': bench_append,
+    'restore': bench_restore,
+    'integrate': bench_integrate,
+    'extremes': bench_extremes,
+    'monthly': bench_monthly,
+    'batch': bench_batch,
+    'retention': bench_retention,
+    'compression': bench_compression,
+    'partitions': bench_partitions,
+    'backends': bench_backends,
+    'stress': bench_stress,
+    'bulk': bench_bulk,
+    'aggregates': bench_aggregates,
+    'calendar': bench_calendar,
+    'status': bench_status,
+    'ingest': bench_ingest,
+    'frames': bench_frames,
+    'quantiles': bench_quantiles,
+    'sqlite': bench_sqlite,
+    'export': bench_export,
+    'site': bench_site,
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS.keys()))
+    parser.add_argument('--duration', type=float, default=180, help='Stress test duration (s)')
+    parser.add_argument('--yaml_max', type=int, default=DAYS_32, help='Skip YAML for buffers longer than this (s)')
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args)
+    sys.exit(0)
@@ -1,9 +1,8 @@
-import time
 import random
-import datetime
 import log_handler
 from requests.exceptions import HTTPError
 from utils import ts2iso
+from data.clock import default_clock
 
 
 class ChargeController:
@@ -19,6 +18,8 @@ class ChargeController:
         update_period: int,
         log_dir: str,
         log_level: str,
+        clock=None,
+        rng=None,
     ):
 
         self.vehicles = vehicles
@@ -27,6 +28,10 @@ class ChargeController:
         self.home_location = home_location
         self.last_start_stop = 0
 
+        # Time and random choices are injectable for replays (see replay.py)
+        self.clock = clock if clock is not None else default_clock()
+        self.random = rng if rng is not None else random
+
         self.logger = log_handler.create_logger(
             name="charge_controller", log_dir=log_dir, level=log_level
         )
@@ -36,7 +41,7 @@ class ChargeController:
 
         for v in vehicles:
             v.timestamp = 0
-            self.floor_time[v.get("vin")] = time.time()
+            self.floor_time[v.get("vin")] = self.clock.time()
 
             self.get_vehicle_data(v)
 
@@ -70,7 +75,7 @@ class ChargeController:
         except Exception:
             self.logger.warning(f"Failed to read timestamp: {e}")
 
-        if awake or time.time() - prev_ts > self.update_period:
+        if awake or self.clock.time() - prev_ts > self.update_period:
             try:
                 sleep_time = (
                     self.settings.get("control")
@@ -93,7 +98,7 @@ class ChargeController:
                     or v.get("charge_state") is None
                     or (v.get("charge_state", {}).get("charging_state") or "").lower()
                     == "charging"
-                    or time.time() - prev_charge_ts > sleep_time
+                    or self.clock.time() - prev_charge_ts > sleep_time
                 ):
 
                     # NOTE: Keep awake
@@ -116,7 +121,7 @@ class ChargeController:
                     n = v.get("display_name", "?") or v.get("vehicle_state", {}).get(
                         "vehicle_name", "?"
                     )
-                    t = int(prev_charge_ts + sleep_time - time.time())
+                    t = int(prev_charge_ts + sleep_time - self.clock.time())
                     self.logger.debug(
                         f"{v.get('vin')} {n} polling postponed {t // 60}m {t % 60}s (not charging) to avoid keeping vehicle awake"
                     )
@@ -127,16 +132,16 @@ class ChargeController:
                     or httpe.response.reason.find("unavailab") > 0
                 ):
                     self.logger.info(
-                        f"Vehicle {v.get('vin')} unavailable {ts2iso(time.time())}: {httpe.response.reason}"
+                        f"Vehicle {v.get('vin')} unavailable {ts2iso(self.clock.time())}: {httpe.response.reason}"
                     )
                 else:
                     self.logger.warning(
-                        f"Failed to get vehicle data for {v.get('vin')} at {ts2iso(time.time())}: {httpe}"
+                        f"Failed to get vehicle data for {v.get('vin')} at {ts2iso(self.clock.time())}: {httpe}"
                     )
 
             except Exception as e:
                 self.logger.warning(
-                    f"Failed to get vehicle data for {v.get('vin')} at {ts2iso(time.time())}: {e}"
+                    f"Failed to get vehicle data for {v.get('vin')} at {ts2iso(self.clock.time())}: {e}"
                 )
 
             finally:
@@ -147,9 +152,9 @@ class ChargeController:
     #
     def shed(self, v):
         vin = v.get("vin")
-        h = datetime.datetime.now().hour + 1
+        h = self.clock.now().hour + 1
         self.logger.warning(
-            f"{vin} Shedding/cutting power after {int(time.time() - self.floor_time.get(vin))}s"
+            f"{vin} Shedding/cutting power after {int(self.clock.time() - self.floor_time.get(vin))}s"
         )
         self.logger.warning(f"{vin} => Postponing charging to {h:2}:00:00")
 
@@ -162,7 +167,7 @@ class ChargeController:
                     and v.get("charge_state").get("charging_state").lower()
                     == "charging"
                 ):
-                    if (time.time() - self.last_start_stop) < self.settings.get(
+                    if (self.clock.time() - self.last_start_stop) < self.settings.get(
                         "control"
                     ).get("start_stop_guard_time"):
                         self.logger.warning(
@@ -174,7 +179,7 @@ class ChargeController:
 
                     # NOTE: Wake
                     v.command("STOP_CHARGE")
-                    self.last_start_stop = time.time()
+                    self.last_start_stop = self.clock.time()
 
             except Exception as e:
                 self.logger.warning("shed() failed: {}".format(e))
@@ -184,13 +189,13 @@ class ChargeController:
             v.command(
                 "SCHEDULED_CHARGING",
                 enable=True,
-                time=h * 60 + int(random.random() * 10),
+                time=h * 60 + int(self.random.random() * 10),
             )
-            time.sleep(1)
+            self.clock.sleep(1)
             self.logger.debug("shed() - normal")
             # NOTE: Wake
             v.command("STOP_CHARGE")
-            self.last_start_stop = time.time()
+            self.last_start_stop = self.clock.time()
 
     ###########################################################
     # Find random vehicle from vehicles charging
@@ -198,9 +203,10 @@ class ChargeController:
     def sun_charge_enabled(self):
 
         # Sun charge during day only
-        if datetime.datetime.now().hour < self.settings.get("control").get(
+        hour = self.clock.now().hour
+        if hour < self.settings.get("control").get(
             "sun_charge_start_hour"
-        ) or datetime.datetime.now().hour >= self.settings.get("control").get(
+        ) or hour >= self.settings.get("control").get(
             "sun_charge_stop_hour"
         ):
             return False
@@ -228,7 +234,7 @@ class ChargeController:
     def sun_charge_start_minimum(self):
 
         # # Ensure start/stop is not called too often
-        # if (time.time() - self.last_start_stop) < self.settings.get('control').get('start_stop_guard_time'):
+        # if (self.clock.time() - self.last_start_stop) < self.settings.get('control').get('start_stop_guard_time'):
         #     self.logger.warning('sun_charge_start_minimum() not completed because of guard time')
         #     return
 
@@ -256,7 +262,7 @@ class ChargeController:
                         self.logger.debug(f"sun_charge_start_minimum() {name}")
                         self.get_vehicle_data(v, awake=True)
 
-                        if (time.time() - self.last_start_stop) < self.settings.get(
+                        if (self.clock.time() - self.last_start_stop) < self.settings.get(
                             "control"
                         ).get("start_stop_guard_time"):
                             self.logger.warning(
@@ -265,7 +271,7 @@ class ChargeController:
                         else:
                             v.command("CHARGING_AMPS", charging_amps=self.MIN_CURRENT)
                             v.command("START_CHARGE")
-                            self.last_start_stop = time.time()
+                            self.last_start_stop = self.clock.time()
 
         except Exception as e:
             self.logger.warning("start_sun_charge_minimum() failed: {}".format(e))
@@ -276,7 +282,7 @@ class ChargeController:
     def sun_charge_stop(self):
 
         # Ensure start/stop is not called too often
-        if (time.time() - self.last_start_stop) < self.settings.get("control").get(
+        if (self.clock.time() - self.last_start_stop) < self.settings.get("control").get(
             "start_stop_guard_time"
         ):
             self.logger.warning("sun_charge_stop() not completed because of guard time")
@@ -303,7 +309,7 @@ class ChargeController:
 
                         # NOTE: Wake
                         v.command("STOP_CHARGE")
-                        self.last_start_stop = time.time()
+                        self.last_start_stop = self.clock.time()
 
         except Exception as e:
             self.logger.warning("sun_charge_stop() failed: {}".format(e))
@@ -328,7 +334,7 @@ class ChargeController:
                         l.append(v)
 
             if len(l) > 0:
-                v_return = random.choice(l)
+                v_return = self.random.choice(l)
 
         except Exception as e:
             self.logger.warning("get_random_vehicle() failed: {}".format(e))
@@ -424,13 +430,13 @@ class ChargeController:
                 self.logger.debug(f"{v.get('vin')} not home!")
 
                 # Reset floor current timer
-                self.floor_time[v.get("vin")] = time.time()
+                self.floor_time[v.get("vin")] = self.clock.time()
                 return 0
 
             if v.get("charge_state").get("charging_state").lower() != "charging":
 
                 # Reset floor current timer
-                self.floor_time[v.get("vin")] = time.time()
+                self.floor_time[v.get("vin")] = self.clock.time()
                 return 0
 
             if up and current_current < max_current:
@@ -439,7 +445,7 @@ class ChargeController:
                 v.command("CHARGING_AMPS", charging_amps=adjust_current)
 
                 # Reset floor current timer
-                self.floor_time[v.get("vin")] = time.time()
+                self.floor_time[v.get("vin")] = self.clock.time()
 
             elif down:
                 if current_current > self.MIN_CURRENT:
@@ -448,12 +454,12 @@ class ChargeController:
                     v.command("CHARGING_AMPS", charging_amps=adjust_current)
 
                     # Reset floor current timer
-                    self.floor_time[v.get("vin")] = time.time()
+                    self.floor_time[v.get("vin")] = self.clock.time()
                 else:
                     # If trying to reduce charge power lower than min, cut power
-                    if time.time() - self.floor_time[v.get("vin")] > (
+                    if self.clock.time() - self.floor_time[v.get("vin")] > (
                         self.settings.get("control").get("max_floor_time")
-                        + int(random.random() * 120)
+                        + int(self.random.random() * 120)
                     ):
                         self.shed(v)
 
@@ -537,14 +543,14 @@ class ChargeController:
                     # v.update(v.api('VEHICLE_DATA', endpoints='location_data;drive_state;'
                     #                     'charge_state;climate_state;vehicle_state;'
                     #                     'gui_settings;vehicle_config')['response'])
-                    # v.timestamp = time.time()
+                    # v.timestamp = self.clock.time()
 
                     cs["vin"] = v.get("vin")
                     cs["shedder_enabled"] = v.get("vin") in included_cars
                     cs["shedder_floor_time"] = ts2iso(self.floor_time.get(v.get("vin")))
                     cs["seconds_until_shed"] = self.settings.get("control").get(
                         "max_floor_time"
-                    ) - int(time.time() - self.floor_time.get(v.get("vin")))
+                    ) - int(self.clock.time() - self.floor_time.get(v.get("vin")))
                     cs["at_location"] = self.at_location(v)
                     cs["latitude"] = v.get("drive_state", {}).get("latitude")
                     cs["longitude"] = v.get("drive_state", {}).get("longitude")
@@ -0,0 +1,314 @@
+import math
+import operator
+from collections import deque
+from .index import BufferIndex
+from .storage import ts_out
+
+#####################################################################
+# Continuous aggregates over a FloatTimeBuffer
+#
+# Rolling window aggregates kept up to date as samples are appended, so
+# reading one is O(1) (amortized) instead of a query over the window.
+# They are buffer indexes: in-order appends update them incrementally,
+# anything else (out-of-order insert, crop, load) makes them rebuild
+# from the buffer on the next read.
+#
+# value(ts) returns the aggregate over the window ending at ts, with the
+# last sample held up to ts like integrate/avg do. Reads for a ts before
+# the last sample fall back to querying the buffer. On an empty buffer
+# it is the class's empty value, what the query it replaces returns
+# then (0 for integrate/avg, None for get_max/get_min). Register them
+# with FloatTimeBuffer.register_aggregate(), on non-accumulated buffers.
+#
+class Aggregate(BufferIndex):
+
+    empty = None
+
+    def __init__(self, buffer, window):
+        self.window = window
+        self.samples = deque()      # (ts, value), oldest may precede the window
+        BufferIndex.__init__(self, buffer)
+
+    def last(self):
+        storage = self.buffer.storage
+        n = len(storage)
+        return (storage.ts_at(n-1), storage.value_at(n-1))
+
+    #################################################################
+    # Samples from the one preceding the window ending at the last
+    # sample. Subclasses add their state.
+    #
+    def rebuild(self):
+        storage = self.buffer.storage
+        self.samples = deque()
+        if len(storage) > 0:
+            from_idx = max(self.buffer.get_index(storage.ts_at(len(storage)-1) - self.window) - 1, 0)
+            for (ts, value) in storage.iter_items(from_idx, len(storage)):
+                self.push(ts, value)
+
+    def on_append(self):
+        if self.valid:
+            self.push(*self.last())
+
+    def push(self, ts, value):
+        self.samples.append((ts, value))
+        self.evict(ts - self.window)
+
+    #################################################################
+    # Drop samples no longer needed for windows starting at start
+    #
+    def evict(self, start):
+        samples = self.samples
+        while len(samples) >= 2 and samples[1][0] <= start:
+            self.drop(samples.popleft(), samples[0])
+
+    def drop(self, sample, next_sample):
+        pass
+
+    #################################################################
+    # Expired samples leave the window from the front
+    #
+    def on_drop_head(self, n):
+        if not self.valid:
+            return
+        storage = self.buffer.storage
+        first_ts = storage.ts_at(0) if len(storage) > 0 else math.inf
+        samples = self.samples
+        while len(samples) > 0 and samples[0][0] < first_ts:
+            sample = samples.popleft()
+            self.drop(sample, samples[0] if len(samples) > 0 else sample)
+
+    def value(self, ts=None):
+        self.ensure()
+        storage = self.buffer.storage
+        if len(storage) <= 0:
+            return self.empty
+        last_ts = storage.ts_at(len(storage)-1)
+        if ts is None:
+            ts = last_ts
+        if ts < last_ts:
+            return self.query(ts)
+        return self.current(ts)
+
+
+#####################################################################
+# Integral over the last window seconds (same as integrate(ts-window, ts))
+#
+class RollingIntegral(Aggregate):
+
+    empty = 0
+
+    def rebuild(self):
+        self.closed = 0.0           # Integral from first to last sample held
+        Aggregate.rebuild(self)
+
+    def push(self, ts, value):
+        if len(self.samples) > 0:
+            (prev_ts, prev_value) = self.samples[-1]
+            self.closed += prev_value*(ts - prev_ts)
+        Aggregate.push(self, ts, value)
+
+    def drop(self, sample, next_sample):
+        self.closed -= sample[1]*(next_sample[0] - sample[0])
+
+    def query(self, ts):
+        return self.buffer.integrate(ts - self.window, ts)
+
+    def current(self, ts):
+        start = ts - self.window
+        samples = self.samples
+        (first_ts, first_value) = samples[0]
+        (last_ts, last_value) = samples[-1]
+        sum = self.closed + last_value*(ts - last_ts)
+
+        # Front samples whose step ends before the window start (only
+        # when ts is past the last sample)
+        k = 0
+        while k+1 < len(samples) and samples[k+1][0] <= start:
+            sum -= samples[k][1]*(samples[k+1][0] - samples[k][0])
+            k += 1
+        (t0, v0) = samples[k]
+        return sum - v0*(start - t0)
+
+
+#####################################################################
+# Time weighted mean over the last window seconds (same as
+# avg(ts-window, ts))
+#
+class RollingMean(RollingIntegral):
+
+    def query(self, ts):
+        return self.buffer.avg(ts - self.window, ts)
+
+    def current(self, ts):
+        if self.window == 0:
+            return 0
+        return RollingIntegral.current(self, ts)/self.window
+
+
+#####################################################################
+# First [ts, value] of the largest (better=operator.gt) or smallest
+# (operator.lt) sample within the last window seconds (same as
+# get_max/get_min(ts-window, ts)). samples only holds the candidates,
+# ordered by ts with values getting worse.
+#
+class RollingExtreme(Aggregate):
+
+    def __init__(self, buffer, window, better=operator.gt):
+        self.better = better
+        Aggregate.__init__(self, buffer, window)
+
+    def push(self, ts, value):
+        samples = self.samples
+        while len(samples) > 0 and not self.better(samples[-1][1], value) and samples[-1][1] != value:
+            samples.pop()
+        samples.append((ts, value))
+
+    def evict(self, start):
+        pass
+
+    def on_drop_head(self, n):
+        pass
+
+    def query(self, ts):
+        return self.buffer.get_extreme(ts - self.window, ts, self.better)
+
+    def current(self, ts):
+        start = ts - self.window
+        for (sample_ts, value) in self.samples:
+            if sample_ts >= start:
+                return [ts_out(sample_ts), value]
+        return None
+
+    #################################################################
+    # Candidates before the last window can go
+    #
+    def on_append(self):
+        if self.valid:
+            (ts, value) = self.last()
+            self.push(ts, value)
+            while self.samples[0][0] < ts - self.window:
+                self.samples.popleft()
+
+
+#####################################################################
+# Exponentially weighted moving average with time constant tau seconds,
+# weighting each value by how long it was held. Rebuilt from the samples
+# of the last REBUILD_TAUS*tau seconds.
+#
+REBUILD_TAUS = 10
+
+class EWMA(Aggregate):
+
+    empty = 0
+
+    def __init__(self, buffer, tau):
+        self.ewma = None
+        self.prev = None
+        Aggregate.__init__(self, buffer, REBUILD_TAUS*tau)
+        self.tau = tau
+
+    def rebuild(self):
+        self.ewma = None
+        self.prev = None
+        Aggregate.rebuild(self)
+
+    def push(self, ts, value):
+        self.ewma = self.decay(ts)
+        self.prev = (ts, value)
+
+    def on_drop_head(self, n):
+        pass
+
+    def decay(self, ts):
+        if self.prev is None:
+            return None
+        a = math.exp(-(ts - self.prev[0])/self.tau)
+        if self.ewma is None:
+            return self.prev[1]
+        return a*self.ewma + (1 - a)*self.prev[1]
+
+    def query(self, ts):
+        ewma = None
+        prev = None
+        (from_idx, to_idx) = self.buffer.get_interval_index(from_ts=ts - self.window, to_ts=ts)
+        for (sample_ts, value) in self.buffer.storage.iter_items(max(from_idx - 1, 0), to_idx):
+            if prev is not None:
+                a = math.exp(-(sample_ts - prev[0])/self.tau)
+                ewma = prev[1] if ewma is None else a*ewma + (1 - a)*prev[1]
+            prev = (sample_ts, value)
+        if prev is None:
+            return self.buffer.get_value(ts, selection='pre')
+        a = math.exp(-(ts - prev[0])/self.tau)
+        return prev[1] if ewma is None else a*ewma + (1 - a)*prev[1]
+
+    def current(self, ts):
+        ewma = self.decay(ts)
+        return self.prev[1] if ewma is None else ewma
+
+
+#####################################################################
+# (integral since the start of the period holding ts, integral over the
+# whole period before it) for fixed periods of duration seconds
+# aligned to the epoch, same as integrate(start, ts) and
+# integrate(start-duration, start). The running integral grows with
+# each sample and is frozen as the previous period's total when a
+# sample crosses into the next period.
+#
+class PeriodIntegral(Aggregate):
+
+    empty = (0, 0)
+
+    def __init__(self, buffer, duration):
+        self.duration = duration
+        Aggregate.__init__(self, buffer, duration)
+
+    def period(self, ts):
+        return self.duration*int(ts/self.duration)
+
+    def rebuild(self):
+        storage = self.buffer.storage
+        self.prev = None
+        if len(storage) > 0:
+            self.prev = self.last()
+            self.start = self.period(self.prev[0])
+            self.current_sum = self.buffer.integrate(self.start, self.prev[0])
+            self.prev_sum = self.buffer.integrate(self.start - self.duration, self.start)
+
+    def push(self, ts, value):
+        if self.prev is None:
+            self.rebuild()
+            return
+        (last_ts, last_value) = self.prev
+        start = self.period(ts)
+        if start == self.start:
+            self.current_sum += last_value*(ts - last_ts)
+        else:
+            if start == self.start + self.duration:
+                self.prev_sum = self.current_sum + last_value*(start - last_ts)
+            else:
+                self.prev_sum = last_value*self.duration
+            self.start = start
+            self.current_sum = last_value*(ts - start)
+        self.prev = (ts, value)
+
+    #################################################################
+    # Expiry only matters when it reaches the previous period
+    #
+    def on_drop_head(self, n):
+        storage = self.buffer.storage
+        if self.valid and (len(storage) <= 0 or storage.ts_at(0) > self.start - self.duration):
+            self.invalidate()
+
+    def query(self, ts):
+        start = self.period(ts)
+        return (self.buffer.integrate(start, ts), self.buffer.integrate(start - self.duration, start))
+
+    def current(self, ts):
+        (last_ts, last_value) = self.prev
+        start = self.period(ts)
+        if start == self.start:
+            return (self.current_sum + last_value*(ts - last_ts), self.prev_sum)
+        elif start == self.start + self.duration:
+            return (last_value*(ts - start), self.current_sum + last_value*(start - last_ts))
+        return (last_value*(ts - start), last_value*self.duration)
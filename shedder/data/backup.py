@@ -0,0 +1,463 @@
+import os
+import mmap
+import struct
+import logging
+from array import array
+from collections import deque
+import yaml
+from .persistence import atomic_write
+
+#####################################################################
+# Backup formats for TimeBuffer
+#
+# * 'yaml':   whole buffer as a YAML list of [ts, value] (any value type)
+# * 'binary': float64 snapshot of the ts/value columns, memory-mapped on
+#             restore, plus an append-only journal of the inserts since
+#             the snapshot. The journal is replayed on restore and folded
+#             into a new snapshot once it grows past a quarter of it.
+# * 'partitioned': one float64 snapshot file per time partition in a
+#             directory; only partitions touched since the last write
+#             are rewritten and expired ones are deleted.
+#
+# FrameBackup is the 'binary' layout for FrameBuffer: one ts column and
+# a value column per channel, journal records are whole frames.
+#
+
+class YamlBackup:
+
+    format = 'yaml'
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.logger = logging.getLogger('timebuffer')
+
+    #################################################################
+    # Return (columns, journal), see BinaryBackup.load
+    #
+    def load(self):
+        with open(self.filename, "r") as f:
+            restore_list = yaml.safe_load(f)
+        if type(restore_list) is list:
+            return (([e[0] for e in restore_list], [e[1] for e in restore_list]), [])
+        return (None, [])
+
+    def record(self, ts, value):
+        pass
+
+    def record_crop(self, from_ts=None, to_ts=None):
+        pass
+
+    def record_reset(self):
+        pass
+
+    def take(self):
+        return None
+
+    #################################################################
+    # Write whole buffer, return bytes written
+    #
+    def write(self, storage, batch=None):
+        return atomic_write(self.filename, yaml.dump([[ts, value] for (ts, value) in storage.iter_items(0, len(storage))]))
+
+
+#####################################################################
+# Snapshot layout: header (magic, version, count), count float64 ts,
+# count float64 values. Journal: (ts, value) float64 pairs, where
+# ts = CROP_FROM/CROP_TO records a crop of samples before/after value.
+# Expiry by age is not journaled, it is redone after restore.
+#
+SNAPSHOT_MAGIC = b'TSB1'
+SNAPSHOT_HEADER = struct.Struct('<4sIQ')
+JOURNAL_RECORD = struct.Struct('<dd')
+JOURNAL_COMPACT_MIN = 1024
+CROP_FROM = float('-inf')
+CROP_TO = float('inf')
+
+class BinaryBackup:
+
+    format = 'binary'
+
+    def __init__(self, filename, migrate_from=None):
+        self.filename = filename
+        self.journal_filename = filename + '.journal'
+        if migrate_from is None:
+            migrate_from = os.path.splitext(filename)[0] + '.yaml'
+        self.migrate_from = migrate_from
+        self.logger = logging.getLogger('timebuffer')
+        self.pending = deque()          # Inserts not yet in the journal
+        self.reset = False              # Content replaced, snapshot on next write
+        self.snapshot_count = 0
+        self.journal_count = 0
+
+    #################################################################
+    # Return (columns, journal) where columns is (ts, values) or None
+    # and journal is a list of (ts, value) to replay on top
+    #
+    def load(self):
+        if not os.path.exists(self.filename) and self.migrate_from is not None and os.path.exists(self.migrate_from):
+            return self.migrate()
+
+        columns = self.load_snapshot()
+        journal = self.load_journal()
+        self.snapshot_count = len(columns[0]) if columns is not None else 0
+        self.journal_count = len(journal)
+        return (columns, journal)
+
+    def load_snapshot(self):
+        if not os.path.exists(self.filename):
+            return None
+
+        with open(self.filename, 'rb') as f:
+            if os.fstat(f.fileno()).st_size < SNAPSHOT_HEADER.size:
+                return None
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                (magic, version, count) = SNAPSHOT_HEADER.unpack_from(m, 0)
+                if magic != SNAPSHOT_MAGIC or version != 1:
+                    raise ValueError('Not a buffer snapshot: {}'.format(self.filename))
+
+                body = memoryview(m)[SNAPSHOT_HEADER.size:SNAPSHOT_HEADER.size + 16*count]
+                ts = array('d')
+                values = array('d')
+                ts.frombytes(body[:8*count])
+                values.frombytes(body[8*count:])
+                body.release()
+
+        return (ts, values)
+
+    def load_journal(self):
+        if not os.path.exists(self.journal_filename):
+            return []
+
+        with open(self.journal_filename, 'rb') as f:
+            data = f.read()
+
+        # A torn last record (crash while appending) is ignored
+        usable = len(data) - len(data) % JOURNAL_RECORD.size
+        return list(JOURNAL_RECORD.iter_unpack(data[:usable]))
+
+    #################################################################
+    # One-shot migration from a YAML backup. The YAML file is renamed
+    # to <name>.migrated once the snapshot is written.
+    #
+    def migrate(self):
+        (columns, journal) = YamlBackup(self.migrate_from).load()
+        if columns is None:
+            columns = ([], [])
+        columns = (array('d', columns[0]), array('d', columns[1]))
+        self.write_snapshot(columns)
+        os.replace(self.migrate_from, self.migrate_from + '.migrated')
+        self.logger.info('Migrated buffer backup {} to {} ({} samples)'.format(self.migrate_from, self.filename, len(columns[0])))
+        return (columns, [])
+
+    #################################################################
+    # Remember insert for the next journal append
+    #
+    def record(self, ts, value):
+        self.pending.append((ts, value))
+
+    def record_crop(self, from_ts=None, to_ts=None):
+        if from_ts is not None:
+            self.pending.append((CROP_FROM, from_ts))
+        if to_ts is not None:
+            self.pending.append((CROP_TO, to_ts))
+
+    def record_reset(self):
+        self.reset = True
+
+    #################################################################
+    # Take the records since the last write as a batch for write().
+    # TimeBuffer takes it together with the storage snapshot, so the
+    # batch matches the storage written.
+    #
+    def take(self):
+        records = []
+        while len(self.pending) > 0:
+            records.append(self.pending.popleft())
+        (reset, self.reset) = (self.reset, False)
+        return (records, reset)
+
+    #################################################################
+    # Append pending inserts to the journal, or compact into a new
+    # snapshot when the journal has grown large. Return bytes written.
+    #
+    def write(self, storage, batch=None):
+        (records, reset) = batch if batch is not None else self.take()
+
+        if reset or self.journal_count + len(records) > max(JOURNAL_COMPACT_MIN, self.snapshot_count/4):
+            try:
+                return self.compact(storage)
+            except Exception:
+                self.reset = True
+                raise
+
+        data = b''.join(JOURNAL_RECORD.pack(ts, value) for (ts, value) in records)
+        try:
+            with open(self.journal_filename, 'ab') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+        except Exception:
+            # Keep the records for the next attempt
+            self.pending.extendleft(reversed(records))
+            raise
+        self.journal_count += len(records)
+        return len(data)
+
+    #################################################################
+    # Write snapshot of the whole buffer and truncate the journal. A
+    # crash in between only replays inserts that are already included.
+    #
+    def compact(self, storage):
+        nbytes = self.write_snapshot(storage.columns())
+        atomic_write(self.journal_filename, b'')
+        self.journal_count = 0
+        return nbytes
+
+    def write_snapshot(self, columns):
+        (ts, values) = columns
+        data = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, 1, len(ts)) + ts.tobytes() + values.tobytes()
+        self.snapshot_count = len(ts)
+        return atomic_write(self.filename, data)
+
+
+#####################################################################
+# Directory <filename> with one snapshot per partition, named by the
+# partition number (ts//span). Any storage backend can be written; the
+# partitions to rewrite are tracked from the recorded inserts.
+#
+class PartitionedBackup:
+
+    format = 'partitioned'
+
+    def __init__(self, filename, span=3600):
+        self.filename = filename
+        self.span = span
+        self.logger = logging.getLogger('timebuffer')
+        self.dirty = set()              # Partition numbers to rewrite
+        self.reset = True               # Rewrite all (first write, crop, reset)
+
+    def partition_filename(self, key):
+        return os.path.join(self.filename, '{}.tsp'.format(int(key)))
+
+    def stored_keys(self):
+        if not os.path.isdir(self.filename):
+            return []
+        return sorted(int(f[:-4]) for f in os.listdir(self.filename) if f.endswith('.tsp') and f[:-4].lstrip('-').isdigit())
+
+    #################################################################
+    # Return (columns, journal), see BinaryBackup.load
+    #
+    def load(self):
+        keys = self.stored_keys()
+        if len(keys) == 0:
+            return (None, [])
+
+        ts = array('d')
+        values = array('d')
+        for key in keys:
+            with open(self.partition_filename(key), 'rb') as f:
+                data = f.read()
+            (magic, version, count) = SNAPSHOT_HEADER.unpack_from(data, 0)
+            if magic != SNAPSHOT_MAGIC or version != 1:
+                raise ValueError('Not a buffer partition: {}'.format(self.partition_filename(key)))
+            body = data[SNAPSHOT_HEADER.size:SNAPSHOT_HEADER.size + 16*count]
+            ts.frombytes(body[:8*count])
+            values.frombytes(body[8*count:])
+        self.reset = False
+        return ((ts, values), [])
+
+    def record(self, ts, value):
+        self.dirty.add(int(ts//self.span))
+
+    def record_crop(self, from_ts=None, to_ts=None):
+        self.reset = True
+
+    def record_reset(self):
+        self.reset = True
+
+    #################################################################
+    # Take the partitions touched since the last write, see
+    # BinaryBackup.take
+    #
+    def take(self):
+        (dirty, self.dirty) = (self.dirty, set())
+        (reset, self.reset) = (self.reset, False)
+        return (dirty, reset)
+
+    #################################################################
+    # Rewrite dirty partitions, delete expired and emptied ones. Return
+    # bytes written
+    #
+    def write(self, storage, batch=None):
+        (dirty, reset) = batch if batch is not None else self.take()
+        if len(storage) > 0:
+            live = set(range(int(storage.ts_at(0)//self.span), int(storage.ts_at(len(storage)-1)//self.span) + 1))
+        else:
+            live = set()
+
+        stored = set(self.stored_keys())
+        if reset:
+            dirty = live | stored
+        else:
+            dirty = dirty | (stored - live)
+
+        os.makedirs(self.filename, exist_ok=True)
+        nbytes = 0
+        try:
+            for key in sorted(dirty):
+                from_idx = storage.bisect_left(key*self.span)
+                to_idx = storage.bisect_left((key+1)*self.span)
+                if to_idx <= from_idx or key not in live:
+                    if key in stored:
+                        os.remove(self.partition_filename(key))
+                    dirty.discard(key)
+                    continue
+                ts = array('d')
+                values = array('d')
+                for (t, v) in storage.iter_items(from_idx, to_idx):
+                    ts.append(t)
+                    values.append(v)
+                data = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, 1, len(ts)) + ts.tobytes() + values.tobytes()
+                nbytes += atomic_write(self.partition_filename(key), data)
+                dirty.discard(key)
+        except Exception:
+            # Retry the rest on the next write
+            self.dirty |= dirty
+            raise
+        return nbytes
+
+
+#####################################################################
+# Snapshot layout: header (magic, version, count, channel count),
+# channel names (length prefixed UTF-8), count float64 ts, then count
+# float64 values per channel (NaN where a frame has no value). Journal:
+# frames as float64 ts followed by one float64 per channel. Channels
+# are matched by name on load, so channels can be added or removed.
+#
+FRAME_MAGIC = b'TSF1'
+FRAME_HEADER = struct.Struct('<4sIQI')
+FRAME_NAME = struct.Struct('<H')
+NAN = float('nan')
+
+class FrameBackup(BinaryBackup):
+
+    def __init__(self, filename, channels):
+        BinaryBackup.__init__(self, filename)
+        self.channels = list(channels)
+        self.journal_record = struct.Struct('<d' + 'd'*len(self.channels))
+        self.stored_channels = self.channels    # Channels of the files on disk
+
+    #################################################################
+    # Return (columns, journal) where columns is (ts, {channel: values})
+    # or None and journal is a list of (ts, {channel: value}) frames
+    #
+    def load(self):
+        columns = self.load_snapshot()
+        journal = self.load_journal()
+        self.snapshot_count = len(columns[0]) if columns is not None else 0
+        self.journal_count = len(journal)
+        return (columns, journal)
+
+    def load_snapshot(self):
+        if not os.path.exists(self.filename):
+            return None
+
+        with open(self.filename, 'rb') as f:
+            data = f.read()
+        if len(data) < FRAME_HEADER.size:
+            return None
+        (magic, version, count, n) = FRAME_HEADER.unpack_from(data, 0)
+        if magic != FRAME_MAGIC or version != 1:
+            raise ValueError('Not a frame buffer snapshot: {}'.format(self.filename))
+
+        pos = FRAME_HEADER.size
+        names = []
+        for i in range(n):
+            (length,) = FRAME_NAME.unpack_from(data, pos)
+            pos += FRAME_NAME.size
+            names.append(data[pos:pos+length].decode('utf-8'))
+            pos += length
+
+        self.stored_channels = names
+        if names != self.channels:
+            self.reset = True
+
+        ts = array('d')
+        ts.frombytes(data[pos:pos+8*count])
+        pos += 8*count
+        stored = {}
+        for name in names:
+            stored[name] = array('d')
+            stored[name].frombytes(data[pos:pos+8*count])
+            pos += 8*count
+        return (ts, {c: stored.get(c, array('d', [NAN])*count) for c in self.channels})
+
+    #################################################################
+    # Journal frames are laid out like the snapshot's channels, which
+    # is written before the first journal record. Changed channels are
+    # written as a new snapshot on the next write.
+    #
+    def load_journal(self):
+        if not os.path.exists(self.journal_filename):
+            return []
+
+        with open(self.journal_filename, 'rb') as f:
+            data = f.read()
+
+        # A torn last record (crash while appending) is ignored
+        record = struct.Struct('<d' + 'd'*len(self.stored_channels))
+        usable = len(data) - len(data) % record.size
+        return [(r[0], dict(zip(self.stored_channels, r[1:]))) for r in record.iter_unpack(data[:usable])]
+
+    def record(self, ts, values):
+        self.pending.append((ts, values))
+
+    def record_crop(self, from_ts=None, to_ts=None):
+        self.reset = True
+
+    def write(self, storage, batch=None):
+        (records, reset) = batch if batch is not None else self.take()
+
+        if reset or not os.path.exists(self.filename) or self.journal_count + len(records) > max(JOURNAL_COMPACT_MIN, self.snapshot_count/4):
+            try:
+                return self.compact(storage)
+            except Exception:
+                self.reset = True
+                raise
+
+        record = self.journal_record
+        data = b''.join(record.pack(ts, *(values.get(c, NAN) for c in self.channels)) for (ts, values) in records)
+        try:
+            with open(self.journal_filename, 'ab') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+        except Exception:
+            self.pending.extendleft(reversed(records))
+            raise
+        self.journal_count += len(records)
+        return len(data)
+
+    def write_snapshot(self, columns):
+        (ts, values) = columns
+        self.stored_channels = self.channels
+        names = b''.join(FRAME_NAME.pack(len(c.encode('utf-8'))) + c.encode('utf-8') for c in self.channels)
+        data = FRAME_HEADER.pack(FRAME_MAGIC, 1, len(ts), len(self.channels)) + names + ts.tobytes() + b''.join(values[c].tobytes() for c in self.channels)
+        self.snapshot_count = len(ts)
+        return atomic_write(self.filename, data)
+
+
+BACKUP_FORMATS = {
+    YamlBackup.format: YamlBackup,
+    BinaryBackup.format: BinaryBackup,
+    PartitionedBackup.format: PartitionedBackup,
+}
+
+#####################################################################
+# Create backup by format name ('yaml', 'binary' or 'partitioned')
+#
+def create_backup(format, filename, **kwargs):
+    try:
+        return BACKUP_FORMATS[format](filename, **kwargs)
+    except KeyError:
+        raise ValueError('Unknown TimeBuffer backup format: {}'.format(format))
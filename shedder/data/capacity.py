@@ -0,0 +1,207 @@
+import copy
+import logging
+import threading
+from bisect import bisect_right
+from operator import itemgetter
+import yaml
+from .persistence import atomic_write, default_worker
+from .clock import default_clock
+
+#####################################################################
+# Capacity tariff tracker
+#
+# Keeps the per-day max/min entries of an accumulated energy buffer
+# (what get_period_max_list/get_period_min_list return per day) in a
+# table keyed by month start. Inserts only mark the affected days dirty
+# and those are recomputed from the buffer on the next query, so a
+# monthly query is O(days). Months are frozen once FREEZE_DELAY has
+# passed after their last day; frozen months are never recomputed and
+# survive the samples ageing out of the buffer.
+#
+# The day grid matches get_period_max_list: calendar.month_bounds(ts)
+# gives (month_start, month_end) and the days are the local calendar
+# days from month_start (calendar.day_grid), 23 or 25 hours long across
+# DST changes.
+#
+# Each month has a revision, bumped when a recomputed day came out
+# different, so results derived from the table can be cached on it.
+#
+# on_insert() is called from the writer thread, queries from another one:
+# the table is guarded by self.lock and days are recomputed from a buffer
+# snapshot without holding it.
+#
+FREEZE_DELAY = 3600
+
+class CapacityTracker:
+
+    def __init__(self, buffer, calendar, backup_filename=None, backup_interval=60, persistence=None):
+        self.buffer = buffer
+        self.calendar = calendar
+        self.backup_filename = backup_filename
+        self.backup_interval = backup_interval
+        self.persistence = persistence
+        self.logger = logging.getLogger('timebuffer')
+        self.months = {}            # month_start -> {'frozen', 'max', 'min'}
+        self.dirty = set()          # (month_start, day) to recompute
+        self.revisions = {}         # month_start -> revision
+        self.lock = threading.RLock()
+        if backup_filename is not None:
+            self.restore()
+
+    #################################################################
+    # Day grid of month holding ts: (month start, [day starts..., end])
+    #
+    def grid(self, ts):
+        (month_start, month_end) = self.calendar.month_bounds(ts)
+        return (month_start, self.calendar.day_grid(month_start, month_end))
+
+    #################################################################
+    # Get (or create) month table. A new month has all days dirty
+    #
+    def month(self, month_start, grid):
+        m = self.months.get(month_start)
+        if m is None:
+            days = len(grid) - 1
+            m = {'frozen': False, 'max': [None]*days, 'min': [None]*days}
+            self.months[month_start] = m
+            self.dirty.update((month_start, d) for d in range(days))
+        return m
+
+    #################################################################
+    # Mark the days holding ts dirty, in its own month and, for ts at
+    # the month start, in the last day of the previous month (day
+    # queries include both ends)
+    #
+    def mark(self, ts):
+        (month_start, grid) = self.grid(ts)
+        self.mark_day(month_start, bisect_right(grid, ts) - 1)
+
+        (prev_start, prev_grid) = self.grid(month_start - 3600)
+        if ts <= prev_grid[-1]:
+            self.mark_day(prev_start, len(prev_grid) - 2)
+
+    def mark_day(self, month_start, day):
+        if not self.months.get(month_start, {}).get('frozen'):
+            self.dirty.add((month_start, day))
+
+    #################################################################
+    # Called after a sample was inserted into the buffer. The delta to
+    # the previous sample changed as well, so its day is marked too.
+    #
+    def on_insert(self, ts):
+        idx = self.buffer.get_index(ts)
+        with self.lock:
+            if idx > 0:
+                self.mark(self.buffer.storage.ts_at(idx-1))
+            self.mark(ts)
+
+    #################################################################
+    # Called after a batch was inserted (TimeBuffer.insert_many). Days
+    # never split an hour, so marking the first sample of each hour
+    # touched and its predecessor is enough.
+    #
+    def on_insert_many(self, timestamps):
+        hours = {}
+        for ts in timestamps:
+            h = ts//3600
+            if h not in hours or ts < hours[h]:
+                hours[h] = ts
+
+        with self.lock:
+            for ts in hours.values():
+                self.mark(ts)
+                idx = self.buffer.get_index(ts)
+                if idx > 0:
+                    self.mark(self.buffer.storage.ts_at(idx-1))
+
+    #################################################################
+    # Recompute dirty days of month
+    #
+    def refresh(self, month_start, grid):
+        with self.lock:
+            m = self.month(month_start, grid)
+            if m['frozen']:
+                return m
+            dirty = [d for d in range(len(grid) - 1) if (month_start, d) in self.dirty]
+            self.dirty.difference_update((month_start, d) for d in dirty)
+
+        # Days marked again meanwhile stay dirty for the next refresh
+        buffer = self.buffer.snapshot()
+        results = []
+        for d in dirty:
+            (f, t) = (grid[d], grid[d+1])
+            results.append((d, buffer.get_max(f, t), buffer.get_min(f, t)))
+
+        with self.lock:
+            for (d, vmax, vmin) in results:
+                if m['max'][d] != vmax or m['min'][d] != vmin:
+                    self.revisions[month_start] = self.revisions.get(month_start, 0) + 1
+                m['max'][d] = vmax
+                m['min'][d] = vmin
+            changed = len(results) > 0
+
+            if default_clock().time() > grid[-1] + FREEZE_DELAY:
+                m['frozen'] = True
+                changed = True
+
+        if changed:
+            self.save()
+        return m
+
+    #################################################################
+    # Revision of the month holding ts, after recomputing its dirty days
+    #
+    def revision(self, ts):
+        (month_start, grid) = self.grid(ts)
+        self.refresh(month_start, grid)
+        with self.lock:
+            return self.revisions.get(month_start, 0)
+
+    #################################################################
+    # True if the month starting at month_start is frozen
+    #
+    def frozen(self, month_start):
+        with self.lock:
+            return self.months.get(month_start, {}).get('frozen', False)
+
+    #################################################################
+    # Daily max and min lists of the month holding ts, sorted like
+    # get_period_max_list/get_period_min_list. Entries are copies.
+    #
+    def period_lists(self, ts):
+        (month_start, grid) = self.grid(ts)
+        m = self.refresh(month_start, grid)
+
+        with self.lock:
+            max_values = [[e[0], e[1]] for e in m['max'] if e is not None]
+            min_values = [[e[0], e[1]] for e in m['min'] if e is not None]
+        return (sorted(max_values, key=itemgetter(1), reverse=True), sorted(min_values, key=itemgetter(1), reverse=False))
+
+    #################################################################
+    # Persistence, written behind by the persistence worker
+    #
+    def save(self):
+        if self.backup_filename is not None:
+            if self.persistence is None:
+                self.persistence = default_worker()
+            self.persistence.mark_dirty(self)
+
+    def flush(self):
+        with self.lock:
+            months = copy.deepcopy(self.months)
+        return atomic_write(self.backup_filename, yaml.dump(months))
+
+    #################################################################
+    # Restore table. Open months are recomputed from the buffer since
+    # it may hold samples newer than the table.
+    #
+    def restore(self):
+        try:
+            with open(self.backup_filename, "r") as f:
+                months = yaml.safe_load(f)
+            if type(months) is dict:
+                self.months = {k: v for (k, v) in months.items() if v.get('frozen')}
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            self.logger.warning('Could not read capacity table {}: {}'.format(self.backup_filename, e))
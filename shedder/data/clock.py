@@ -0,0 +1,62 @@
+import time
+import datetime
+
+#####################################################################
+# Clock
+#
+# Buffers, calculators and the control loop take the current time from
+# default_clock() instead of time.time(), so a replay of recorded
+# measurements (see replay.py) can run them on recorded time.
+# SystemClock is the wall clock. ReplayClock only moves when told to:
+# advance_to() follows the recording, sleep() returns at once and moves
+# the clock instead.
+#
+class SystemClock:
+
+    def time(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    #################################################################
+    # Local wall time as naive datetime, like datetime.datetime.now()
+    #
+    def now(self):
+        return datetime.datetime.now()
+
+
+class ReplayClock:
+
+    def __init__(self, start=0.0):
+        self.ts = start
+
+    def time(self):
+        return self.ts
+
+    def sleep(self, seconds):
+        self.ts += seconds
+
+    def now(self):
+        return datetime.datetime.fromtimestamp(self.ts)
+
+    #################################################################
+    # Move to ts, never backwards
+    #
+    def advance_to(self, ts):
+        if ts > self.ts:
+            self.ts = ts
+
+
+_default_clock = SystemClock()
+
+#####################################################################
+# Clock used by everything unless one is given explicitly. Set before
+# any buffers are created.
+#
+def default_clock():
+    return _default_clock
+
+def set_default_clock(clock):
+    global _default_clock
+    _default_clock = clock
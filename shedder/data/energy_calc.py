@@ -1,7 +1,14 @@
 import time
-import datetime
 from pathlib import Path
 from .float_tb import FloatTimeBuffer
+from .capacity import CapacityTracker
+from .rollup import RollupTier, TieredBuffer
+from .aggregates import RollingMean, PeriodIntegral
+from .local_calendar import default_calendar
+from .status_cache import StatusCache
+from .quantiles import DailyQuantiles
+from .sqlite_store import SqliteBuffer, LongTermBuffer
+from .clock import default_clock
 
 #####################################################################
 # Returns (start, end) of month as timestamps
@@ -9,141 +16,342 @@ from .float_tb import FloatTimeBuffer
 def epoch_to_month_ts(ts=None):
 
     if ts is None:
-        ts = int(time.time())
+        ts = int(default_clock().time())
     else:
         ts = int(ts)
 
-    local_zone = datetime.datetime.now().astimezone().tzinfo
-
-    from_date = datetime.datetime.fromtimestamp(ts, local_zone).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-    to_date = (from_date + datetime.timedelta(days=32)).replace(day=1)
-
-    return (int(from_date.timestamp()), int(to_date.timestamp()))
+    return default_calendar().month_bounds(ts)
 
 # #########################################################################
 # Returns iso time to local time zone from epoch time (ms)
 #
 def ts2iso(ts):
-    local_zone = datetime.datetime.now().astimezone().tzinfo
-    ts_iso = datetime.datetime.fromtimestamp(ts, local_zone).isoformat()
-    return ts_iso
+    return default_calendar().iso(ts)
 
 # #########################################################################
 # Returns YYYY.MM.DD time to local time zone from epoch time
 #
 def ts2ymd(ts):
-    local_zone = datetime.datetime.now().astimezone().tzinfo
-    ts_ymd = datetime.datetime.fromtimestamp(ts, local_zone).strftime('%Y.%m.%d')
-    return ts_ymd
+    return default_calendar().ymd(ts)
 
 # #########################################################################
 # Returns HH:MM:SS time to local time zone from epoch time 
 #
 def ts2hms(ts):
-    local_zone = datetime.datetime.now().astimezone().tzinfo
-    ts_hms = datetime.datetime.fromtimestamp(ts, local_zone).strftime('%H:%M:%S')
-    return ts_hms
+    return default_calendar().hms(ts)
+
+#####################################################################
+# Backup (format, filename) of buffer name in log_dir. 'partitioned'
+# buffers are backed up per partition into a directory, so a write only
+# touches the partitions changed since the last one.
+#
+def buffer_backup(log_dir, name, storage):
+    if storage == 'partitioned':
+        return ('partitioned', str(Path(log_dir) / f'{name}.parts'))
+    return ('binary', str(Path(log_dir) / f'{name}.tsb'))
 
 #####################################################################
 # Returns (start, end) of month as timestamps
 #
 class EnergyCalculator():
-    def __init__(self, log_dir='.', postfix=''):
-        self.power_buffer = FloatTimeBuffer(age=7*3600, backup_filename=str(Path(log_dir) / f'power_buffer{postfix}.yaml'))
-        self.energy_buffer = FloatTimeBuffer(age=24*3600*32, backup_filename=str(Path(log_dir) / f'energy_buffer{postfix}.yaml'), accumulated=True)
+    def __init__(self, log_dir='.', postfix='', backup_interval=60, persistence=None, power_storage='columns', energy_storage='gorilla', energy_days=32, power_buffer=None, energy_buffer=None, long_term_db=None):
+        # Buffers may be given as channels of a FrameBuffer (see
+        # frame_buffer.py), those are written and backed up there
+        self.power_buffer = power_buffer
+        if self.power_buffer is None:
+            (backup_format, backup_filename) = buffer_backup(log_dir, f'power_buffer{postfix}', power_storage)
+            self.power_buffer = FloatTimeBuffer(
+                age=7*3600,
+                backup_filename=backup_filename,
+                backup_format=backup_format,
+                storage=power_storage,
+                backup_interval=backup_interval,
+                persistence=persistence)
+        self.power_buffer.register_aggregate('avg_1m', RollingMean, 60)
+        self.power_buffer.register_aggregate('avg_5m', RollingMean, 300)
+        self.energy_buffer = energy_buffer
+        if self.energy_buffer is None:
+            (backup_format, backup_filename) = buffer_backup(log_dir, f'energy_buffer{postfix}', energy_storage)
+            self.energy_buffer = FloatTimeBuffer(
+                age=24*3600*energy_days,
+                backup_filename=backup_filename,
+                backup_format=backup_format,
+                storage=energy_storage,
+                accumulated=True,
+                backup_interval=backup_interval,
+                persistence=persistence)
+
+        # Energy readings expiring from energy_buffer are kept for good in
+        # long_term_db (SQLite), if given
+        self.energy_history = None
+        if long_term_db is not None:
+            self.energy_history = LongTermBuffer(
+                self.energy_buffer,
+                SqliteBuffer(
+                    str(Path(log_dir) / long_term_db),
+                    series=f'energy{postfix}',
+                    accumulated=True,
+                    backup_interval=backup_interval,
+                    persistence=persistence))
+
+        # Power older than the raw buffer is kept as per-minute rollups
+        # for a week and per-hour rollups for a bit over a year
+        self.power_hours = RollupTier(
+            resolution=3600,
+            age=400*24*3600,
+            backup_filename=str(Path(log_dir) / f'power_hours{postfix}.trl'),
+            backup_interval=backup_interval,
+            persistence=persistence)
+        self.power_minutes = RollupTier(
+            resolution=60,
+            age=7*24*3600,
+            next_tier=self.power_hours,
+            backup_filename=str(Path(log_dir) / f'power_minutes{postfix}.trl'),
+            backup_interval=backup_interval,
+            persistence=persistence)
+        self.power_history = TieredBuffer(self.power_buffer, [self.power_minutes, self.power_hours])
+
+        # Power percentiles and load-duration curves per day
+        self.quantiles = DailyQuantiles(
+            self.power_buffer,
+            calendar=default_calendar(),
+            backup_filename=str(Path(log_dir) / f'quantiles{postfix}.tqd'),
+            backup_interval=backup_interval,
+            persistence=persistence)
+
+        self.status_cache = StatusCache()
+        self.period_texts = (None, None)    # ((ts_from, duration), texts) of period_status
+
+        # Per-day max/min hourly energy for monthly_status (capacity tariff)
+        self.capacity = CapacityTracker(
+            self.energy_buffer,
+            calendar=default_calendar(),
+            backup_filename=str(Path(log_dir) / f'capacity{postfix}.yaml'),
+            backup_interval=backup_interval,
+            persistence=persistence)
+
+        # Called with the timestamps of inserted energy samples (e.g. by
+        # the site capacity table, see site.py)
+        self.energy_hooks = []
 
     def insert_power(self, ts, value):
         self.power_buffer.insert_sorted(ts=ts, value=value)
 
     def insert_energy(self, ts, value):
         self.energy_buffer.insert_sorted(ts=ts, value=value)
+        self.capacity.on_insert(ts)
+        for hook in self.energy_hooks:
+            hook([ts])
 
+    #################################################################
+    # Energy (kWh), average, max and min power over [ts_from, ts_to)
+    # from the finest retention tier covering each part of the range
+    #
+    def history_status(self, ts_from, ts_to):
+        key = ('history', ts_from, ts_to, self.power_buffer.version)
+        return self.status_cache.get(key, lambda: self.compute_history_status(ts_from, ts_to))
+
+    def compute_history_status(self, ts_from, ts_to):
+        return {
+            'ts_from': ts_from,
+            'ts_to': ts_to,
+            'energy': self.power_history.integrate(ts_from, ts_to)/3600,
+            'power_avg': self.power_history.avg(ts_from, ts_to),
+            'power_max': self.power_history.get_max(ts_from, ts_to),
+            'power_min': self.power_history.get_min(ts_from, ts_to),
+        }
+
+    #################################################################
+    # Bulk ingest for backfill and replay: ts column with power and/or
+    # energy columns of the same length. None entries are skipped.
+    #
+    def insert_columns(self, ts, power=None, energy=None):
+        if power is not None:
+            self.power_buffer.insert_many((t, v) for (t, v) in zip(ts, power) if v is not None)
+        if energy is not None:
+            samples = [(t, v) for (t, v) in zip(ts, energy) if v is not None]
+            if len(samples) > 0:
+                self.energy_buffer.insert_many(samples)
+                self.energy_inserted([t for (t, v) in samples])
+
+    #################################################################
+    # Power samples at timestamps arrived late (behind the reorder
+    # window). A sample holds until the next one, so the cached totals
+    # of the closed previous hours after the earliest one are dropped.
+    #
+    def power_late(self, timestamps):
+        ts = min(timestamps)
+        self.status_cache.discard(lambda key: key[0] == 'prev_hour' and key[1] > ts)
+
+    #################################################################
+    # Energy samples at timestamps were inserted into the energy buffer
+    # directly (e.g. as frames of its FrameBuffer)
+    #
+    def energy_inserted(self, timestamps):
+        self.capacity.on_insert_many(timestamps)
+        for hook in self.energy_hooks:
+            hook(timestamps)
+
+    #################################################################
+    # Top three daily max/min hourly energies of this and the previous
+    # month. Cached per revision of the capacity table, which changes
+    # only when a day's max or min does; frozen months keep theirs.
+    #
     def monthly_status(self, ts=None):
         if ts is None:
-            ts = int(time.time())
+            ts = int(default_clock().time())
         else:
             ts = int(ts)
 
         (ts_from, ts_to) = epoch_to_month_ts(ts)
-        this_month_max = self.energy_buffer.get_period_max_list(ts_from, ts_to, duration=3600*24)[:3]
-        this_month_min = self.energy_buffer.get_period_min_list(ts_from, ts_to, duration=3600*24)[:3]
+        (prev_from, prev_to) = epoch_to_month_ts(ts_from-3600)
 
-        (ts_from, ts_to) = epoch_to_month_ts(ts_from-3600)
-        prev_month_max = self.energy_buffer.get_period_max_list(ts_from, ts_to, duration=3600*24)[:3]
-        prev_month_min = self.energy_buffer.get_period_min_list(ts_from, ts_to, duration=3600*24)[:3]
+        this_key = ('month', ts_from, self.capacity.revision(ts_from))
+        this_month = self.status_cache.get(this_key, lambda: self.month_status(ts_from))
+        prev_key = ('month', prev_from, self.capacity.revision(prev_from))
+        prev_month = self.status_cache.get(prev_key, lambda: self.month_status(prev_from))
 
-        # Normalize and add human readable timestamp
-        for l in [this_month_max, this_month_min, prev_month_max, prev_month_min]:
-            for e in l:
-                e[0] = ts2ymd(e[0]) + ' ' + ts2hms(e[0])
-                e[1] = int(e[1] * 1000)
+        return {
+            'this_month': this_month,
+            'prev_month': prev_month
+        }
 
-        if len(this_month_max) > 0:
-            this_avg = int(sum(e[1] for e in this_month_max) / len(this_month_max))
+    #################################################################
+    # Power percentiles (P50/P95/P99) and load-duration curve of today,
+    # this and the previous month. Recomputed once a minute.
+    #
+    def load_status(self, ts=None):
+        if ts is None:
+            ts = int(default_clock().time())
         else:
-            this_avg = 0
+            ts = int(ts)
+
+        key = ('load', ts//60, int(default_clock().time())//60)
+        return self.status_cache.get(key, lambda: self.compute_load_status(ts))
+
+    def compute_load_status(self, ts):
+        (ts_from, ts_to) = epoch_to_month_ts(ts)
+        return {
+            'today': self.quantiles.day_status(ts),
+            'this_month': self.quantiles.month_status(ts),
+            'prev_month': self.quantiles.month_status(ts_from-3600)
+        }
+
+    def month_status(self, ts):
+        return self.format_month(*self.capacity.period_lists(ts))
+
+    #################################################################
+    # Month status of any month still in the long-term store (e.g. for
+    # tariff disputes), None without one
+    #
+    def archived_month_status(self, ts):
+        if self.energy_history is None:
+            return None
+        (ts_from, ts_to) = epoch_to_month_ts(ts)
+        return self.format_month(
+            self.energy_history.get_period_max_list(ts_from, ts_to),
+            self.energy_history.get_period_min_list(ts_from, ts_to))
+
+    def format_month(self, month_max, month_min):
+        month_max = month_max[:3]
+        month_min = month_min[:3]
+
+        # Normalize and add human readable timestamp
+        for l in [month_max, month_min]:
+            for (e, text) in zip(l, default_calendar().ymd_hms_many([e[0] for e in l])):
+                e[0] = text
+                e[1] = int(e[1] * 1000)
 
-        if len(prev_month_max) > 0:
-            prev_avg = int(sum(e[1] for e in prev_month_max) / len(prev_month_max))
+        if len(month_max) > 0:
+            avg = int(sum(e[1] for e in month_max) / len(month_max))
         else:
-            prev_avg = 0
+            avg = 0
 
         return {
-            'this_month': {
-                'max_values': this_month_max,
-                'min_values': this_month_min,
-                'max3_avg': this_avg
-            },
-            'prev_month': {
-                'max_values': prev_month_max,
-                'min_values': prev_month_min,
-                'max3_avg': prev_avg
-            }
+            'max_values': month_max,
+            'min_values': month_min,
+            'max3_avg': avg
         }
 
+    #################################################################
+    # Energy and power status of the period holding ts. Not cached: it
+    # depends on the wall clock (offline detection) and is asked for
+    # once per control loop, while the buffers change in between. The
+    # closed previous period is cached.
+    #
     def period_status(self, max_energy, ts=None, duration=3600, max_offline_time=600):
+        now = int(default_clock().time())
         if ts is None:
-            ts = int(time.time())
+            ts = now
         else:
             ts = int(ts)
 
+        # Running integrals of this and the previous period
+        period_name = 'period_{}'.format(duration)
+        if period_name not in self.power_buffer.aggregates:
+            self.power_buffer.register_aggregate(period_name, PeriodIntegral, duration)
+
+        # Queries run on snapshots, the buffers are written from the
+        # MQTT thread
+        power_buffer = self.power_buffer.snapshot()
+        energy_buffer = self.energy_buffer.snapshot()
+
         ts_from = duration*int(ts/duration)
         ts_to = ts_from + duration
-        energy = self.power_buffer.integrate(ts_from=ts_from, ts_to=ts)/3600
+        energy = (power_buffer.aggregate(period_name, ts) or (0, 0))[0]/3600
         remaining_time = max(ts_to - ts, 1)     # Minimmum value 1 to avoid /0
 
-        last_power = self.power_buffer.get_last_tuple()
+        last_power = power_buffer.get_last_tuple()
         if last_power is None:
             metering_offline = True
         else:
-            metering_offline = int(time.time()) - last_power[0] > max_offline_time
+            metering_offline = now - last_power[0] > max_offline_time
 
         # Set emulated power-usage to max if power-reading is offline/missing to avoid over-usage 
         if metering_offline:
             if last_power is None or last_power[1] < max_energy*3600/duration:
                 self.insert_power(ts=ts-max_offline_time, value=max_energy*3600/duration)
+                power_buffer = self.power_buffer.snapshot()
+                last_power = power_buffer.get_last_tuple()
 
-        power_avg_1m = self.power_buffer.avg(ts_from=ts-60, ts_to=ts)
-        power_avg_5m = self.power_buffer.avg(ts_from=ts-300, ts_to=ts)
+        # Previous period's total is the previous hour for hourly periods.
+        # Closed once no emulated sample can land in it anymore, late
+        # samples drop it (power_late).
+        if duration == 3600:
+            compute = lambda: (power_buffer.aggregate(period_name, ts) or (0, 0))[1]/3600
+        else:
+            compute = lambda: power_buffer.integrate(ts_from=ts_from-3600, ts_to=ts_from)/3600
+        if ts - max_offline_time >= ts_from:
+            prev_key = ('prev_hour', ts_from)
+        else:
+            prev_key = ('prev_hour', ts_from, power_buffer.version)
+        prev_energy = self.status_cache.get(prev_key, compute)
+
+        power_avg_1m = power_buffer.aggregate('avg_1m', ts)
+        power_avg_5m = power_buffer.aggregate('avg_5m', ts)
 
         # Buffers may be empty on first start (no backup file yet) - fall back to ts
-        last_power_tuple = self.power_buffer.get_last_tuple()
-        power_ts = last_power_tuple[0] if last_power_tuple is not None else ts
+        power_ts = last_power[0] if last_power is not None else ts
 
-        last_energy_tuple = self.energy_buffer.get_last_tuple()
+        last_energy_tuple = energy_buffer.get_last_tuple()
         energy_ts = last_energy_tuple[0] if last_energy_tuple is not None else ts
 
+        # Texts of the period, the same for all of its calls
+        if self.period_texts[0] != (ts_from, duration):
+            self.period_texts = ((ts_from, duration), (ts2hms(ts_from), ts2hms(ts_to), time.strftime("%H:%M:%S", time.gmtime(duration))))
+        texts = self.period_texts[1]
+
         ret = {
             'ts_from': ts_from,
             'ts_to': ts_to,
-            'ts_from_text': ts2hms(ts_from),
-            'ts_to_text': ts2hms(ts_to),
+            'ts_from_text': texts[0],
+            'ts_to_text': texts[1],
             'duration': duration,
-            'duration_text': time.strftime("%H:%M:%S", time.gmtime(duration)),
+            'duration_text': texts[2],
             'ts': ts,
-            'power': self.power_buffer.get_value(ts=ts, selection='pre'),
+            'power': power_buffer.get_value(ts=ts, selection='pre'),
             'power_ts': power_ts,
-            'power_ts_text': ts2ymd(power_ts) + ' ' + ts2hms(power_ts),
+            'power_ts_text': default_calendar().ymd_hms(power_ts),
             'power_avg_1m': power_avg_1m,
             'power_avg_5m': power_avg_5m,
             'metering_offline': metering_offline,
@@ -153,11 +361,11 @@ class EnergyCalculator():
             'remaining_time': remaining_time,
             'remaining_max_power': 3600*(max_energy - energy)/remaining_time,
             'estimated_energy': energy + power_avg_1m*remaining_time/3600,
-            'prev_hour_energy': 1000*self.energy_buffer.get_value(ts=int(time.time())) - \
-                1000*self.energy_buffer.get_value(ts=int(time.time()-3600), selection='pre'),
+            'prev_hour_energy': 1000*energy_buffer.get_value(ts=now) - \
+                1000*energy_buffer.get_value(ts=now-3600, selection='pre'),
             'prev_hour_energy_ts': energy_ts,
-            'prev_hour_energy_ts_text': ts2ymd(energy_ts) + ' ' + ts2hms(energy_ts),
-            'prev_hour_energy_int': self.power_buffer.integrate(ts_from=ts_from-3600, ts_to=ts_from)/3600
+            'prev_hour_energy_ts_text': default_calendar().ymd_hms(energy_ts),
+            'prev_hour_energy_int': prev_energy
         }
 
         return ret
@@ -0,0 +1,199 @@
+import bisect
+import logging
+import threading
+from array import array
+from pathlib import Path
+import yaml
+from .persistence import atomic_write
+from .rollup import RollupTier
+from .clock import default_clock
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+#####################################################################
+# Columnar export of buffers and rollup tiers
+#
+# Writes the samples of FloatTimeBuffers (ts, value) and the buckets of
+# RollupTiers (start, min, max, mean, integral, duration) to Parquet or
+# Arrow IPC files, one directory per channel and local day:
+#
+#   <export_dir>/channel=<name>/date=<YYYY-MM-DD>/part-<first ts>.parquet
+#
+# which pandas/pyarrow read as a partitioned dataset. Each run only
+# writes what was added since the previous one: the last exported ts of
+# each channel is kept in _export_state.yaml (skipped by dataset
+# readers). Raw samples younger than settle seconds (still in the
+# reorder window) and rollup buckets that are not closed yet wait for
+# the next run.
+#
+# Needs pyarrow, which is optional for the rest of the package.
+#
+STATE_FILENAME = '_export_state.yaml'
+FORMATS = {'parquet': '.parquet', 'arrow': '.arrow'}
+TIER_COLUMNS = ('start', 'min', 'max', 'mean', 'integral', 'duration')
+
+class ColumnarExporter:
+
+    def __init__(self, export_dir, sources, calendar, format='parquet', settle=60, interval=3600):
+        if pyarrow is None:
+            raise RuntimeError('Columnar export needs pyarrow')
+        if format not in FORMATS:
+            raise ValueError('Unknown export format {}'.format(format))
+        self.export_dir = Path(export_dir)
+        self.sources = sources          # sources() -> {channel: FloatTimeBuffer or RollupTier}
+        self.calendar = calendar
+        self.format = format
+        self.settle = settle
+        self.interval = interval
+        self.logger = logging.getLogger('timebuffer')
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.state = {}                 # channel -> last exported ts
+        self.stats = {'runs': 0, 'files': 0, 'rows': 0, 'bytes_written': 0, 'errors': 0}
+        self.export_dir.mkdir(parents=True, exist_ok=True)
+        self.restore()
+
+    #################################################################
+    # Export everything new of all sources. Returns files written.
+    #
+    def run(self, now=None):
+        with self.lock:
+            files = 0
+            for (channel, source) in sorted(self.sources().items()):
+                try:
+                    files += self.export_source(channel, source, now)
+                except Exception as e:
+                    self.stats['errors'] += 1
+                    self.logger.warning('Could not export {}: {}'.format(channel, e))
+            self.stats['runs'] += 1
+            return files
+
+    def export_source(self, channel, source, now=None):
+        if isinstance(source, RollupTier):
+            (key, columns) = self.tier_columns(source, self.state.get(channel))
+        else:
+            (key, columns) = self.buffer_columns(source, self.state.get(channel), now)
+        if len(columns[key]) == 0:
+            return 0
+
+        files = 0
+        for (day, rows) in self.split_days(columns[key]):
+            self.write_part(channel, day, {k: c[rows.start:rows.stop] for (k, c) in columns.items()})
+            files += 1
+        self.stats['rows'] += len(columns[key])
+        self.state[channel] = columns[key][-1]
+        self.save()
+        return files
+
+    #################################################################
+    # Raw samples after ts last up to now - settle as columns
+    #
+    def buffer_columns(self, buffer, last, now=None):
+        if now is None:
+            now = default_clock().time()
+        storage = buffer.snapshot().storage
+        first = 0
+        if last is not None:
+            first = storage.bisect_left(last)
+            while first < len(storage) and storage.ts_at(first) <= last:
+                first += 1
+        stop = max(first, storage.bisect_left(now - self.settle))
+
+        ts = array('d')
+        values = array('d')
+        for (t, v) in storage.iter_items(first, stop):
+            ts.append(t)
+            values.append(v)
+        return ('ts', {'ts': ts, 'value': values})
+
+    #################################################################
+    # Closed buckets starting after ts last as columns
+    #
+    def tier_columns(self, tier, last):
+        with tier.lock:
+            c = tier.columns
+            starts = c['start']
+            first = 0 if last is None else bisect.bisect_right(starts, last)
+            closed = tier.closed_ts()
+            stop = first if closed is None else bisect.bisect_right(starts, closed - tier.resolution, lo=first)
+            columns = {k: c[k][first:stop] for k in c}
+        columns['mean'] = array('d', (i/d if d > 0 else 0 for (i, d) in zip(columns['integral'], columns['duration'])))
+        return ('start', {k: columns[k] for k in TIER_COLUMNS})
+
+    #################################################################
+    # [(day start, row range)] of sorted timestamps by local day
+    #
+    def split_days(self, ts):
+        parts = []
+        idx = 0
+        while idx < len(ts):
+            (day_from, day_to) = self.calendar.day_bounds(ts[idx])
+            end = bisect.bisect_left(ts, day_to, lo=idx)
+            parts.append((day_from, range(idx, end)))
+            idx = end
+        return parts
+
+    #################################################################
+    # One file of a channel and day, named by its first ts so a run
+    # repeated after a crash overwrites its own files
+    #
+    def write_part(self, channel, day, columns):
+        key = next(iter(columns))
+        directory = self.export_dir / f'channel={channel}' / 'date={}'.format(self.calendar.ymd(day).replace('.', '-'))
+        directory.mkdir(parents=True, exist_ok=True)
+        filename = directory / 'part-{}{}'.format(int(columns[key][0]), FORMATS[self.format])
+
+        table = pyarrow.table({k: pyarrow.array(v, type=pyarrow.float64()) for (k, v) in columns.items()})
+        sink = pyarrow.BufferOutputStream()
+        if self.format == 'parquet':
+            pyarrow.parquet.write_table(table, sink, compression='zstd')
+        else:
+            with pyarrow.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        self.stats['bytes_written'] += atomic_write(str(filename), sink.getvalue().to_pybytes())
+        self.stats['files'] += 1
+
+    #################################################################
+    # Background job, runs every interval seconds until stop()
+    #
+    def start(self):
+        if self.thread is None or not self.thread.is_alive():
+            self.stop_event.clear()
+            self.thread = threading.Thread(target=self.loop, name='export', daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None and self.thread.is_alive():
+            self.thread.join()
+
+    def loop(self):
+        while not self.stop_event.wait(self.interval):
+            files = self.run()
+            self.logger.debug('Exported {} files to {}'.format(files, self.export_dir))
+
+    def metrics(self):
+        return dict(self.stats)
+
+    #################################################################
+    # Last exported ts per channel
+    #
+    def save(self):
+        atomic_write(str(self.export_dir / STATE_FILENAME), yaml.dump({'format': self.format, 'channels': self.state}))
+
+    def restore(self):
+        filename = self.export_dir / STATE_FILENAME
+        if not filename.exists():
+            return
+        try:
+            with open(filename, 'r') as f:
+                state = yaml.safe_load(f) or {}
+            self.state = {str(k): float(v) for (k, v) in (state.get('channels') or {}).items()}
+        except Exception as e:
+            self.logger.warning('Could not read export state {}: {}'.format(filename, e))
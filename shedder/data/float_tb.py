@@ -1,12 +1,34 @@
+import operator
 from operator import itemgetter
 import copy
 from .timebuffer import TimeBuffer
+from .index import PrefixIntegral, BlockExtremes
+from .local_calendar import default_calendar
+
+DAY = 3600*24
 
 class FloatTimeBuffer(TimeBuffer):
 
-    def __init__(self, age=-1, backup_filename=None, accumulated=False):
-        TimeBuffer.__init__(self, age, backup_filename)
+    def __init__(self, age=-1, backup_filename=None, accumulated=False, storage='columns', backup_interval=60, persistence=None, backup_format='yaml'):
+        TimeBuffer.__init__(self, age, backup_filename, backup_interval=backup_interval, storage=storage, persistence=persistence, backup_format=backup_format)
         self.accumulated=accumulated
+        self.integral = PrefixIntegral(self)
+        self.extremes = BlockExtremes(self, accumulated=accumulated)
+        self.aggregates = {}
+
+    #################################################################
+    # Continuous aggregates (see aggregates.py), e.g.
+    #   register_aggregate('avg_1m', RollingMean, 60)
+    #   aggregate('avg_1m', ts)
+    #
+    def register_aggregate(self, name, aggregate_class, *args, **kwargs):
+        with self.lock:
+            self.aggregates[name] = aggregate_class(self, *args, **kwargs)
+            self.version += 1           # Next snapshot has it
+            return self.aggregates[name]
+
+    def aggregate(self, name, ts=None):
+        return self.aggregates[name].value(ts)
 
     #################################################################
     # Get value
@@ -16,39 +38,51 @@ class FloatTimeBuffer(TimeBuffer):
     # * 'avg'
     #
     def get_value(self, ts: int, selection='inter'):
+        storage = self.storage
+        n = len(storage)
 
         # Empty: Default to 0
-        if len(self.sorted_list) <= 0:
+        if n <= 0:
             return 0
-        
-        idx = self.get_index(ts=ts)
+
+        # At or after the last value (the usual 'now'): no search
+        if ts >= storage.ts_at(n-1):
+            return storage.value_at(n-1)
+
+        return self.value_at_index(self.get_index(ts=ts), ts, selection)
+
+    #################################################################
+    # Get value for ts, given idx = get_index(ts)
+    #
+    def value_at_index(self, idx, ts, selection='inter'):
+        storage = self.storage
+        n = len(storage)
 
         # Last value: Return last value
-        if idx >= len(self.sorted_list):
-            return self.sorted_list[-1][1]
+        if idx >= n:
+            return storage.value_at(n-1)
         
         # First value: Return first value
         elif idx <= 0:
-            return self.sorted_list[0][1]
+            return storage.value_at(0)
 
         # Spot on
-        elif self.sorted_list[idx][0] == ts:
-            return self.sorted_list[idx][1]
+        elif storage.ts_at(idx) == ts:
+            return storage.value_at(idx)
      
-        # Get index of values for idx-1 and idx+1
-        pre_idx = max(0, idx-1)
-        post_idx = min(idx, len(self.sorted_list)-1)
-
-        pre = self.sorted_list[pre_idx]
-        post = self.sorted_list[post_idx]
-
-        if selection.lower() == 'pre':
-            return pre[1]
-        elif selection.lower() == 'post':
-            return post[1]
-        elif selection.lower() == 'avg':
+        # Values at idx-1 and idx
+        selection = selection.lower()
+        if selection == 'pre':
+            return storage.value_at(idx-1)
+        elif selection == 'post':
+            return storage.value_at(idx)
+
+        pre = storage.item(idx-1)
+        post = storage.item(idx)
+
+        if selection == 'avg':
             return (post[1]+pre[1])/2
-        elif selection.lower() == 'inter':
+        elif selection == 'inter':
             dt = post[0]-pre[0]
             dv = post[1]-pre[1]
             if dt == 0:
@@ -63,34 +97,69 @@ class FloatTimeBuffer(TimeBuffer):
     #
     def integrate(self, ts_from: int, ts_to: int):
 
-        if len(self.sorted_list) <= 0:
+        if len(self.storage) <= 0:
             return 0
 
+        return self.integrate_at_index(self.get_index(ts=ts_from), self.get_index(ts=ts_to), ts_from, ts_to)
+
+    #################################################################
+    # Integrate, given idx_from = get_index(ts_from) and
+    # idx_to = get_index(ts_to)
+    #
+    def integrate_at_index(self, idx_from, idx_to, ts_from, ts_to):
+
         sum = 0
             
         if self.accumulated:
-            pre_value = self.get_value(ts=ts_from, selection='inter')
-            post_value = self.get_value(ts=ts_to, selection='inter')
+            pre_value = self.value_at_index(idx_from, ts_from, selection='inter')
+            post_value = self.value_at_index(idx_to, ts_to, selection='inter')
             sum = post_value-pre_value
         else:
-            idx_from = self.get_index(ts=ts_from, valid_read_index=True)
-            idx_to = self.get_index(ts=ts_to, valid_read_index=True)
-            
+            pre_value = self.value_at_index(idx_from, ts_from, selection='pre')
+            post_value = self.value_at_index(idx_to, ts_to, selection='pre')
+
+            # Valid read index
+            idx_from = min(idx_from, len(self.storage)-1)
+            idx_to = min(idx_to, len(self.storage)-1)
+
             # End point not at ts
-            if self.sorted_list[idx_to][0] > ts_to:
+            if self.storage.ts_at(idx_to) > ts_to:
                 idx_to = max(idx_from, idx_to-1)
 
-            pre_value = self.get_value(ts=ts_from, selection='pre')
-            post_value = self.get_value(ts=ts_to, selection='pre')
-
-            for idx in range(idx_from, idx_to):
-                sum += self.sorted_list[idx][1] * (self.sorted_list[idx+1][0] - self.sorted_list[idx][0])
+            # Whole steps between the samples from the running integral
+            if idx_to > idx_from:
+                sum += self.integral.range(idx_from, idx_to)
 
-            sum += pre_value * (self.sorted_list[idx_from][0] - ts_from)
-            sum += post_value * (ts_to - self.sorted_list[idx_to][0])
+            sum += pre_value * (self.storage.ts_at(idx_from) - ts_from)
+            sum += post_value * (ts_to - self.storage.ts_at(idx_to))
 
         return sum
 
+    #################################################################
+    # Batch queries. Same results as calling get_value/integrate/avg per
+    # element, but with one binary search per timestamp and no per-call
+    # overhead. Return lists.
+    #
+    def get_values(self, timestamps, selection='inter'):
+        if len(self.storage) <= 0:
+            return [0]*len(timestamps)
+
+        bisect_left = self.storage.bisect_left
+        value_at_index = self.value_at_index
+        return [value_at_index(bisect_left(ts), ts, selection) for ts in timestamps]
+
+    def integrate_many(self, starts, ends):
+        if len(self.storage) <= 0:
+            return [0]*len(starts)
+
+        bisect_left = self.storage.bisect_left
+        integrate_at_index = self.integrate_at_index
+        return [integrate_at_index(bisect_left(ts_from), bisect_left(ts_to), ts_from, ts_to) for (ts_from, ts_to) in zip(starts, ends)]
+
+    def avg_many(self, starts, ends):
+        sums = self.integrate_many(starts, ends)
+        return [0 if ts_to - ts_from == 0 else s/(ts_to - ts_from) for (s, ts_from, ts_to) in zip(sums, starts, ends)]
+
     #################################################################
     # Average value over time
     #
@@ -106,53 +175,84 @@ class FloatTimeBuffer(TimeBuffer):
     # Max value
     #
     def get_max(self, ts_from: int, ts_to: int):
-        measurements = self.get_interval(from_ts=ts_from, to_ts=ts_to)
-        if len(measurements) > 0:
-            if self.accumulated:
-                # for i in range(len(measurements)-1, 0, -1):
-                #     measurements[i][1] -= measurements[i-1][1]
-                # del measurements[0]
-                for i in range(0, len(measurements)-1):
-                    measurements[i][1] = measurements[i+1][1] - measurements[i][1]
-                del measurements[-1]
-
-            if len(measurements) > 0:
-                return max(measurements, key=itemgetter(1))
-            else:
-                return None
-            
-        else:
-            return None
+        return self.get_extreme(ts_from=ts_from, ts_to=ts_to, better=operator.gt)
 
     #################################################################
     # Min value
     #
     def get_min(self, ts_from: int, ts_to: int):
-        measurements = self.get_interval(from_ts=ts_from, to_ts=ts_to)
-        if len(measurements) > 0:
-            if self.accumulated:
-                # for i in range(len(measurements)-1, 0, -1):
-                #     measurements[i][1] -= measurements[i-1][1]
-                # del measurements[0]
-                for i in range(0, len(measurements)-1):
-                    measurements[i][1] = measurements[i+1][1] - measurements[i][1]
-                del measurements[-1]
-
-            if len(measurements) > 0:
-                return min(measurements, key=itemgetter(1))
-            else:
-                return None
-        else:
+        return self.get_extreme(ts_from=ts_from, ts_to=ts_to, better=operator.lt)
+
+    #################################################################
+    # First [ts, value] in [from, to] where value is better than all
+    # others. Accumulated buffers compare consecutive deltas. Answered
+    # from the block summaries, no copy of the interval.
+    #
+    def get_extreme(self, ts_from: int, ts_to: int, better=operator.gt):
+        (from_idx, to_idx) = self.get_interval_index(from_ts=ts_from, to_ts=ts_to)
+        if self.accumulated:
+            to_idx -= 1
+        return self.extremes.extreme(from_idx, to_idx, better)
+
+    #################################################################
+    # [count, min, max, integral] over the samples in [from, to], where
+    # integral is the step function integral between those samples only
+    # (no interpolation at the bounds). None if there are none. On the
+    # 'partitioned' storage, partitions fully inside the window are
+    # taken from their summaries.
+    #
+    def summary(self, ts_from: int, ts_to: int):
+        (from_idx, to_idx) = self.get_interval_index(from_ts=ts_from, to_ts=ts_to)
+        if to_idx <= from_idx:
             return None
 
+        storage = self.storage
+        summary_at = getattr(storage, 'summary_at', None)
+        result = [0, None, None, 0.0]
+        prev = None
+        idx = from_idx
+        while idx < to_idx:
+            (s, n) = summary_at(idx) if summary_at is not None else (None, to_idx - idx)
+            if s is not None and idx + n <= to_idx:
+                first = storage.item(idx)
+                if prev is not None:
+                    result[3] += prev[1]*(first[0] - prev[0])
+                result[0] += s[0]
+                result[1] = s[1] if result[1] is None else min(result[1], s[1])
+                result[2] = s[2] if result[2] is None else max(result[2], s[2])
+                result[3] += s[3]
+                prev = storage.item(idx + n - 1)
+            else:
+                n = min(n, to_idx - idx)
+                for (ts, v) in storage.iter_items(idx, idx + n):
+                    if prev is not None:
+                        result[3] += prev[1]*(ts - prev[0])
+                    result[0] += 1
+                    result[1] = v if result[1] is None else min(result[1], v)
+                    result[2] = v if result[2] is None else max(result[2], v)
+                    prev = (ts, v)
+            idx += n
+
+        return result
+
+    #################################################################
+    # [(from, to)] periods of duration from ts_from while before ts_to.
+    # Days are local calendar days (23 or 25 hours across DST changes).
+    #
+    def periods(self, ts_from: int, ts_to: int, duration=DAY):
+        if duration == DAY:
+            grid = default_calendar().day_grid(ts_from, ts_to)
+            return list(zip(grid, grid[1:]))
+        return [(f, f+duration) for f in range(ts_from, ts_to, duration)]
+
     #################################################################
     # Max values over group of values
     #
-    def get_period_max_list(self, ts_from: int, ts_to: int, duration=3600*24):
+    def get_period_max_list(self, ts_from: int, ts_to: int, duration=DAY):
         max_values = []
 
-        for f in range(ts_from, ts_to, duration):
-            vm = self.get_max(f, f+duration)
+        for (f, t) in self.periods(ts_from, ts_to, duration):
+            vm = self.get_max(f, t)
             if vm is not None:
                 max_values.append(vm)
 
@@ -164,11 +264,11 @@ class FloatTimeBuffer(TimeBuffer):
     #################################################################
     # Min values over group of values
     #
-    def get_period_min_list(self, ts_from: int, ts_to: int, duration=3600*24):
+    def get_period_min_list(self, ts_from: int, ts_to: int, duration=DAY):
         min_values = []
 
-        for f in range(ts_from, ts_to, duration):
-            vm = self.get_min(f, f+duration)
+        for (f, t) in self.periods(ts_from, ts_to, duration):
+            vm = self.get_min(f, t)
             if vm is not None:
                 min_values.append(vm)
 
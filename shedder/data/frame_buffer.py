@@ -0,0 +1,450 @@
+import bisect
+import logging
+import threading
+from array import array
+from .float_tb import FloatTimeBuffer
+from .timebuffer import expiry_slack
+from .storage import ColumnStorage, ColumnView, IntervalView, COMPACT_MIN, ts_out
+from .backup import FrameBackup
+from .persistence import default_worker
+from .clock import default_clock
+
+#####################################################################
+# Multi-channel frame buffer
+#
+# A meter frame carries several values per timestamp (P_pos, P_neg,
+# Q_pos, I1..I3, U1..U3, ...). FrameBuffer keeps them as one ts column
+# and one value column per channel, so a frame is one insert, one
+# binary search and one backup record instead of one per value.
+#
+# channel(name) returns a FloatTimeBuffer view of one channel with the
+# usual query API, indexes and aggregates; inserts into a view go into
+# the frame buffer as a frame with just that channel. Frames without a
+# value for a channel hold NaN there and the channel skips them: a
+# channel with a value in every frame maps its indexes to the frame
+# rows directly, otherwise it keeps the positions of its rows.
+#
+# Rows are addressed by absolute position (base + physical index), so
+# expiry does not move them. Out-of-order inserts rebuild the channel
+# row maps and invalidate the channel indexes.
+#
+NAN = float('nan')
+
+class FrameStorage:
+
+    def __init__(self, channels):
+        self.channels = list(channels)
+        self.ts = array('d')
+        self.cols = {c: array('d') for c in self.channels}
+        self.head = 0
+        self.base = 0           # Absolute position of ts[0]
+        self.shared = False     # Columns shared with a channel view
+
+    def __len__(self):
+        return len(self.ts) - self.head
+
+    def ts_at(self, idx):
+        return self.ts[self.head+idx]
+
+    def position(self, idx):
+        return self.base + self.head + idx
+
+    def bisect_left(self, ts, lo=0, hi=None):
+        if hi is None:
+            hi = len(self)
+        return bisect.bisect_left(self.ts, ts, self.head+lo, self.head+hi) - self.head
+
+    #################################################################
+    # Modification. values: {channel: value}, others are NaN
+    #
+    def append(self, ts, values):
+        self.ts.append(ts)
+        for (c, col) in self.cols.items():
+            col.append(values.get(c, NAN))
+
+    def insert(self, idx, ts, values):
+        self.detach()
+        self.ts.insert(self.head+idx, ts)
+        for (c, col) in self.cols.items():
+            col.insert(self.head+idx, values.get(c, NAN))
+
+    def merge(self, idx, values):
+        self.detach()
+        for (c, v) in values.items():
+            self.cols[c][self.head+idx] = v
+
+    def drop_head(self, n):
+        self.head += min(max(n, 0), len(self))
+        if self.head >= COMPACT_MIN and 2*self.head >= len(self.ts):
+            self.compact()
+
+    def compact(self):
+        self.detach()
+        if self.head > 0:
+            del self.ts[:self.head]
+            for col in self.cols.values():
+                del col[:self.head]
+            self.base += self.head
+            self.head = 0
+
+    def keep(self, from_idx, to_idx):
+        self.detach()
+        for col in [self.ts] + list(self.cols.values()):
+            del col[self.head+to_idx:]
+            del col[:self.head+from_idx]
+        self.base += self.head + from_idx
+        self.head = 0
+
+    #################################################################
+    # Column import/export, (ts, {channel: values})
+    #
+    def load_columns(self, ts, cols):
+        self.base += len(self.ts)
+        self.ts = ts if isinstance(ts, array) else array('d', ts)
+        self.cols = {c: array('d', cols[c]) if c in cols else array('d', [NAN])*len(self.ts) for c in self.channels}
+        self.head = 0
+        self.shared = False
+
+    def columns(self):
+        return (self.ts[self.head:], {c: col[self.head:] for (c, col) in self.cols.items()})
+
+    #################################################################
+    # Private columns before a change other than an append while channel
+    # views share them (see storage.py). Positions stay as they were,
+    # like compact().
+    #
+    def detach(self):
+        if self.shared:
+            self.base += self.head
+            (self.ts, self.cols) = self.columns()
+            self.head = 0
+            self.shared = False
+
+
+#####################################################################
+# Read-only storage of one channel over a FrameStorage, same interface
+# as the storage backends for the queries. rows is None while every
+# frame has a value (index = frame index), else the absolute positions
+# of the frames that have one, from rows[head].
+#
+class ChannelStorage:
+
+    kind = 'channel'
+
+    def __init__(self, frames, channel):
+        self.frames = frames
+        self.channel = channel
+        self.rows = None
+        self.head = 0
+
+    def __len__(self):
+        if self.rows is None:
+            return len(self.frames)
+        return len(self.rows) - self.head
+
+    def index(self, idx):
+        frames = self.frames
+        if self.rows is None:
+            return frames.head + idx
+        return self.rows[self.head+idx] - frames.base
+
+    def ts_at(self, idx):
+        return self.frames.ts[self.index(idx)]
+
+    def value_at(self, idx):
+        return self.frames.cols[self.channel][self.index(idx)]
+
+    def item(self, idx):
+        i = self.index(idx)
+        return [ts_out(self.frames.ts[i]), self.frames.cols[self.channel][i]]
+
+    def bisect_left(self, ts, lo=0, hi=None):
+        if self.rows is None:
+            return self.frames.bisect_left(ts, lo, hi)
+        if hi is None:
+            hi = len(self)
+        frames = self.frames
+        return bisect.bisect_left(self.rows, ts, self.head+lo, self.head+hi, key=lambda p: frames.ts[p - frames.base]) - self.head
+
+    def iter_items(self, from_idx, to_idx):
+        frames = self.frames
+        if self.rows is None:
+            r = range(frames.head+from_idx, frames.head+to_idx)
+        else:
+            r = [p - frames.base for p in self.rows[self.head+from_idx:self.head+to_idx]]
+        return zip(map(frames.ts.__getitem__, r), map(frames.cols[self.channel].__getitem__, r))
+
+    def slice(self, from_idx, to_idx):
+        return [[ts_out(t), v] for (t, v) in self.iter_items(from_idx, to_idx)]
+
+    def to_list(self):
+        return self.slice(0, len(self))
+
+    def columns(self):
+        frames = self.frames
+        if self.rows is None:
+            return (frames.ts[frames.head:], frames.cols[self.channel][frames.head:])
+        idx = [p - frames.base for p in self.rows[self.head:]]
+        return (array('d', map(frames.ts.__getitem__, idx)), array('d', map(frames.cols[self.channel].__getitem__, idx)))
+
+    #################################################################
+    # Snapshot copy of the channel alone
+    #
+    def copy(self):
+        storage = ColumnStorage()
+        (storage.ts, storage.values) = self.columns()
+        return storage
+
+    #################################################################
+    # Read-only view for snapshots: the frame columns themselves while
+    # every frame has a value, else a copy
+    #
+    def view(self):
+        frames = self.frames
+        if self.rows is not None:
+            return self.copy()
+        frames.shared = True
+        return ColumnView(frames.ts, frames.cols[self.channel], frames.head, len(frames.ts))
+
+    def compact(self):
+        pass
+
+    #################################################################
+    # Maintenance by FrameBuffer
+    #
+    def rebuild(self):
+        frames = self.frames
+        col = frames.cols[self.channel]
+        present = [i for i in range(frames.head, len(col)) if col[i] == col[i]]
+        if len(present) == len(frames):
+            self.rows = None
+        else:
+            self.rows = array('q', (frames.base + i for i in present))
+        self.head = 0
+
+    #################################################################
+    # Frame appended; returns True if it has a value for the channel
+    #
+    def on_append(self):
+        frames = self.frames
+        v = frames.cols[self.channel][-1]
+        if v == v:
+            if self.rows is not None:
+                self.rows.append(frames.base + len(frames.ts) - 1)
+            return True
+        if self.rows is None:
+            self.rows = array('q', range(frames.base + frames.head, frames.base + len(frames.ts) - 1))
+            self.head = 0
+        return False
+
+    #################################################################
+    # Number of channel samples before absolute frame position first,
+    # drop_before() drops them after the frames were dropped
+    #
+    def count_before(self, first):
+        if self.rows is None:
+            return first - self.frames.position(0)
+        return bisect.bisect_left(self.rows, first, self.head) - self.head
+
+    def drop_before(self, first):
+        if self.rows is None:
+            return
+        self.head = bisect.bisect_left(self.rows, first, self.head)
+        if self.head >= COMPACT_MIN and 2*self.head >= len(self.rows):
+            del self.rows[:self.head]
+            self.head = 0
+
+
+#####################################################################
+# FloatTimeBuffer view of one channel. Shares the frame buffer's lock;
+# expiry, backup and persistence are done by the frame buffer.
+#
+class ChannelView(FloatTimeBuffer):
+
+    def __init__(self, frame_buffer, channel, accumulated=False):
+        FloatTimeBuffer.__init__(self, accumulated=accumulated)
+        self.frame_buffer = frame_buffer
+        self.channel = channel
+        self.storage = ChannelStorage(frame_buffer.storage, channel)
+        self.lock = frame_buffer.lock
+
+    def insert_sorted(self, ts: int, value, overwrite=True):
+        self.frame_buffer.insert_frame(ts, {self.channel: value})
+
+    def insert_many(self, ts_values, overwrite=True):
+        self.frame_buffer.insert_frames((ts, {self.channel: value}) for (ts, value) in ts_values)
+
+    def crop_interval(self, from_ts=0, to_ts=0):
+        self.frame_buffer.crop_interval(from_ts, to_ts)
+
+    def save(self):
+        self.frame_buffer.save()
+
+
+class FrameBuffer:
+
+    def __init__(self, channels, age=-1, backup_filename=None, backup_interval=60, persistence=None):
+        self.channels = dict(channels)      # name -> accumulated
+        self.storage = FrameStorage(self.channels)
+        self.age = age
+        self.backup_interval = backup_interval
+        self.backup_filename = backup_filename
+        self.backup = None
+        self.persistence = persistence
+        self.lock = threading.RLock()
+        self.logger = logging.getLogger('timebuffer')
+        self.views = {c: ChannelView(self, c, accumulated) for (c, accumulated) in self.channels.items()}
+        if backup_filename is not None:
+            self.backup = FrameBackup(backup_filename, self.channels)
+            self.restore()
+
+    def channel(self, name):
+        return self.views[name]
+
+    #################################################################
+    # Insert frame {channel: value}; None values and unknown channels
+    # are left out. A frame at an existing ts is merged into it.
+    #
+    def insert_frame(self, ts, values):
+        self.insert_frames([(ts, values)])
+
+    #################################################################
+    # Insert many (ts, {channel: value}) frames, sorted and merged once.
+    # Frames without a value for any channel are skipped.
+    #
+    def insert_frames(self, frames):
+        batch = sorted(((ts, self.clean(values)) for (ts, values) in frames), key=lambda e: e[0])
+        batch = [(ts, values) for (ts, values) in batch if len(values) > 0]
+        if len(batch) == 0:
+            return
+
+        with self.lock:
+            reordered = False
+            for (ts, values) in batch:
+                if not self.insert(ts, values):
+                    reordered = True
+                if self.backup is not None:
+                    self.backup.record(ts, values)
+            if reordered:
+                self.reindex()
+            self.auto_crop()
+        self.save()
+
+    def clean(self, values):
+        return {c: v for (c, v) in values.items() if v is not None and c in self.channels}
+
+    #################################################################
+    # Insert without expiry and backup. Returns False if the channel
+    # row maps need a reindex()
+    #
+    def insert(self, ts, values):
+        storage = self.storage
+        n = len(storage)
+        if n == 0 or ts > storage.ts_at(n-1):
+            storage.append(ts, values)
+            for view in self.views.values():
+                if view.storage.on_append():
+                    view.version += 1
+                    for index in view.indexes:
+                        index.on_append()
+            return True
+
+        idx = storage.bisect_left(ts)
+        if idx < n and storage.ts_at(idx) == ts:
+            storage.merge(idx, values)
+        else:
+            storage.insert(idx, ts, values)
+        return False
+
+    #################################################################
+    # Rebuild channel row maps, invalidate the channel indexes
+    #
+    def reindex(self):
+        for view in self.views.values():
+            view.storage.rebuild()
+            view.invalidate_indexes()
+
+    #################################################################
+    # Auto crop frames to max age, see TimeBuffer.auto_crop. Channel
+    # expiry hooks see the channel samples about to expire.
+    #
+    def auto_crop(self):
+        now = default_clock().time()
+        storage = self.storage
+        if self.age > 0 and len(storage) > 0 and storage.ts_at(0) < now-self.age-expiry_slack():
+            n = storage.bisect_left(now-self.age-1)
+            first = storage.position(n)
+            counts = {}
+            for (c, view) in self.views.items():
+                k = view.storage.count_before(first)
+                counts[c] = k
+                for hook in view.expiry_hooks:
+                    hook(IntervalView(view.storage, 0, k))
+
+            storage.drop_head(n)
+            for (c, view) in self.views.items():
+                view.storage.drop_before(first)
+                view.version += 1
+                for index in view.indexes:
+                    index.on_drop_head(counts[c])
+
+        # Frames from the future (clock skew) are cropped as well
+        to_ts = int(now+1)
+        if self.age > 0 and len(storage) > 0 and storage.ts_at(len(storage)-1) > to_ts:
+            self.crop_interval(to_ts=to_ts)
+
+    #################################################################
+    # Crop frames [from, to], including
+    #
+    def crop_interval(self, from_ts=0, to_ts=0):
+        with self.lock:
+            storage = self.storage
+            from_idx = storage.bisect_left(from_ts)
+            to_idx = len(storage) if to_ts <= 0 else storage.bisect_left(to_ts)
+            if to_idx < len(storage) and storage.ts_at(to_idx) == to_ts:
+                to_idx += 1
+            storage.keep(from_idx, max(from_idx, to_idx))
+            self.reindex()
+            if self.backup is not None:
+                self.backup.record_crop(from_ts=from_ts, to_ts=to_ts)
+
+    #################################################################
+    # Persistence, see TimeBuffer
+    #
+    def save(self):
+        if self.backup_filename is not None:
+            if self.persistence is None:
+                self.persistence = default_worker()
+            self.persistence.mark_dirty(self)
+
+    def flush(self):
+        if self.backup is None:
+            return 0
+        with self.lock:
+            columns = self.storage.columns()
+            batch = self.backup.take()
+        return self.backup.write(FrameColumns(columns), batch)
+
+    def restore(self):
+        with self.lock:
+            try:
+                (columns, journal) = self.backup.load()
+                if columns is not None:
+                    self.storage.load_columns(columns[0], columns[1])
+                for (ts, values) in journal:
+                    self.insert(ts, {c: v for (c, v) in values.items() if v == v and c in self.channels})
+                self.reindex()
+            except Exception as e:
+                self.logger.warning('Could not read frame buffer backup {}: {}'.format(self.backup_filename, e))
+
+
+#####################################################################
+# Column copy handed to FrameBackup.write (outside the lock)
+#
+class FrameColumns:
+
+    def __init__(self, columns):
+        self.cols = columns
+
+    def columns(self):
+        return self.cols
@@ -0,0 +1,157 @@
+import struct
+from array import array
+
+#####################################################################
+# Gorilla-style chunk codec for (ts, value) float64 columns
+#
+# Timestamps are stored as delta-of-delta when all of them are whole
+# numbers (the usual case, seconds), else XOR-encoded like the values.
+# Values are XOR-encoded against the previous value, reusing the
+# previous leading/trailing zero window when the XOR fits into it.
+# Regular sampling and slowly changing or register-like values compress
+# to a few bits per sample.
+#
+# Chunk layout: header (flags, count), then the bit stream padded to a
+# whole byte. The codec works on bit strings ('0'/'1') since slicing
+# and int(s, 2) are the fastest bit access plain Python has.
+#
+CHUNK_HEADER = struct.Struct('<BI')
+FLAG_INT_TS = 1
+
+# Delta-of-delta classes: (prefix, bits), zigzag encoded
+DOD_CLASSES = (('10', 7), ('110', 9), ('1110', 12))
+DOD_WIDE = ('1111', 64)
+
+def zigzag(n):
+    return 2*n if n >= 0 else -2*n - 1
+
+def unzigzag(z):
+    return z >> 1 if z & 1 == 0 else -((z + 1) >> 1)
+
+def float_bits(values):
+    bits = array('Q')
+    bits.frombytes(array('d', values).tobytes())
+    return bits
+
+def bits_float(bits):
+    values = array('d')
+    values.frombytes(array('Q', bits).tobytes())
+    return values
+
+#####################################################################
+# Encode columns into one chunk, return bytes
+#
+def encode_chunk(ts, values):
+    count = len(ts)
+    int_ts = all(t == int(t) for t in ts)
+    out = []
+    if count > 0:
+        if int_ts:
+            encode_dod(out, [int(t) for t in ts])
+        else:
+            encode_xor(out, float_bits(ts))
+        encode_xor(out, float_bits(values))
+
+    stream = ''.join(out)
+    stream += '0'*(-len(stream) % 8)
+    data = int(stream, 2).to_bytes(len(stream)//8, 'big') if len(stream) > 0 else b''
+    return CHUNK_HEADER.pack(FLAG_INT_TS if int_ts else 0, count) + data
+
+def encode_dod(out, ts):
+    out.append(format(zigzag(ts[0]), '064b'))
+    prev = ts[0]
+    prev_delta = 0
+    for t in ts[1:]:
+        delta = t - prev
+        z = zigzag(delta - prev_delta)
+        if z == 0:
+            out.append('0')
+        else:
+            for (prefix, bits) in DOD_CLASSES:
+                if z < 1 << bits:
+                    out.append(prefix + format(z, '0{}b'.format(bits)))
+                    break
+            else:
+                out.append(DOD_WIDE[0] + format(z, '064b'))
+        prev = t
+        prev_delta = delta
+
+def encode_xor(out, bits):
+    out.append(format(bits[0], '064b'))
+    prev = bits[0]
+    (lead, trail) = (-1, -1)
+    for b in bits[1:]:
+        x = b ^ prev
+        prev = b
+        if x == 0:
+            out.append('0')
+            continue
+
+        x_lead = min(64 - x.bit_length(), 31)
+        x_trail = (x & -x).bit_length() - 1
+        if lead >= 0 and x_lead >= lead and x_trail >= trail:
+            # Fits the previous window
+            out.append('10' + format(x >> trail, '0{}b'.format(64 - lead - trail)))
+        else:
+            (lead, trail) = (x_lead, x_trail)
+            sig = 64 - lead - trail
+            out.append('11' + format(lead, '05b') + format(sig - 1, '06b') + format(x >> trail, '0{}b'.format(sig)))
+
+#####################################################################
+# Decode chunk, return (ts, values) as array('d')
+#
+def decode_chunk(data):
+    (flags, count) = CHUNK_HEADER.unpack_from(data, 0)
+    if count == 0:
+        return (array('d'), array('d'))
+
+    body = data[CHUNK_HEADER.size:]
+    stream = format(int.from_bytes(body, 'big'), '0{}b'.format(8*len(body)))
+    if flags & FLAG_INT_TS:
+        (ts, pos) = decode_dod(stream, 0, count)
+        ts = array('d', ts)
+    else:
+        (ts, pos) = decode_xor(stream, 0, count)
+        ts = bits_float(ts)
+    (values, pos) = decode_xor(stream, pos, count)
+    return (ts, bits_float(values))
+
+def decode_dod(s, pos, count):
+    prev = unzigzag(int(s[pos:pos+64], 2))
+    pos += 64
+    ts = [prev]
+    prev_delta = 0
+    for i in range(count - 1):
+        if s[pos] == '0':
+            pos += 1
+        else:
+            for (prefix, bits) in DOD_CLASSES + (DOD_WIDE,):
+                if s.startswith(prefix, pos):
+                    pos += len(prefix)
+                    prev_delta += unzigzag(int(s[pos:pos+bits], 2))
+                    pos += bits
+                    break
+        prev += prev_delta
+        ts.append(prev)
+    return (ts, pos)
+
+def decode_xor(s, pos, count):
+    prev = int(s[pos:pos+64], 2)
+    pos += 64
+    bits = [prev]
+    (lead, trail) = (0, 0)
+    for i in range(count - 1):
+        if s[pos] == '0':
+            pos += 1
+        else:
+            if s[pos+1] == '1':
+                lead = int(s[pos+2:pos+7], 2)
+                trail = 64 - lead - (int(s[pos+7:pos+13], 2) + 1)
+                pos += 13
+            else:
+                pos += 2
+            sig = 64 - lead - trail
+            prev ^= int(s[pos:pos+sig], 2) << trail
+            pos += sig
+        bits.append(prev)
+    return (bits, pos)
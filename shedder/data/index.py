@@ -0,0 +1,248 @@
+import copy
+from array import array
+from collections import deque
+from itertools import accumulate
+from operator import mul, sub
+from .storage import ts_out
+
+#####################################################################
+# Derived indexes kept alongside a TimeBuffer
+#
+# TimeBuffer notifies its indexes on every change: on_append() after an
+# in-order append, on_drop_head(n) when n samples expire from the head
+# and invalidate() for anything else (out-of-order insert, crop, load).
+# An invalid index is rebuilt lazily on its next query.
+#
+# clone() copies an index for a buffer snapshot. Once a snapshot's copy
+# has been queried, the live index is kept valid (wanted) so later
+# snapshots copy it instead of each rebuilding their own. The copy
+# shares the index arrays: indexes only append to them, replace them
+# (rebuild, expiry) or update the summary of a block a snapshot does not
+# cover completely, so a snapshot bounded to fewer samples never sees
+# a change.
+#
+COMPACT_MIN = 1024
+
+class BufferIndex:
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.valid = False
+        self.wanted = False
+        self.origin = None          # Live index this is a snapshot copy of
+        buffer.indexes.append(self)
+
+    def invalidate(self):
+        self.valid = False
+
+    def ensure(self):
+        if self.origin is not None:
+            self.origin.wanted = True
+        if not self.valid:
+            self.rebuild()
+            self.valid = True
+
+    def rebuild(self):
+        pass
+
+    def on_append(self):
+        self.invalidate()
+
+    def on_drop_head(self, n):
+        self.invalidate()
+
+    #################################################################
+    # Copy for buffer (a snapshot of self.buffer). Arrays are shared and
+    # deques copied if valid, everything else is shared.
+    #
+    def clone(self, buffer):
+        if self.wanted:
+            self.ensure()
+        index = copy.copy(self)
+        index.buffer = buffer
+        index.origin = self
+        for (name, value) in vars(self).items():
+            if isinstance(value, array):
+                setattr(index, name, value if self.valid else array(value.typecode))
+            elif isinstance(value, deque):
+                setattr(index, name, deque(value if self.valid else ()))
+        buffer.indexes.append(index)
+        return index
+
+
+#####################################################################
+# Running integral of the step function through the samples:
+#
+#   integral(i) = sum(value[k] * (ts[k+1] - ts[k]) for k < i)
+#
+# so the integral over samples [a, b] is integral(b) - integral(a).
+#
+class PrefixIntegral(BufferIndex):
+
+    def __init__(self, buffer):
+        self.cum = array('d')
+        self.head = 0
+        BufferIndex.__init__(self, buffer)
+
+    def rebuild(self):
+        (ts, values) = self.buffer.storage.columns()
+        if len(ts) > 0:
+            steps = map(mul, values[:-1], map(sub, ts[1:], ts[:-1]))
+            self.cum = array('d', accumulate(steps, initial=0.0))
+        else:
+            self.cum = array('d')
+        self.head = 0
+
+    def on_append(self):
+        if not self.valid:
+            return
+
+        storage = self.buffer.storage
+        n = len(storage)
+        if n == 1:
+            self.cum = array('d', [0.0])
+            self.head = 0
+        else:
+            self.cum.append(self.cum[-1] + storage.value_at(n-2)*(storage.ts_at(n-1) - storage.ts_at(n-2)))
+
+    def on_drop_head(self, n):
+        if not self.valid:
+            return
+
+        self.head += n
+        if self.head >= COMPACT_MIN and 2*self.head >= len(self.cum):
+            self.cum = self.cum[self.head:]
+            self.head = 0
+
+    #################################################################
+    # Integral over samples [from_idx, to_idx]
+    #
+    def range(self, from_idx, to_idx):
+        self.ensure()
+        return self.cum[self.head+to_idx] - self.cum[self.head+from_idx]
+
+
+#####################################################################
+# Block max/min summaries for range extremum queries
+#
+# Elements are the sample values, or the deltas to the next sample for
+# accumulated buffers (element i belongs to ts[i]). Blocks of BLOCK_SIZE
+# elements are numbered by absolute position (dropped + index), so expiry
+# only drops whole blocks from the front. A query scans the partial
+# blocks at the ends and the block summaries in between.
+#
+BLOCK_SIZE = 64
+
+class BlockExtremes(BufferIndex):
+
+    def __init__(self, buffer, accumulated=False):
+        self.accumulated = accumulated
+        self.max = array('d')
+        self.min = array('d')
+        self.first_block = 0
+        self.dropped = 0
+        BufferIndex.__init__(self, buffer)
+
+    def element(self, idx):
+        storage = self.buffer.storage
+        if self.accumulated:
+            return storage.value_at(idx+1) - storage.value_at(idx)
+        else:
+            return storage.value_at(idx)
+
+    def element_count(self):
+        n = len(self.buffer.storage)
+        return max(n-1, 0) if self.accumulated else n
+
+    def rebuild(self):
+        (ts, values) = self.buffer.storage.columns()
+        if self.accumulated:
+            elements = array('d', map(sub, values[1:], values[:-1]))
+        else:
+            elements = values
+        self.max = array('d', (max(elements[k:k+BLOCK_SIZE]) for k in range(0, len(elements), BLOCK_SIZE)))
+        self.min = array('d', (min(elements[k:k+BLOCK_SIZE]) for k in range(0, len(elements), BLOCK_SIZE)))
+        self.first_block = 0
+        self.dropped = 0
+
+    def on_append(self):
+        if not self.valid:
+            return
+
+        idx = self.element_count() - 1
+        if idx < 0:
+            return
+
+        v = self.element(idx)
+        k = (self.dropped + idx)//BLOCK_SIZE - self.first_block
+        if k >= len(self.max):
+            self.max.append(v)
+            self.min.append(v)
+        else:
+            if v > self.max[k]:
+                self.max[k] = v
+            if v < self.min[k]:
+                self.min[k] = v
+
+    def on_drop_head(self, n):
+        if not self.valid:
+            return
+
+        self.dropped += n
+        k = self.dropped//BLOCK_SIZE - self.first_block
+        if k > 0:
+            self.max = self.max[k:]
+            self.min = self.min[k:]
+            self.first_block += k
+
+    #################################################################
+    # First [ts, element] in elements [from_idx, to_idx) where element
+    # is better (operator.gt: max, operator.lt: min) than all others.
+    # None if the range is empty.
+    #
+    def extreme(self, from_idx, to_idx, better):
+        self.ensure()
+        to_idx = min(to_idx, self.element_count())
+        if to_idx <= from_idx:
+            return None
+
+        summary = self.max if better(1, 0) else self.min
+        select = max if better(1, 0) else min
+        base = self.dropped - self.first_block*BLOCK_SIZE
+
+        # Whole blocks inside the range, as summary indexes
+        k_from = (base + from_idx + BLOCK_SIZE - 1)//BLOCK_SIZE
+        k_to = (base + to_idx)//BLOCK_SIZE
+        if k_to <= k_from:
+            return self.scan(from_idx, to_idx, better)
+
+        best = self.scan(from_idx, k_from*BLOCK_SIZE - base, better)
+
+        v = select(summary[k_from:k_to])
+        if best is None or better(v, best[1]):
+            k = summary.index(v, k_from, k_to)
+            best = self.scan(k*BLOCK_SIZE - base, (k+1)*BLOCK_SIZE - base, better)
+
+        tail = self.scan(k_to*BLOCK_SIZE - base, to_idx, better)
+        if tail is not None and better(tail[1], best[1]):
+            best = tail
+
+        return best
+
+    def scan(self, from_idx, to_idx, better):
+        storage = self.buffer.storage
+        if self.accumulated:
+            samples = storage.iter_items(from_idx, to_idx+1)
+            prev = next(samples, None)
+            elements = []
+            for e in samples:
+                elements.append((prev[0], e[1] - prev[1]))
+                prev = e
+        else:
+            elements = storage.iter_items(from_idx, to_idx)
+
+        best = None
+        for (ts, v) in elements:
+            if best is None or better(v, best[1]):
+                best = [ts_out(ts), v]
+        return best
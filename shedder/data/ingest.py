@@ -0,0 +1,133 @@
+import threading
+from collections import deque
+
+#####################################################################
+# Reorder buffer for incoming samples
+#
+# Holds samples for window seconds behind the newest timestamp seen (the
+# watermark), so samples arriving slightly out of order from several
+# gateways are sorted before they reach the buffers. Samples at or below
+# the watermark are released to sink(batch) as one sorted list of
+# (ts, item) per add(), which the buffers take on their append path
+# (TimeBuffer.insert_many).
+#
+# A sample with the timestamp of a pending or recently released one is a
+# duplicate: dict items are merged into the pending one (fields it is
+# missing), anything else is dropped. A duplicate dict of a released one
+# that carries fields it was missing (e.g. the energy registers from a
+# second gateway) goes to late(ts, fields) with only those fields. A
+# sample behind the watermark that is not a duplicate is late and goes
+# to late(ts, item) right away.
+# At most max_pending samples are held; flush(now) releases what the
+# wall clock says is complete when no newer samples arrive.
+#
+# add() is called from the MQTT thread, flush() from the main loop;
+# both hold self.lock while calling the sinks, so batches reach the
+# buffers in order.
+#
+class ReorderBuffer:
+
+    def __init__(self, sink, late=None, window=4, max_pending=256):
+        self.sink = sink
+        self.late = late if late is not None else lambda ts, item: sink([(ts, item)])
+        self.window = window
+        self.max_pending = max_pending
+        self.pending = {}           # ts -> item
+        self.max_ts = None
+        self.watermark = None       # Newest released ts
+        self.recent = deque()       # Released ts within window of the watermark
+        self.released = {}          # ts in recent -> fields sent (dict items)
+        self.lock = threading.Lock()
+        self.stats = {
+            'received': 0,
+            'released': 0,
+            'batches': 0,
+            'reordered': 0,
+            'late': 0,
+            'duplicates': 0,
+        }
+
+    #################################################################
+    # Add sample, release what is complete
+    #
+    def add(self, ts, item):
+        with self.lock:
+            self.stats['received'] += 1
+
+            if ts in self.pending:
+                self.stats['duplicates'] += 1
+                existing = self.pending[ts]
+                if isinstance(existing, dict) and isinstance(item, dict):
+                    for (k, v) in item.items():
+                        if existing.get(k) is None:
+                            existing[k] = v
+                return
+
+            if self.watermark is not None and ts <= self.watermark:
+                if ts in self.released:
+                    self.stats['duplicates'] += 1
+                    fields = self.released[ts]
+                    if fields is not None and isinstance(item, dict):
+                        missing = {k: v for (k, v) in item.items() if v is not None and k not in fields}
+                        if len(missing) > 0:
+                            self.stats['late'] += 1
+                            fields.update(missing)
+                            self.late(ts, missing)
+                else:
+                    self.stats['late'] += 1
+                    self.remember(ts, item)
+                    self.late(ts, item)
+                return
+
+            if self.max_ts is not None and ts < self.max_ts:
+                self.stats['reordered'] += 1
+            else:
+                self.max_ts = ts
+            self.pending[ts] = item
+            self.release(self.max_ts - self.window)
+
+    #################################################################
+    # Release pending samples up to now - window, all if now is None
+    #
+    def flush(self, now=None):
+        with self.lock:
+            if now is None:
+                self.release(None)
+            else:
+                self.release(now - self.window)
+
+    #################################################################
+    # Send pending samples with ts <= watermark (all if None), and the
+    # oldest ones beyond max_pending, to the sink as one batch
+    #
+    def release(self, watermark):
+        keys = sorted(self.pending)
+        n = len(keys) if watermark is None else next((i for (i, ts) in enumerate(keys) if ts > watermark), len(keys))
+        n = max(n, len(keys) - self.max_pending)
+        if n <= 0:
+            return
+
+        batch = [(ts, self.pending.pop(ts)) for ts in keys[:n]]
+        for (ts, item) in batch:
+            self.remember(ts, item)
+        self.watermark = batch[-1][0] if self.watermark is None else max(self.watermark, batch[-1][0])
+        self.stats['released'] += len(batch)
+        self.stats['batches'] += 1
+        self.sink(batch)
+
+    #################################################################
+    # Keep released ts for duplicate detection for window seconds
+    #
+    def remember(self, ts, item):
+        self.recent.append(ts)
+        if isinstance(item, dict):
+            self.released[ts] = set(k for (k, v) in item.items() if v is not None)
+        else:
+            self.released[ts] = None
+        if self.watermark is not None:
+            while len(self.recent) > 0 and self.recent[0] < self.watermark - self.window:
+                self.released.pop(self.recent.popleft(), None)
+
+    def metrics(self):
+        with self.lock:
+            return dict(self.stats, pending=len(self.pending))
@@ -0,0 +1,184 @@
+import os
+import logging
+import datetime
+from threading import Lock
+from .clock import default_clock
+
+try:
+    from zoneinfo import ZoneInfo
+except ImportError:
+    ZoneInfo = None
+
+#####################################################################
+# Local calendar
+#
+# Resolves the local zone once (zoneinfo, from TZ or /etc/localtime)
+# and caches what the status calls need per local hour: the date and
+# wall time of the hour start, so formatting a timestamp is string
+# work instead of a datetime conversion. Day and month bounds follow
+# the zone's DST transitions, days are 23 or 25 hours long across them.
+#
+# Falls back to the current fixed UTC offset (no DST) if the zone can
+# not be resolved.
+#
+HOUR_CACHE = 4096
+GRID_CACHE = 64
+
+#####################################################################
+# Local zone: ZoneInfo for TZ or /etc/localtime, else the current
+# fixed offset
+#
+def local_zone():
+    logger = logging.getLogger('timebuffer')
+    key = os.environ.get('TZ', '').lstrip(':')
+    if key == '':
+        try:
+            path = os.path.realpath('/etc/localtime')
+            if 'zoneinfo/' in path:
+                key = path.split('zoneinfo/', 1)[1]
+        except OSError:
+            pass
+    if key == '':
+        try:
+            with open('/etc/timezone', 'r') as f:
+                key = f.read().strip()
+        except OSError:
+            pass
+
+    if ZoneInfo is not None and key != '':
+        try:
+            return ZoneInfo(key)
+        except Exception as e:
+            logger.warning('Unknown time zone {}: {}'.format(key, e))
+    return datetime.datetime.now().astimezone().tzinfo
+
+
+class LocalCalendar:
+
+    def __init__(self, zone=None):
+        self.zone = zone if zone is not None else local_zone()
+        self.hours = {}             # UTC hour -> hour entry
+        self.months = {}            # (year, month) -> (start, end)
+        self.grids = {}             # (ts_from, ts_to) -> day starts
+
+    #################################################################
+    # (hour start ts, local datetime at it, 'YYYY.MM.DD', seconds into
+    # the local day at hour start, steady) for the UTC hour holding ts.
+    # steady: same UTC offset all hour, wall time is hour start + dt.
+    #
+    def hour(self, ts):
+        h = int(ts//3600)
+        entry = self.hours.get(h)
+        if entry is None:
+            start = datetime.datetime.fromtimestamp(3600*h, self.zone)
+            end = datetime.datetime.fromtimestamp(3600*h + 3600, self.zone)
+            entry = (3600*h, start, start.strftime('%Y.%m.%d'), 3600*start.hour + 60*start.minute + start.second, start.utcoffset() == end.utcoffset())
+            if len(self.hours) >= HOUR_CACHE:
+                self.hours = {}
+            self.hours[h] = entry
+        return entry
+
+    def local(self, ts):
+        return datetime.datetime.fromtimestamp(ts, self.zone)
+
+    def date(self, ts):
+        (start_ts, start, ymd, sec, steady) = self.hour(ts)
+        if steady and sec + int(ts) - start_ts < 86400:
+            return start.date()
+        return self.local(ts).date()
+
+    #################################################################
+    # Formatting, same output as strftime/isoformat on the local time
+    #
+    def ymd(self, ts):
+        (start_ts, start, ymd, sec, steady) = self.hour(ts)
+        if steady and sec + int(ts) - start_ts < 86400:
+            return ymd
+        return self.local(ts).strftime('%Y.%m.%d')
+
+    def hms(self, ts):
+        (start_ts, start, ymd, sec, steady) = self.hour(ts)
+        sec += int(ts) - start_ts
+        if steady and sec < 86400:
+            return '{:02d}:{:02d}:{:02d}'.format(sec//3600, sec//60 % 60, sec % 60)
+        return self.local(ts).strftime('%H:%M:%S')
+
+    def ymd_hms(self, ts):
+        return self.ymd(ts) + ' ' + self.hms(ts)
+
+    def iso(self, ts):
+        if ts != int(ts):
+            return self.local(ts).isoformat()
+        (start_ts, start, ymd, sec, steady) = self.hour(ts)
+        if not steady or sec + int(ts) - start_ts >= 86400:
+            return self.local(ts).isoformat()
+        offset = start.isoformat()[19:]
+        return ymd.replace('.', '-') + 'T' + self.hms(ts) + offset
+
+    #################################################################
+    # Batch formatting of a list of timestamps
+    #
+    def ymd_hms_many(self, timestamps):
+        ymd_hms = self.ymd_hms
+        return [ymd_hms(ts) for ts in timestamps]
+
+    def iso_many(self, timestamps):
+        iso = self.iso
+        return [iso(ts) for ts in timestamps]
+
+    #################################################################
+    # Bounds
+    #
+    def day_bounds(self, ts):
+        d = self.date(ts)
+        start = datetime.datetime(d.year, d.month, d.day, tzinfo=self.zone)
+        return (int(start.timestamp()), self.add_days(int(start.timestamp()), 1))
+
+    def month_bounds(self, ts=None):
+        if ts is None:
+            ts = default_clock().time()
+        d = self.date(ts)
+        key = (d.year, d.month)
+        bounds = self.months.get(key)
+        if bounds is None:
+            from_date = datetime.datetime(d.year, d.month, 1, tzinfo=self.zone)
+            to_date = (from_date + datetime.timedelta(days=32)).replace(day=1)
+            bounds = (int(from_date.timestamp()), int(to_date.timestamp()))
+            self.months[key] = bounds
+        return bounds
+
+    #################################################################
+    # Same local wall time n days later
+    #
+    def add_days(self, ts, n):
+        t = self.local(ts).replace(tzinfo=None) + datetime.timedelta(days=n)
+        return int(t.replace(tzinfo=self.zone).timestamp())
+
+    #################################################################
+    # Starts of the local days from ts_from (same wall time each day)
+    # while before ts_to, followed by the end of the last one
+    #
+    def day_grid(self, ts_from, ts_to):
+        key = (ts_from, ts_to)
+        grid = self.grids.get(key)
+        if grid is None:
+            grid = [ts_from]
+            while grid[-1] < ts_to:
+                grid.append(self.add_days(ts_from, len(grid)))
+            if len(self.grids) >= GRID_CACHE:
+                self.grids = {}
+            self.grids[key] = grid
+        return grid
+
+_default_calendar = None
+_default_lock = Lock()
+
+#####################################################################
+# Shared calendar for the local zone
+#
+def default_calendar():
+    global _default_calendar
+    with _default_lock:
+        if _default_calendar is None:
+            _default_calendar = LocalCalendar()
+    return _default_calendar
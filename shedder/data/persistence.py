@@ -0,0 +1,155 @@
+import os
+import time
+import atexit
+import logging
+import tempfile
+from threading import Thread, Event, Lock
+
+#####################################################################
+# Write-behind persistence for buffers
+#
+# Buffers call mark_dirty() on change. One background thread flushes each
+# dirty buffer at most once per its backup_interval by calling
+# buffer.flush(), which returns the number of bytes written. The mark is
+# cleared before the flush (changes made meanwhile mark it again) and put
+# back if the flush fails, so it is retried after another interval.
+# stop() does a final flush of everything still dirty.
+#
+class PersistenceWorker:
+
+    def __init__(self, tick=1.0):
+        self.tick = tick
+        self.logger = logging.getLogger('timebuffer')
+        self.lock = Lock()
+        self.dirty = {}             # buffer -> time first marked dirty
+        self.last_flush = {}        # buffer -> time of last flush
+        self.stop_event = Event()
+        self.thread = None
+        self.stats = {
+            'flushes': 0,
+            'errors': 0,
+            'bytes_written': 0,
+            'last_flush_bytes': 0,
+            'last_flush_duration': 0.0,
+            'max_flush_duration': 0.0,
+            'total_flush_duration': 0.0,
+        }
+
+    #################################################################
+    # Start background thread (idempotent)
+    #
+    def start(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.stop_event.clear()
+                self.thread = Thread(target=self.run, name='persistence', daemon=True)
+                self.thread.start()
+
+    #################################################################
+    # Stop background thread and flush everything still dirty
+    #
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None and self.thread.is_alive():
+            self.thread.join()
+        self.flush_all(force=True)
+
+    #################################################################
+    # Schedule buffer for flushing
+    #
+    def mark_dirty(self, buffer):
+        with self.lock:
+            if buffer not in self.dirty:
+                self.dirty[buffer] = time.time()
+
+    #################################################################
+    # Thread loop
+    #
+    def run(self):
+        while not self.stop_event.wait(self.tick):
+            self.flush_all()
+
+    #################################################################
+    # Flush dirty buffers that are due (or all of them if forced)
+    #
+    def flush_all(self, force=False):
+        now = time.time()
+        with self.lock:
+            due = [(b, since) for (b, since) in self.dirty.items() if force or now - self.last_flush.get(b, 0) >= b.backup_interval]
+            for (b, since) in due:
+                del self.dirty[b]
+                self.last_flush[b] = now
+
+        for (b, since) in due:
+            self.flush_buffer(b, since)
+
+    def flush_buffer(self, buffer, since=None):
+        t0 = time.perf_counter()
+        try:
+            nbytes = buffer.flush()
+        except Exception as e:
+            self.stats['errors'] += 1
+            self.logger.warning('Could not flush buffer {}: {}'.format(buffer.backup_filename, e))
+            # Still dirty, keep the oldest mark
+            with self.lock:
+                first = self.dirty.get(buffer, time.time())
+                self.dirty[buffer] = min(first, since) if since is not None else first
+            return
+        duration = time.perf_counter() - t0
+
+        self.stats['flushes'] += 1
+        self.stats['bytes_written'] += nbytes
+        self.stats['last_flush_bytes'] = nbytes
+        self.stats['last_flush_duration'] = duration
+        self.stats['max_flush_duration'] = max(duration, self.stats['max_flush_duration'])
+        self.stats['total_flush_duration'] += duration
+
+    #################################################################
+    # Metrics for status publishing
+    #
+    def metrics(self):
+        with self.lock:
+            pending = len(self.dirty)
+        return dict(self.stats, pending=pending)
+
+
+#####################################################################
+# Write data to filename atomically (temp file + rename). Returns bytes
+# written.
+#
+def atomic_write(filename, data):
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+
+    directory = os.path.dirname(os.path.abspath(filename))
+    (fd, tmp_filename) = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(filename) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filename, filename)
+    except Exception:
+        try:
+            os.unlink(tmp_filename)
+        except OSError:
+            pass
+        raise
+
+    return len(data)
+
+
+_default_worker = None
+_default_lock = Lock()
+
+#####################################################################
+# Shared worker used by all buffers unless one is given explicitly
+#
+def default_worker():
+    global _default_worker
+    with _default_lock:
+        if _default_worker is None:
+            _default_worker = PersistenceWorker()
+            _default_worker.start()
+            atexit.register(_default_worker.stop)
+    return _default_worker
@@ -0,0 +1,313 @@
+import os
+import math
+import struct
+import logging
+import threading
+from array import array
+from .persistence import atomic_write, default_worker
+from .clock import default_clock
+
+#####################################################################
+# Streaming quantiles of power (load-duration statistics)
+#
+# TDigest is a merging t-digest: values are kept as at most about
+# compression centroids (mean, weight), small at the tails and larger
+# around the median, so P99 stays accurate with bounded memory. Digests
+# merge, so a month is the merge of its days.
+#
+# DailyQuantiles keeps one digest per local day of a raw power buffer,
+# weighted by time: each sample counts for the seconds it is held (the
+# step function integrate() uses, gaps capped at max_gap). Like the
+# rollup tiers it is fed with the samples expiring from the raw buffer;
+# queries merge the stored days with the part still in the buffer.
+#
+COMPRESSION = 200
+BUFFER_FACTOR = 5           # Unmerged values held, times compression
+DIGEST_HEADER = struct.Struct('<4sIQ')        # magic, version, day count
+OPEN_POINT = struct.Struct('<dd?')            # open ts, open value, has open point
+DAY_HEADER = struct.Struct('<ddddI')          # day start, min, max, total weight, centroid count
+DIGEST_MAGIC = b'TQD1'
+LOAD_DURATION = (0.0, 0.01, 0.05, 0.1, 0.25, 0.5, 0.75, 0.9, 0.95, 0.99, 1.0)
+
+class TDigest:
+
+    def __init__(self, compression=COMPRESSION):
+        self.compression = compression
+        self.means = array('d')
+        self.weights = array('d')
+        self.pending = []           # (value, weight) not merged yet
+        self.total = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value, weight=1.0):
+        if weight <= 0:
+            return
+        self.pending.append((value, weight))
+        self.total += weight
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        if len(self.pending) > BUFFER_FACTOR*self.compression:
+            self.compress()
+
+    #################################################################
+    # Merge other digests into this one, compressed once
+    #
+    def merge(self, *others):
+        for other in others:
+            other.compress()
+            self.pending.extend(zip(other.means, other.weights))
+            self.total += other.total
+            self.min = min(self.min, other.min)
+            self.max = max(self.max, other.max)
+        self.compress()
+        return self
+
+    def copy(self):
+        return TDigest(self.compression).merge(self)
+
+    #################################################################
+    # Scale function k1: centroid q ranges span at most 1 in k
+    #
+    def k(self, q):
+        return self.compression/(2*math.pi)*math.asin(2*q - 1)
+
+    def k_inv(self, k):
+        return (math.sin(min(max(2*math.pi*k/self.compression, -math.pi/2), math.pi/2)) + 1)/2
+
+    def compress(self):
+        if len(self.pending) == 0:
+            return
+        items = sorted(list(zip(self.means, self.weights)) + self.pending)
+        self.pending = []
+
+        means = array('d')
+        weights = array('d')
+        (mean, weight) = items[0]
+        done = 0.0
+        limit = self.total*self.k_inv(self.k(0) + 1)
+        for (m, w) in items[1:]:
+            if done + weight + w <= limit:
+                weight += w
+                mean += (m - mean)*w/weight
+            else:
+                means.append(mean)
+                weights.append(weight)
+                done += weight
+                limit = self.total*self.k_inv(self.k(done/self.total) + 1)
+                (mean, weight) = (m, w)
+        means.append(mean)
+        weights.append(weight)
+        (self.means, self.weights) = (means, weights)
+
+    def __len__(self):
+        self.compress()
+        return len(self.means)
+
+    #################################################################
+    # Value below which fraction q of the weight lies. None if empty.
+    # Interpolates between centroid centers, min/max at the ends.
+    #
+    def quantile(self, q):
+        self.compress()
+        n = len(self.means)
+        if n == 0:
+            return None
+        if n == 1 or q <= 0:
+            return self.min if q <= 0 else (self.max if q >= 1 else self.means[0])
+        if q >= 1:
+            return self.max
+
+        target = q*self.total
+        cum = 0.0
+        prev = (self.min, 0.0)      # (value, weight position)
+        for (m, w) in zip(self.means, self.weights):
+            center = cum + w/2
+            if target < center:
+                (v0, p0) = prev
+                return v0 + (m - v0)*(target - p0)/(center - p0) if center > p0 else m
+            prev = (m, center)
+            cum += w
+        (v0, p0) = prev
+        return v0 + (self.max - v0)*(target - p0)/(self.total - p0) if self.total > p0 else self.max
+
+    #################################################################
+    # Fraction of the weight at or below value
+    #
+    def cdf(self, value):
+        self.compress()
+        if len(self.means) == 0:
+            return None
+        if value < self.min:
+            return 0.0
+        if value >= self.max:
+            return 1.0
+
+        cum = 0.0
+        prev = (self.min, 0.0)
+        for (m, w) in zip(self.means, self.weights):
+            center = cum + w/2
+            if value < m:
+                (v0, p0) = prev
+                return (p0 + (center - p0)*(value - v0)/(m - v0))/self.total if m > v0 else p0/self.total
+            prev = (m, center)
+            cum += w
+        (v0, p0) = prev
+        return (p0 + (self.total - p0)*(value - v0)/(self.max - v0))/self.total if self.max > v0 else 1.0
+
+
+class DailyQuantiles:
+
+    def __init__(self, raw, calendar, age=400*24*3600, max_gap=600, compression=COMPRESSION, backup_filename=None, backup_interval=60, persistence=None):
+        self.raw = raw
+        self.calendar = calendar
+        self.age = age
+        self.max_gap = max_gap
+        self.compression = compression
+        self.backup_filename = backup_filename
+        self.backup_interval = backup_interval
+        self.persistence = persistence
+        self.logger = logging.getLogger('timebuffer')
+        self.days = {}              # day start -> TDigest
+        self.open_point = None      # Last pushed sample, segment not yet closed
+        self.bounds = [0, 0]        # Day of the last segment
+        self.lock = threading.RLock()
+        raw.expiry_hooks.append(self.on_expire)
+        if backup_filename is not None:
+            self.restore()
+
+    def on_expire(self, view):
+        with self.lock:
+            for (ts, value) in view:
+                self.push_point(ts, value)
+            self.expire()
+        self.save()
+
+    #################################################################
+    # Feed one sample (in ts order). Closes the segment of the previous
+    # sample.
+    #
+    def push_point(self, ts, value):
+        if self.open_point is not None and ts > self.open_point[0]:
+            self.add_segment(self.days, self.bounds, self.open_point[0], ts, self.open_point[1])
+        if self.open_point is None or ts > self.open_point[0]:
+            self.open_point = (ts, value)
+
+    #################################################################
+    # Value held over [ts_from, ts_to) (at most max_gap), split at day
+    # bounds into the digests of days. bounds: [start, end] of the day
+    # of the previous segment, updated.
+    #
+    def add_segment(self, days, bounds, ts_from, ts_to, value):
+        ts_to = min(ts_to, ts_from + self.max_gap)
+        t = ts_from
+        while t < ts_to:
+            if not bounds[0] <= t < bounds[1]:
+                bounds[:] = self.calendar.day_bounds(t)
+            end = min(bounds[1], ts_to)
+            digest = days.get(bounds[0])
+            if digest is None:
+                digest = days[bounds[0]] = TDigest(self.compression)
+            digest.add(value, end - t)
+            t = end
+
+    def expire(self, now=None):
+        if now is None:
+            now = default_clock().time()
+        for day in [d for d in self.days if d < now - self.age]:
+            del self.days[day]
+
+    #################################################################
+    # Merged digest over the days starting in [ts_from, ts_to), with
+    # the samples still in the raw buffer
+    #
+    def digest(self, ts_from, ts_to):
+        raw = self.raw.snapshot()
+        with self.lock:
+            days = [d for (day, d) in self.days.items() if ts_from <= day < ts_to]
+            digest = TDigest(self.compression).merge(*days)
+            open_point = self.open_point
+
+        # Raw samples from the open point on, up to the first after ts_to
+        live = {}
+        bounds = [0, 0]
+        prev = open_point
+        for (ts, value) in raw.iter_interval(open_point[0] if open_point is not None else ts_from):
+            if prev is not None and ts > prev[0]:
+                self.add_segment(live, bounds, prev[0], ts, prev[1])
+            if ts >= ts_to:
+                break
+            prev = (ts, value)
+        return digest.merge(*[d for (day, d) in live.items() if ts_from <= day < ts_to])
+
+    #################################################################
+    # Percentiles and load-duration curve of a digest: power exceeded
+    # during each fraction of the covered time
+    #
+    def summary(self, digest):
+        if digest.total <= 0:
+            return None
+        return {
+            'hours': digest.total/3600,
+            'min': digest.min,
+            'max': digest.max,
+            'p50': digest.quantile(0.5),
+            'p95': digest.quantile(0.95),
+            'p99': digest.quantile(0.99),
+            'load_duration': [[f, digest.quantile(1 - f)] for f in LOAD_DURATION],
+        }
+
+    def day_status(self, ts):
+        (day_from, day_to) = self.calendar.day_bounds(ts)
+        return self.summary(self.digest(day_from, day_to))
+
+    def month_status(self, ts):
+        (month_from, month_to) = self.calendar.month_bounds(ts)
+        return self.summary(self.digest(month_from, month_to))
+
+    #################################################################
+    # Persistence, written behind by the persistence worker
+    #
+    def save(self):
+        if self.backup_filename is not None:
+            if self.persistence is None:
+                self.persistence = default_worker()
+            self.persistence.mark_dirty(self)
+
+    def flush(self):
+        with self.lock:
+            days = sorted((day, d.copy()) for (day, d) in self.days.items())
+            open_point = self.open_point
+        (open_ts, open_value) = open_point if open_point is not None else (0, 0)
+        data = DIGEST_HEADER.pack(DIGEST_MAGIC, 1, len(days))
+        data += OPEN_POINT.pack(open_ts, open_value, open_point is not None)
+        for (day, d) in days:
+            data += DAY_HEADER.pack(day, d.min, d.max, d.total, len(d.means)) + d.means.tobytes() + d.weights.tobytes()
+        return atomic_write(self.backup_filename, data)
+
+    def restore(self):
+        if not os.path.exists(self.backup_filename):
+            return
+        try:
+            with open(self.backup_filename, 'rb') as f:
+                data = f.read()
+            (magic, version, count) = DIGEST_HEADER.unpack_from(data, 0)
+            if magic != DIGEST_MAGIC or version != 1:
+                raise ValueError('Not a quantile digest file')
+            offset = DIGEST_HEADER.size
+            (open_ts, open_value, has_open) = OPEN_POINT.unpack_from(data, offset)
+            offset += OPEN_POINT.size
+            days = {}
+            for i in range(count):
+                (day, vmin, vmax, total, n) = DAY_HEADER.unpack_from(data, offset)
+                offset += DAY_HEADER.size
+                d = TDigest(self.compression)
+                d.means.frombytes(data[offset:offset + 8*n])
+                d.weights.frombytes(data[offset + 8*n:offset + 16*n])
+                offset += 16*n
+                (d.min, d.max, d.total) = (vmin, vmax, total)
+                days[day] = d
+            self.days = days
+            self.open_point = (open_ts, open_value) if has_open else None
+        except Exception as e:
+            self.logger.warning('Could not read quantile digests {}: {}'.format(self.backup_filename, e))
@@ -0,0 +1,315 @@
+import os
+import struct
+import bisect
+import operator
+import logging
+import threading
+from array import array
+from math import fsum
+from .persistence import atomic_write, default_worker
+from .float_tb import FloatTimeBuffer
+from .storage import ts_out
+from .clock import default_clock
+
+#####################################################################
+# Tiered retention with rollups
+#
+# Samples expiring from a raw FloatTimeBuffer are rolled up into fixed
+# buckets (per minute, per hour, ...). Each bucket holds min, max,
+# integral and covered duration of the step function through the
+# samples, so mean = integral/duration. Buckets expiring from one tier
+# are merged into the next, coarser tier. Every tier only holds data
+# older than the finer tier in front of it.
+#
+# Tiers are fed from the writer thread (through the raw buffer's expiry)
+# and queried from others, so each tier guards its columns with a lock.
+#
+COLUMNS = ('start', 'min', 'max', 'integral', 'duration')
+TIER_HEADER = struct.Struct('<4sIQdd?')       # magic, version, count, open ts, open value, has open point
+TIER_MAGIC = b'TRL1'
+
+class RollupTier:
+
+    def __init__(self, resolution, age, next_tier=None, backup_filename=None, backup_interval=60, persistence=None):
+        self.resolution = resolution
+        self.age = age
+        self.next_tier = next_tier
+        self.backup_filename = backup_filename
+        self.backup_interval = backup_interval
+        self.persistence = persistence
+        self.logger = logging.getLogger('timebuffer')
+        self.columns = {c: array('d') for c in COLUMNS}
+        self.open_point = None      # Last pushed sample, segment not yet closed
+        self.lock = threading.RLock()
+        if backup_filename is not None:
+            self.restore()
+
+    def __len__(self):
+        return len(self.columns['start'])
+
+    #################################################################
+    # Feed one sample (in ts order). Closes the segment of the previous
+    # sample.
+    #
+    def push_point(self, ts, value):
+        with self.lock:
+            if self.open_point is not None and ts > self.open_point[0]:
+                self.add_segment(self.open_point[0], ts, self.open_point[1])
+            if self.open_point is None or ts > self.open_point[0]:
+                self.open_point = (ts, value)
+
+    #################################################################
+    # Value held over [ts_from, ts_to), split over buckets
+    #
+    def add_segment(self, ts_from, ts_to, value):
+        t = ts_from
+        while t < ts_to:
+            start = self.resolution*(t//self.resolution)
+            end = min(start + self.resolution, ts_to)
+            self.add_part(start, value, value, value*(end - t), end - t)
+            t = end
+
+    #################################################################
+    # Merge a partial bucket (from a segment or a finer tier)
+    #
+    def add_part(self, start, vmin, vmax, integral, duration):
+        with self.lock:
+            c = self.columns
+            start = self.resolution*(start//self.resolution)
+            if len(c['start']) > 0 and c['start'][-1] >= start:
+                # Normally the last bucket; older ones only on late data
+                idx = len(c['start']) - 1
+                while idx > 0 and c['start'][idx] > start:
+                    idx -= 1
+                if c['start'][idx] == start:
+                    c['min'][idx] = min(c['min'][idx], vmin)
+                    c['max'][idx] = max(c['max'][idx], vmax)
+                    c['integral'][idx] += integral
+                    c['duration'][idx] += duration
+                    self.save()
+                    return
+                idx += 0 if c['start'][idx] > start else 1
+                for (k, v) in zip(COLUMNS, (start, vmin, vmax, integral, duration)):
+                    c[k].insert(idx, v)
+            else:
+                for (k, v) in zip(COLUMNS, (start, vmin, vmax, integral, duration)):
+                    c[k].append(v)
+            self.save()
+
+    #################################################################
+    # Move buckets older than age to the next tier (or drop them)
+    #
+    def expire(self, now=None):
+        with self.lock:
+            if self.age <= 0:
+                return
+            if now is None:
+                now = default_clock().time()
+
+            c = self.columns
+            n = 0
+            while n < len(c['start']) and c['start'][n] + self.resolution <= now - self.age:
+                if self.next_tier is not None:
+                    self.next_tier.add_part(c['start'][n], c['min'][n], c['max'][n], c['integral'][n], c['duration'][n])
+                n += 1
+
+            if n > 0:
+                for k in COLUMNS:
+                    del c[k][:n]
+                self.save()
+            if self.next_tier is not None:
+                self.next_tier.expire(now)
+
+    #################################################################
+    # Oldest ts covered by this tier, None if empty
+    #
+    def first_ts(self):
+        with self.lock:
+            if len(self.columns['start']) > 0:
+                return self.columns['start'][0]
+            elif self.open_point is not None:
+                return self.open_point[0]
+            return None
+
+    #################################################################
+    # Buckets ending at or before this ts are complete, later samples
+    # (late data aside) no longer fall into them. The open point closes
+    # everything before it; without one (a tier fed by a finer tier)
+    # every bucket but the last. None if empty.
+    #
+    def closed_ts(self):
+        with self.lock:
+            if self.open_point is not None:
+                return self.open_point[0]
+            elif len(self.columns['start']) > 0:
+                return self.columns['start'][-1]
+            return None
+
+    #################################################################
+    # Queries over [ts_from, ts_to). Partial buckets are prorated.
+    #
+    def integrate(self, ts_from, ts_to):
+        with self.lock:
+            c = self.columns
+            r = self.bucket_range(ts_from, ts_to)
+            if len(r) == 0:
+                sum = 0.0
+            else:
+                # Whole buckets in C, only the end buckets are prorated
+                sum = fsum(c['integral'][r.start+1:r.stop-1])
+                for idx in sorted({r.start, r.stop-1}):
+                    start = c['start'][idx]
+                    overlap = min(ts_to, start + self.resolution) - max(ts_from, start)
+                    if overlap >= self.resolution:
+                        sum += c['integral'][idx]
+                    elif c['duration'][idx] > 0:
+                        sum += c['integral'][idx] * min(1.0, overlap/c['duration'][idx])
+
+            # Open point holds its value up to ts_to (the finer tier starts there)
+            if self.open_point is not None and ts_to > self.open_point[0]:
+                sum += self.open_point[1] * (ts_to - max(ts_from, self.open_point[0]))
+            return sum
+
+    def get_extreme(self, ts_from, ts_to, column, better):
+        with self.lock:
+            c = self.columns
+            r = self.bucket_range(ts_from, ts_to)
+            best = None
+            if len(r) > 0:
+                v = (max if better(1, 0) else min)(c[column][r.start:r.stop])
+                best = [ts_out(c['start'][c[column].index(v, r.start, r.stop)]), v]
+            if self.open_point is not None and ts_to > self.open_point[0]:
+                if best is None or better(self.open_point[1], best[1]):
+                    best = [ts_out(self.open_point[0]), self.open_point[1]]
+            return best
+
+    def bucket_range(self, ts_from, ts_to):
+        starts = self.columns['start']
+        return range(bisect.bisect_left(starts, ts_from - self.resolution + 1e-9), bisect.bisect_left(starts, ts_to))
+
+    #################################################################
+    # Bucket rows in [ts_from, ts_to) as dicts
+    #
+    def rows(self, ts_from=0, ts_to=float('inf')):
+        with self.lock:
+            c = self.columns
+            return [{
+                'start': c['start'][idx],
+                'min': c['min'][idx],
+                'max': c['max'][idx],
+                'mean': c['integral'][idx]/c['duration'][idx] if c['duration'][idx] > 0 else 0,
+                'integral': c['integral'][idx],
+                'duration': c['duration'][idx],
+            } for idx in self.bucket_range(ts_from, ts_to)]
+
+    #################################################################
+    # Persistence, written behind by the persistence worker
+    #
+    def save(self):
+        if self.backup_filename is not None:
+            if self.persistence is None:
+                self.persistence = default_worker()
+            self.persistence.mark_dirty(self)
+
+    def flush(self):
+        with self.lock:
+            c = self.columns
+            (open_ts, open_value) = self.open_point if self.open_point is not None else (0, 0)
+            data = TIER_HEADER.pack(TIER_MAGIC, 1, len(c['start']), open_ts, open_value, self.open_point is not None)
+            data += b''.join(c[k].tobytes() for k in COLUMNS)
+        return atomic_write(self.backup_filename, data)
+
+    def restore(self):
+        if not os.path.exists(self.backup_filename):
+            return
+        try:
+            with open(self.backup_filename, 'rb') as f:
+                data = f.read()
+            (magic, version, count, open_ts, open_value, has_open) = TIER_HEADER.unpack_from(data, 0)
+            if magic != TIER_MAGIC or version != 1:
+                raise ValueError('Not a rollup tier file')
+            offset = TIER_HEADER.size
+            for k in COLUMNS:
+                self.columns[k] = array('d')
+                self.columns[k].frombytes(data[offset:offset + 8*count])
+                offset += 8*count
+            self.open_point = (open_ts, open_value) if has_open else None
+        except Exception as e:
+            self.logger.warning('Could not read rollup tier {}: {}'.format(self.backup_filename, e))
+
+
+#####################################################################
+# Raw FloatTimeBuffer with rollup tiers behind it
+#
+# tiers are ordered finest first; the first tier is fed with the samples
+# expiring from the raw buffer. Queries are split at the tier boundaries
+# so each part is answered by the finest tier holding it; the raw buffer
+# covers everything from its first sample on.
+#
+class TieredBuffer:
+
+    def __init__(self, raw, tiers):
+        self.raw = raw
+        self.tiers = tiers
+        raw.expiry_hooks.append(self.on_expire)
+
+    def on_expire(self, view):
+        first = self.tiers[0]
+        for (ts, value) in view:
+            first.push_point(ts, value)
+        first.expire()
+
+    #################################################################
+    # [(source, ts_from, ts_to)] covering [ts_from, ts_to), finest last
+    #
+    def split(self, ts_from, ts_to):
+        parts = []
+        raw = self.raw.snapshot()
+        cut = raw.storage.ts_at(0) if len(raw.storage) > 0 else float('inf')
+        if ts_to > cut:
+            parts.append((raw, max(ts_from, cut), ts_to))
+            ts_to = cut
+
+        for tier in self.tiers:
+            if ts_from >= ts_to:
+                break
+            first = tier.first_ts()
+            if first is None:
+                continue
+            if ts_to > first:
+                parts.append((tier, max(ts_from, first), ts_to))
+                ts_to = first
+        return parts
+
+    def integrate(self, ts_from, ts_to):
+        return sum(source.integrate(f, t) for (source, f, t) in self.split(ts_from, ts_to))
+
+    def avg(self, ts_from, ts_to):
+        parts = self.split(ts_from, ts_to)
+        covered = sum(t - f for (source, f, t) in parts)
+        if covered <= 0:
+            return 0
+        return sum(source.integrate(f, t) for (source, f, t) in parts)/covered
+
+    def get_max(self, ts_from, ts_to):
+        return self.get_extreme(ts_from, ts_to, 'max', operator.gt)
+
+    def get_min(self, ts_from, ts_to):
+        return self.get_extreme(ts_from, ts_to, 'min', operator.lt)
+
+    def get_extreme(self, ts_from, ts_to, column, better):
+        best = None
+        for (source, f, t) in reversed(self.split(ts_from, ts_to)):
+            if isinstance(source, FloatTimeBuffer):
+                e = source.get_max(f, t) if column == 'max' else source.get_min(f, t)
+            else:
+                e = source.get_extreme(f, t, column, better)
+            if e is not None and (best is None or better(e[1], best[1])):
+                best = e
+        return best
+
+    #################################################################
+    # Memory held by the tiers in bytes
+    #
+    def tier_bytes(self):
+        return sum(len(tier)*8*len(COLUMNS) for tier in self.tiers)
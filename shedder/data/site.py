@@ -0,0 +1,319 @@
+import threading
+import operator
+from .energy_calc import EnergyCalculator, epoch_to_month_ts
+from .capacity import CapacityTracker
+from .storage import ts_out
+from .float_tb import FloatTimeBuffer
+from .aggregates import RollingMean
+from .local_calendar import default_calendar
+from .status_cache import StatusCache
+from .clock import default_clock
+
+#####################################################################
+# Per-meter shards and the aggregated site view
+#
+# Each meter (HAN gateway) gets its own calculators, buffers and backup
+# files, so samples of different meters never interleave in one buffer
+# and ingest of one meter does not wait for another one's lock.
+#
+# SiteCalculator answers the status queries of EnergyCalculator for the
+# site by summing the meters' results on demand: power and energy add
+# up. The capacity tariff hours come from a site CapacityTracker over
+# the sum of the meters' registers (SiteRegister), frozen and persisted
+# like the one of each meter. With a single meter it returns that
+# meter's results as is. Before the first
+# meter is known (per_meter on a fresh start) the period status is the
+# one of a meter without readings: offline, at emulated max power.
+#
+
+#####################################################################
+# Meter id usable in file names
+#
+def meter_key(meter_id):
+    return ''.join(c if c.isalnum() or c in '-_' else '_' for c in str(meter_id))
+
+
+class MeterShards:
+
+    def __init__(self, factory):
+        self.factory = factory      # factory(meter_id) -> shard
+        self.shards = {}
+        self.lock = threading.Lock()
+
+    #################################################################
+    # Shard of meter, created on first use
+    #
+    def get(self, meter_id):
+        shard = self.shards.get(meter_id)
+        if shard is None:
+            with self.lock:
+                shard = self.shards.get(meter_id)
+                if shard is None:
+                    shard = self.factory(meter_id)
+                    self.shards[meter_id] = shard
+        return shard
+
+    def ids(self):
+        with self.lock:
+            return list(self.shards.keys())
+
+    def values(self):
+        with self.lock:
+            return list(self.shards.values())
+
+    def items(self):
+        with self.lock:
+            return list(self.shards.items())
+
+
+#####################################################################
+# Meter without readings, in memory: EnergyCalculator.period_status on
+# its empty buffers reports the metering offline and emulates max power
+#
+class OfflineMeter:
+
+    def __init__(self):
+        self.power_buffer = FloatTimeBuffer(age=7*3600)
+        self.power_buffer.register_aggregate('avg_1m', RollingMean, 60)
+        self.power_buffer.register_aggregate('avg_5m', RollingMean, 300)
+        self.energy_buffer = FloatTimeBuffer(age=24*3600, accumulated=True)
+        self.status_cache = StatusCache()
+        self.period_texts = (None, None)
+
+    insert_power = EnergyCalculator.insert_power
+    period_status = EnergyCalculator.period_status
+
+
+#####################################################################
+# Accumulated energy register of the site, the sum of the meters'
+# registers, as buffer of a CapacityTracker. The site register steps at
+# every sample of a meter by that sample's delta to the meter's
+# previous sample in the queried interval, so with one meter the
+# deltas are the meter's own.
+#
+class SiteRegister:
+
+    def __init__(self, calculators, buffers=None):
+        self.calculators = calculators
+        self.buffers = buffers
+
+    def snapshot(self):
+        return SiteRegister(self.calculators, [c.energy_buffer.snapshot() for c in self.calculators()])
+
+    #################################################################
+    # [(ts, delta to the next step)] of the site register in [from, to]
+    #
+    def deltas(self, ts_from, ts_to):
+        steps = {}          # ts -> summed delta of the samples at ts
+        for b in self.buffers:
+            (from_idx, to_idx) = b.get_interval_index(from_ts=ts_from, to_ts=ts_to)
+            samples = b.storage.iter_items(from_idx, to_idx)
+            prev = next(samples, None)
+            if prev is not None:
+                steps.setdefault(prev[0], 0.0)
+            for e in samples:
+                steps[e[0]] = steps.get(e[0], 0.0) + e[1] - prev[1]
+                prev = e
+        times = sorted(steps)
+        return [(t0, steps[t1]) for (t0, t1) in zip(times, times[1:])]
+
+    #################################################################
+    # First [ts, delta] in [from, to] where delta is better than all
+    # others, as FloatTimeBuffer.get_extreme on a register
+    #
+    def get_extreme(self, ts_from, ts_to, better=operator.gt):
+        best = None
+        for (ts, delta) in self.deltas(ts_from, ts_to):
+            if best is None or better(delta, best[1]):
+                best = [ts, delta]
+        if best is not None:
+            best[0] = ts_out(best[0])
+        return best
+
+    def get_max(self, ts_from, ts_to):
+        return self.get_extreme(ts_from, ts_to, better=operator.gt)
+
+    def get_min(self, ts_from, ts_to):
+        return self.get_extreme(ts_from, ts_to, better=operator.lt)
+
+
+#####################################################################
+# Site view over the calculators returned by calculators(). The site
+# capacity table is kept in backup_filename, if given.
+#
+class SiteCalculator:
+
+    # Summed across meters, None counts as 0
+    PERIOD_SUMS = ['power', 'power_avg_1m', 'power_avg_5m', 'energy', 'estimated_energy', 'prev_hour_energy', 'prev_hour_energy_int']
+
+    def __init__(self, calculators, backup_filename=None, backup_interval=60, persistence=None):
+        self.calculators = calculators
+        self.status_cache = StatusCache()
+        self.offline = OfflineMeter()
+        self.capacity = CapacityTracker(
+            SiteRegister(calculators),
+            calendar=default_calendar(),
+            backup_filename=backup_filename,
+            backup_interval=backup_interval,
+            persistence=persistence)
+        self.hooked = set()         # Calculators feeding self.capacity
+        self.hook_lock = threading.Lock()
+
+    #################################################################
+    # Feed the site capacity table from meters not seen before. Their
+    # samples so far are marked like new ones.
+    #
+    def hook(self, calculators):
+        with self.hook_lock:
+            new = [c for c in calculators if id(c) not in self.hooked]
+            self.hooked.update(id(c) for c in new)
+        for c in new:
+            c.energy_hooks.append(self.energy_inserted)
+            (ts, values) = c.energy_buffer.snapshot().storage.columns()
+            self.energy_inserted(ts)
+
+    #################################################################
+    # Energy samples at timestamps were inserted into a meter. As in
+    # CapacityTracker.on_insert_many the first sample of each hour is
+    # marked, with the previous sample of every meter: the site register
+    # steps at those and one of them starts the changed delta.
+    #
+    def energy_inserted(self, timestamps):
+        hours = {}
+        for ts in timestamps:
+            h = ts//3600
+            if h not in hours or ts < hours[h]:
+                hours[h] = ts
+
+        buffers = [c.energy_buffer for c in self.calculators()]
+        with self.capacity.lock:
+            for ts in hours.values():
+                self.capacity.mark(ts)
+                for b in buffers:
+                    idx = b.get_index(ts)
+                    if idx > 0:
+                        self.capacity.mark(b.storage.ts_at(idx-1))
+
+    #################################################################
+    # Energy and power status of the period holding ts, see
+    # EnergyCalculator.period_status. Each meter emulates max_energy
+    # while it is offline, so an offline sub-meter errs on the safe side.
+    #
+    def period_status(self, max_energy, ts=None, duration=3600, max_offline_time=600):
+        calculators = self.calculators()
+        if len(calculators) == 0:
+            calculators = [self.offline]
+        if len(calculators) == 1:
+            return calculators[0].period_status(max_energy, ts=ts, duration=duration, max_offline_time=max_offline_time)
+
+        if ts is None:
+            ts = int(default_clock().time())
+        else:
+            ts = int(ts)
+
+        statuses = [c.period_status(max_energy, ts=ts, duration=duration, max_offline_time=max_offline_time) for c in calculators]
+        ret = dict(statuses[0])
+        for k in self.PERIOD_SUMS:
+            ret[k] = sum(s[k] or 0 for s in statuses)
+        ret['metering_offline'] = any(s['metering_offline'] for s in statuses)
+
+        # Oldest reading of any meter
+        for k in ['power_ts', 'prev_hour_energy_ts']:
+            ret[k] = min(s[k] for s in statuses)
+            ret[k + '_text'] = default_calendar().ymd_hms(ret[k])
+
+        ret['remaining_energy'] = max_energy - ret['energy']
+        ret['remaining_max_power'] = 3600*(max_energy - ret['energy'])/ret['remaining_time']
+        ret['meters'] = len(statuses)
+        return ret
+
+    #################################################################
+    # Energy (kWh) and average power over [ts_from, ts_to), summed.
+    # Max and min power do not add up across meters and are left out.
+    #
+    def history_status(self, ts_from, ts_to):
+        calculators = self.calculators()
+        if len(calculators) == 1:
+            return calculators[0].history_status(ts_from, ts_to)
+
+        statuses = [c.history_status(ts_from, ts_to) for c in calculators]
+        return {
+            'ts_from': ts_from,
+            'ts_to': ts_to,
+            'energy': sum(s['energy'] for s in statuses),
+            'power_avg': sum(s['power_avg'] for s in statuses),
+        }
+
+    #################################################################
+    # Site power integral over [ts_from, ts_to]
+    #
+    def integrate(self, ts_from, ts_to):
+        return sum(c.power_buffer.snapshot().integrate(ts_from, ts_to) for c in self.calculators())
+
+    #################################################################
+    # Power percentiles, see EnergyCalculator.load_status. Quantiles of
+    # the meters do not add up, so several meters are listed each.
+    #
+    def load_status(self, ts=None):
+        calculators = self.calculators()
+        if len(calculators) == 1:
+            return calculators[0].load_status(ts)
+        return {'meters': [c.load_status(ts) for c in calculators]}
+
+    #################################################################
+    # Top three daily max/min hourly site energies of this and the
+    # previous month from the site capacity table, see
+    # EnergyCalculator.monthly_status. The meters feed the table once
+    # there is more than one.
+    #
+    def monthly_status(self, ts=None):
+        calculators = self.calculators()
+        if len(calculators) == 1:
+            return calculators[0].monthly_status(ts)
+        self.hook(calculators)
+
+        if ts is None:
+            ts = int(default_clock().time())
+        else:
+            ts = int(ts)
+
+        (ts_from, ts_to) = epoch_to_month_ts(ts)
+        (prev_from, prev_to) = epoch_to_month_ts(ts_from-3600)
+
+        this_key = ('month', ts_from, self.capacity.revision(ts_from))
+        this_month = self.status_cache.get(this_key, lambda: self.month_status(ts_from))
+        prev_key = ('month', prev_from, self.capacity.revision(prev_from))
+        prev_month = self.status_cache.get(prev_key, lambda: self.month_status(prev_from))
+
+        return {
+            'this_month': this_month,
+            'prev_month': prev_month
+        }
+
+    def month_status(self, ts):
+        return self.format_month(*self.capacity.period_lists(ts))
+
+    format_month = EnergyCalculator.format_month
+
+    #################################################################
+    # Site energy (kWh) of the hours starting in [ts_from, ts_to) as
+    # {hour start: energy}. Hours count where any meter has readings
+    # around them.
+    #
+    def hourly_energy(self, ts_from, ts_to, calculators=None):
+        if calculators is None:
+            calculators = self.calculators()
+        buffers = [c.energy_buffer.snapshot() for c in calculators]
+        buffers = [b for b in buffers if len(b.storage) > 1]
+        if len(buffers) > 0:
+            first = min(b.storage.ts_at(0) for b in buffers)
+            last = max(b.storage.ts_at(len(b.storage)-1) for b in buffers)
+            starts = [h for h in range(ts_from, ts_to, 3600) if h >= first and h+3600 <= last]
+        else:
+            starts = []
+        ends = [h+3600 for h in starts]
+
+        energies = [0.0]*len(starts)
+        for b in buffers:
+            energies = [e + d for (e, d) in zip(energies, b.integrate_many(starts, ends))]
+        return dict(zip(starts, energies))
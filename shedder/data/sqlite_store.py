@@ -0,0 +1,384 @@
+import logging
+import operator
+import sqlite3
+import threading
+from .persistence import default_worker
+from .local_calendar import default_calendar
+from .clock import default_clock
+
+DAY = 3600*24
+
+#####################################################################
+# Long-term store in SQLite
+#
+# SqliteBuffer keeps a series of (ts, value) samples in a table of a
+# local SQLite database (WAL mode, one row per sample, primary key
+# (series, ts)) and answers the FloatTimeBuffer queries with SQL range
+# queries, so years of samples are never loaded into memory. Inserts
+# are queued and committed in batches by the persistence worker
+# (flush). A query commits what is still queued first, so it sees every
+# sample handed over, e.g. just expired from the hot buffer of a
+# LongTermBuffer.
+#
+# Each thread has its own connection: with WAL, readers do not wait
+# for the writer.
+#
+# LongTermBuffer puts a FloatTimeBuffer (the hot window used by the
+# control loop) in front of a SqliteBuffer fed with the samples expiring
+# from it, like TieredBuffer does with the rollup tiers. Queries are
+# split at the first sample of the hot buffer.
+#
+BUSY_TIMEOUT = 10.0
+
+class SqliteBuffer:
+
+    def __init__(self, filename, series, accumulated=False, age=-1, backup_interval=60, persistence=None):
+        self.filename = filename
+        self.series = series
+        self.accumulated = accumulated
+        self.age = age
+        self.backup_filename = filename     # For the persistence worker
+        self.backup_interval = backup_interval
+        self.persistence = persistence
+        self.logger = logging.getLogger('timebuffer')
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.pending = []           # (ts, value) not committed yet
+        self.crops = []             # (from_ts, to_ts) not committed yet
+        self.flush_lock = threading.Lock()  # Commits in queue order
+        self.version = 0
+
+        db = self.connection()
+        db.execute('CREATE TABLE IF NOT EXISTS samples (series TEXT NOT NULL, ts REAL NOT NULL, value REAL NOT NULL, PRIMARY KEY (series, ts)) WITHOUT ROWID')
+        db.commit()
+
+    #################################################################
+    # Connection of the calling thread
+    #
+    def connection(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.filename, timeout=BUSY_TIMEOUT)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self.local.db = db
+        return db
+
+    def query(self, sql, args=()):
+        self.sync()
+        return self.connection().execute(sql, (self.series,) + tuple(args)).fetchall()
+
+    #################################################################
+    # Commit queued writes before a query
+    #
+    def sync(self):
+        if len(self.pending) > 0 or len(self.crops) > 0:
+            self.flush()
+
+    def __len__(self):
+        return self.query('SELECT COUNT(*) FROM samples WHERE series = ?')[0][0]
+
+    #################################################################
+    # Writes, committed by flush()
+    #
+    def insert_sorted(self, ts, value, overwrite=True):
+        self.insert_many([(ts, value)])
+
+    def insert_many(self, ts_values, overwrite=True):
+        with self.lock:
+            self.pending.extend(ts_values)
+            self.version += 1
+        self.save()
+
+    def crop_interval(self, from_ts=0, to_ts=0):
+        with self.lock:
+            self.crops.append((from_ts, to_ts))
+            self.version += 1
+        self.save()
+
+    def save(self):
+        if self.persistence is None:
+            self.persistence = default_worker()
+        self.persistence.mark_dirty(self)
+
+    #################################################################
+    # Commit queued inserts and crops in one transaction, expire
+    # samples older than age. Returns rows written.
+    #
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                (pending, self.pending) = (self.pending, [])
+                (crops, self.crops) = (self.crops, [])
+
+            db = self.connection()
+            try:
+                with db:
+                    db.executemany('INSERT OR REPLACE INTO samples (series, ts, value) VALUES (?, ?, ?)', ((self.series, ts, value) for (ts, value) in pending))
+                    for (from_ts, to_ts) in crops:
+                        db.execute('DELETE FROM samples WHERE series = ? AND (ts < ? OR ts > ?)', (self.series, from_ts, to_ts if to_ts > 0 else float('inf')))
+                    if self.age > 0:
+                        db.execute('DELETE FROM samples WHERE series = ? AND ts < ?', (self.series, default_clock().time() - self.age))
+            except Exception:
+                # Keep them for the next attempt
+                with self.lock:
+                    self.pending[:0] = pending
+                    self.crops[:0] = crops
+                raise
+            return len(pending)
+
+    #################################################################
+    # Queries, see FloatTimeBuffer
+    #
+    def get_last_tuple(self):
+        rows = self.query('SELECT ts, value FROM samples WHERE series = ? ORDER BY ts DESC LIMIT 1')
+        return list(rows[0]) if len(rows) > 0 else None
+
+    def get_first_tuple(self):
+        rows = self.query('SELECT ts, value FROM samples WHERE series = ? ORDER BY ts LIMIT 1')
+        return list(rows[0]) if len(rows) > 0 else None
+
+    def get_interval(self, from_ts=0, to_ts=0):
+        if to_ts <= 0:
+            to_ts = float('inf')
+        return [list(r) for r in self.query('SELECT ts, value FROM samples WHERE series = ? AND ts >= ? AND ts <= ? ORDER BY ts', (from_ts, to_ts))]
+
+    #################################################################
+    # Samples around ts: (last with ts' <= ts, first with ts' >= ts)
+    #
+    def neighbours(self, ts):
+        pre = self.query('SELECT ts, value FROM samples WHERE series = ? AND ts <= ? ORDER BY ts DESC LIMIT 1', (ts,))
+        post = self.query('SELECT ts, value FROM samples WHERE series = ? AND ts >= ? ORDER BY ts LIMIT 1', (ts,))
+        return (pre[0] if len(pre) > 0 else None, post[0] if len(post) > 0 else None)
+
+    def get_value(self, ts, selection='inter'):
+        (pre, post) = self.neighbours(ts)
+        if pre is None and post is None:
+            return 0
+        if pre is None:
+            return post[1]
+        if post is None or pre[0] == ts:
+            return pre[1]
+
+        selection = selection.lower()
+        if selection == 'pre':
+            return pre[1]
+        elif selection == 'post':
+            return post[1]
+        elif selection == 'avg':
+            return (post[1]+pre[1])/2
+        elif selection == 'inter':
+            return pre[1] + (post[1]-pre[1])*(ts-pre[0])/(post[0]-pre[0])
+        return 0
+
+    #################################################################
+    # Integral over [ts_from, ts_to]: register difference for
+    # accumulated series, else the step function through the samples
+    # (first value held back to ts_from, last one up to ts_to)
+    #
+    def integrate(self, ts_from, ts_to):
+        if self.accumulated:
+            return self.get_value(ts_to) - self.get_value(ts_from)
+
+        (pre, post) = self.neighbours(ts_from)
+        start = pre if pre is not None else post
+        if start is None:
+            return 0
+        rows = self.query(
+            'SELECT COALESCE(SUM(value * (next_ts - ts)), 0) FROM ('
+            ' SELECT ts, value, LEAD(ts) OVER (ORDER BY ts) AS next_ts FROM samples'
+            ' WHERE series = ? AND ts >= ? AND ts <= ?) WHERE next_ts IS NOT NULL', (start[0], ts_to))
+        sum = rows[0][0]
+        last = self.neighbours(ts_to)[0] if ts_to >= start[0] else None
+        if last is None:
+            last = start
+
+        # Step through start and last, plus the ends
+        sum += start[1]*(start[0] - ts_from) if pre is None else -start[1]*(ts_from - start[0])
+        sum += last[1]*(ts_to - last[0])
+        return sum
+
+    def avg(self, ts_from, ts_to):
+        dt = ts_to - ts_from
+        if dt == 0:
+            return 0
+        return self.integrate(ts_from, ts_to)/dt
+
+    #################################################################
+    # Extremes over the samples in [ts_from, ts_to], first [ts, value]
+    # of the best; accumulated series compare deltas to the next sample
+    #
+    def get_max(self, ts_from, ts_to):
+        return self.get_extreme(ts_from, ts_to, better=operator.gt)
+
+    def get_min(self, ts_from, ts_to):
+        return self.get_extreme(ts_from, ts_to, better=operator.lt)
+
+    def get_extreme(self, ts_from, ts_to, better=operator.gt):
+        return self.period_extremes([(ts_from, ts_to)], better)[0]
+
+    #################################################################
+    # Extreme of each (from, to) period, None for periods without
+    # samples, one query per period on the ts index. Accumulated series
+    # compare the deltas (a window over the period). Ties go to the
+    # first, by ordering on (value, ts): the row a bare column next to
+    # MAX()/MIN() comes from is arbitrary among ties.
+    #
+    def period_extremes(self, periods, better=operator.gt):
+        order = 'DESC' if better(1, 0) else 'ASC'
+        if self.accumulated:
+            sql = ('SELECT ts, value FROM ('
+                   ' SELECT ts, LEAD(value) OVER (ORDER BY ts) - value AS value FROM samples'
+                   ' WHERE series = ? AND ts >= ? AND ts <= ?) WHERE value IS NOT NULL'
+                   ' ORDER BY value {}, ts ASC LIMIT 1'.format(order))
+        else:
+            sql = ('SELECT ts, value FROM samples WHERE series = ? AND ts >= ? AND ts <= ?'
+                   ' ORDER BY value {}, ts ASC LIMIT 1'.format(order))
+
+        result = []
+        for (f, t) in periods:
+            rows = self.query(sql, (f, t))
+            result.append(list(rows[0]) if len(rows) > 0 else None)
+        return result
+
+    #################################################################
+    # Sorted extremes per period, see FloatTimeBuffer. Days are local
+    # calendar days.
+    #
+    def periods(self, ts_from, ts_to, duration=DAY):
+        if duration == DAY:
+            grid = default_calendar().day_grid(ts_from, ts_to)
+            return list(zip(grid, grid[1:]))
+        return [(f, f+duration) for f in range(ts_from, ts_to, duration)]
+
+    def get_period_max_list(self, ts_from, ts_to, duration=DAY):
+        values = [e for e in self.period_extremes(self.periods(ts_from, ts_to, duration), operator.gt) if e is not None]
+        return sorted(values, key=operator.itemgetter(1), reverse=True)
+
+    def get_period_min_list(self, ts_from, ts_to, duration=DAY):
+        values = [e for e in self.period_extremes(self.periods(ts_from, ts_to, duration), operator.lt) if e is not None]
+        return sorted(values, key=operator.itemgetter(1), reverse=False)
+
+
+#####################################################################
+# Hot FloatTimeBuffer in front of a SqliteBuffer holding what expired
+# from it
+#
+class LongTermBuffer:
+
+    def __init__(self, hot, cold):
+        self.hot = hot
+        self.cold = cold
+        self.accumulated = hot.accumulated
+        hot.expiry_hooks.append(self.on_expire)
+
+    def on_expire(self, view):
+        self.cold.insert_many([(ts, value) for (ts, value) in view])
+
+    #################################################################
+    # First ts of the hot buffer (snapshot), inf if empty
+    #
+    def cut(self):
+        hot = self.hot.snapshot()
+        return (hot, hot.storage.ts_at(0) if len(hot.storage) > 0 else float('inf'))
+
+    def source(self, ts):
+        (hot, cut) = self.cut()
+        return hot if ts >= cut else self.cold
+
+    def get_last_tuple(self):
+        last = self.hot.snapshot().get_last_tuple()
+        return last if last is not None else self.cold.get_last_tuple()
+
+    def get_value(self, ts, selection='inter'):
+        (hot, cut) = self.cut()
+        if ts >= cut or self.cold.get_last_tuple() is None:
+            return hot.get_value(ts, selection)
+
+        # Between the last cold and the first hot sample
+        (pre, post) = self.cold.neighbours(ts)
+        if post is None and cut < float('inf'):
+            post = hot.storage.item(0)
+            if selection.lower() == 'inter':
+                return pre[1] + (post[1]-pre[1])*(ts-pre[0])/(post[0]-pre[0])
+            elif selection.lower() == 'post':
+                return post[1]
+            elif selection.lower() == 'avg':
+                return (post[1]+pre[1])/2
+        return self.cold.get_value(ts, selection)
+
+    def get_interval(self, from_ts=0, to_ts=0):
+        (hot, cut) = self.cut()
+        result = []
+        if from_ts < cut:
+            result = self.cold.get_interval(from_ts, min(to_ts, cut - 1e-9) if to_ts > 0 else cut - 1e-9)
+        if to_ts <= 0 or to_ts >= cut:
+            result += hot.get_interval(max(from_ts, cut), to_ts)
+        return result
+
+    def integrate(self, ts_from, ts_to):
+        if self.accumulated:
+            return self.get_value(ts_to) - self.get_value(ts_from)
+
+        (hot, cut) = self.cut()
+        if ts_from >= cut or self.cold.get_last_tuple() is None:
+            return hot.integrate(ts_from, ts_to)
+        if ts_to <= cut:
+            return self.cold.integrate(ts_from, ts_to)
+        return self.cold.integrate(ts_from, cut) + hot.integrate(cut, ts_to)
+
+    def avg(self, ts_from, ts_to):
+        dt = ts_to - ts_from
+        if dt == 0:
+            return 0
+        return self.integrate(ts_from, ts_to)/dt
+
+    def get_max(self, ts_from, ts_to):
+        return self.get_extreme(ts_from, ts_to, operator.gt)
+
+    def get_min(self, ts_from, ts_to):
+        return self.get_extreme(ts_from, ts_to, operator.lt)
+
+    def get_extreme(self, ts_from, ts_to, better=operator.gt):
+        return self.period_extremes([(ts_from, ts_to)], better)[0]
+
+    #################################################################
+    # Periods before the cut in one SQL query, the others from the hot
+    # buffer. For accumulated buffers the delta from the last cold to
+    # the first hot sample counts for periods holding both.
+    #
+    def period_extremes(self, periods, better=operator.gt):
+        (hot, cut) = self.cut()
+        result = [None]*len(periods)
+
+        cold = [i for (i, (f, t)) in enumerate(periods) if f < cut]
+        for (i, e) in zip(cold, self.cold.period_extremes([(periods[i][0], min(periods[i][1], cut)) for i in cold], better)):
+            result[i] = e
+
+        boundary = None
+        if self.accumulated and cut < float('inf'):
+            last = self.cold.get_last_tuple()
+            if last is not None:
+                first = hot.storage.item(0)
+                boundary = [last[0], first[1] - last[1], first[0]]
+
+        for (i, (f, t)) in enumerate(periods):
+            candidates = [result[i]]
+            if t >= cut:
+                candidates.append(hot.get_extreme(max(f, cut), t, better))
+            if boundary is not None and f <= boundary[0] and boundary[2] <= t:
+                candidates.append(boundary[:2])
+            best = None
+            for e in candidates:
+                if e is not None and (best is None or better(e[1], best[1]) or (e[1] == best[1] and e[0] < best[0])):
+                    best = e
+            result[i] = best
+        return result
+
+    def get_period_max_list(self, ts_from, ts_to, duration=DAY):
+        values = [e for e in self.period_extremes(self.cold.periods(ts_from, ts_to, duration), operator.gt) if e is not None]
+        return sorted(values, key=operator.itemgetter(1), reverse=True)
+
+    def get_period_min_list(self, ts_from, ts_to, duration=DAY):
+        values = [e for e in self.period_extremes(self.cold.periods(ts_from, ts_to, duration), operator.lt) if e is not None]
+        return sorted(values, key=operator.itemgetter(1), reverse=False)
@@ -0,0 +1,57 @@
+import threading
+from collections import OrderedDict
+
+#####################################################################
+# Memoizing cache for status queries
+#
+# Results are keyed by the query and its arguments plus the versions
+# (TimeBuffer.version) of the buffers they were computed from, so any
+# change to the data makes a new key and the stale entry ages out of
+# the LRU. Results for closed periods are keyed without versions and
+# stay valid. Cached results are shared: callers must not modify them.
+#
+STATUS_CACHE_SIZE = 64
+
+class StatusCache:
+
+    def __init__(self, size=STATUS_CACHE_SIZE):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    #################################################################
+    # Cached result for key, else compute() (without the lock held)
+    #
+    def get(self, key, compute):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+
+        value = compute()
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return value
+
+    #################################################################
+    # Drop the entries with match(key) true
+    #
+    def discard(self, match):
+        with self.lock:
+            for key in [k for k in self.entries if match(k)]:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def metrics(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries)}
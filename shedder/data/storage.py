@@ -0,0 +1,1020 @@
+import bisect
+import copy
+from array import array
+from collections import OrderedDict
+from math import fsum
+from operator import itemgetter, mul, sub
+from .gorilla import encode_chunk, decode_chunk
+
+#####################################################################
+# Storage backends for TimeBuffer
+#
+# A backend holds the (ts, value) samples sorted by ts and is addressed
+# by index. TimeBuffer only talks to the methods below, so the list and
+# the columnar layout are interchangeable.
+#
+# * 'list':    one [ts, value] list per sample (original layout, any value type)
+# * 'columns': two compact array('d') columns (floats only, ~16 bytes/sample)
+# * 'gorilla': 'columns' for the recent samples, older ones sealed into
+#              Gorilla-compressed chunks (floats only, ~2-5 bytes/sample)
+# * 'partitioned': columns split into fixed time partitions (floats only)
+#
+# Expired samples leave through a moving head index. The dead prefix is
+# compacted away once it is larger than the live part, so dropping from
+# the head is amortized O(1).
+#
+# view() publishes the current samples read-only for buffer snapshots:
+# the view shares the containers and is bounded to the length at the
+# time, so later appends do not show in it. Any other change (insert,
+# replace, compaction, crop) first gives the storage private copies of
+# whatever a view shares (copy on write), so in-order ingest never
+# copies.
+#
+COMPACT_MIN = 1024
+
+#####################################################################
+# Timestamps are held as doubles by the float backends. Whole seconds
+# are handed out as int, as the 'list' backend (and so the published
+# status) always had them.
+#
+def ts_out(ts):
+    if isinstance(ts, float) and ts.is_integer():
+        return int(ts)
+    return ts
+
+class ListStorage:
+
+    kind = 'list'
+
+    def __init__(self, items=None):
+        self.items = []
+        self.head = 0
+        self.shared = False         # items shared with a view
+        if items is not None:
+            self.load(items)
+
+    def __len__(self):
+        return len(self.items) - self.head
+
+    #################################################################
+    # Element access
+    #
+    def ts_at(self, idx):
+        return self.items[self.head+idx][0]
+
+    def value_at(self, idx):
+        return self.items[self.head+idx][1]
+
+    def item(self, idx):
+        e = self.items[self.head+idx]
+        return [e[0], e[1]]
+
+    #################################################################
+    # First index in [lo, hi) with ts >= provided ts
+    #
+    def bisect_left(self, ts, lo=0, hi=None):
+        if hi is None:
+            hi = len(self)
+        return bisect.bisect_left(self.items, ts, self.head+lo, self.head+hi, key=itemgetter(0)) - self.head
+
+    #################################################################
+    # Modification
+    #
+    def insert(self, idx, ts, value):
+        self.detach()
+        self.items.insert(self.head+idx, [ts, value])
+
+    def replace(self, idx, ts, value):
+        self.detach()
+        self.items[self.head+idx] = [ts, value]
+
+    def append(self, ts, value):
+        self.items.append([ts, value])
+
+    #################################################################
+    # Drop n oldest samples, amortized O(1)
+    #
+    def drop_head(self, n):
+        self.head += min(max(n, 0), len(self))
+        if self.head >= COMPACT_MIN and 2*self.head >= len(self.items):
+            self.compact()
+
+    def compact(self):
+        self.detach()
+        if self.head > 0:
+            del self.items[:self.head]
+            self.head = 0
+
+    #################################################################
+    # Keep [from_idx, to_idx) only
+    #
+    def keep(self, from_idx, to_idx):
+        self.items = self.items[self.head+from_idx:self.head+to_idx]
+        self.head = 0
+        self.shared = False
+
+    #################################################################
+    # Copy of [from_idx, to_idx) as list of [ts, value]
+    #
+    def slice(self, from_idx, to_idx):
+        return copy.deepcopy(self.items[self.head+from_idx:self.head+to_idx])
+
+    def to_list(self):
+        return self.slice(0, len(self))
+
+    #################################################################
+    # Iterate (ts, value) over [from_idx, to_idx) without copying
+    #
+    def iter_items(self, from_idx, to_idx):
+        items = self.items
+        return ((e[0], e[1]) for e in map(items.__getitem__, range(self.head+from_idx, self.head+to_idx)))
+
+    def load(self, items):
+        self.items = [[e[0], e[1]] for e in items]
+        self.head = 0
+        self.shared = False
+
+    #################################################################
+    # Column import/export, (ts, values)
+    #
+    def load_columns(self, ts, values):
+        self.items = [[t, v] for (t, v) in zip(ts, values)]
+        self.head = 0
+        self.shared = False
+
+    def columns(self):
+        live = self.items[self.head:]
+        return (array('d', (e[0] for e in live)), array('d', (e[1] for e in live)))
+
+    #################################################################
+    # Independent copy of the live samples (entries are never modified
+    # in place, so they are shared)
+    #
+    def copy(self):
+        storage = ListStorage()
+        storage.items = self.items[self.head:len(self)+self.head]
+        return storage
+
+    #################################################################
+    # Read-only view of the current samples, see above. detach() gives
+    # the storage a private list before a change other than an append.
+    #
+    def view(self):
+        self.shared = True
+        return ListView(self.items, self.head, len(self.items))
+
+    def detach(self):
+        if self.shared:
+            self.items = self.items[self.head:]
+            self.head = 0
+            self.shared = False
+
+
+class ListView(ListStorage):
+
+    def __init__(self, items, head, end):
+        self.items = items
+        self.head = head
+        self.end = end
+        self.shared = False
+
+    def __len__(self):
+        return self.end - self.head
+
+    def columns(self):
+        live = self.items[self.head:self.end]
+        return (array('d', (e[0] for e in live)), array('d', (e[1] for e in live)))
+
+    def view(self):
+        return self
+
+
+class ColumnStorage:
+
+    kind = 'columns'
+
+    def __init__(self, items=None):
+        self.ts = array('d')
+        self.values = array('d')
+        self.head = 0
+        self.shared = False         # Columns shared with a view
+        if items is not None:
+            self.load(items)
+
+    def __len__(self):
+        return len(self.ts) - self.head
+
+    #################################################################
+    # Element access
+    #
+    def ts_at(self, idx):
+        return self.ts[self.head+idx]
+
+    def value_at(self, idx):
+        return self.values[self.head+idx]
+
+    def item(self, idx):
+        return [ts_out(self.ts[self.head+idx]), self.values[self.head+idx]]
+
+    #################################################################
+    # First index in [lo, hi) with ts >= provided ts
+    #
+    def bisect_left(self, ts, lo=0, hi=None):
+        if hi is None:
+            hi = len(self)
+        return bisect.bisect_left(self.ts, ts, self.head+lo, self.head+hi) - self.head
+
+    #################################################################
+    # Modification
+    #
+    def insert(self, idx, ts, value):
+        self.detach()
+        self.ts.insert(self.head+idx, ts)
+        self.values.insert(self.head+idx, value)
+
+    def replace(self, idx, ts, value):
+        self.detach()
+        self.ts[self.head+idx] = ts
+        self.values[self.head+idx] = value
+
+    def append(self, ts, value):
+        self.ts.append(ts)
+        self.values.append(value)
+
+    #################################################################
+    # Drop n oldest samples, amortized O(1)
+    #
+    def drop_head(self, n):
+        self.head += min(max(n, 0), len(self))
+        if self.head >= COMPACT_MIN and 2*self.head >= len(self.ts):
+            self.compact()
+
+    def compact(self):
+        self.detach()
+        if self.head > 0:
+            del self.ts[:self.head]
+            del self.values[:self.head]
+            self.head = 0
+
+    #################################################################
+    # Keep [from_idx, to_idx) only
+    #
+    def keep(self, from_idx, to_idx):
+        self.detach()
+        del self.ts[self.head+to_idx:]
+        del self.values[self.head+to_idx:]
+        del self.ts[:self.head+from_idx]
+        del self.values[:self.head+from_idx]
+        self.head = 0
+
+    #################################################################
+    # Copy of [from_idx, to_idx) as list of [ts, value]
+    #
+    def slice(self, from_idx, to_idx):
+        from_idx += self.head
+        to_idx += self.head
+        return [[ts_out(t), v] for (t, v) in zip(self.ts[from_idx:to_idx], self.values[from_idx:to_idx])]
+
+    def to_list(self):
+        return self.slice(0, len(self))
+
+    #################################################################
+    # Iterate (ts, value) over [from_idx, to_idx) without copying
+    #
+    def iter_items(self, from_idx, to_idx):
+        r = range(self.head+from_idx, self.head+to_idx)
+        return zip(map(self.ts.__getitem__, r), map(self.values.__getitem__, r))
+
+    def load(self, items):
+        self.ts = array('d', (e[0] for e in items))
+        self.values = array('d', (e[1] for e in items))
+        self.head = 0
+        self.shared = False
+
+    #################################################################
+    # Column import/export, (ts, values). Arrays are taken over as is
+    #
+    def load_columns(self, ts, values):
+        self.ts = ts if isinstance(ts, array) else array('d', ts)
+        self.values = values if isinstance(values, array) else array('d', values)
+        self.head = 0
+        self.shared = False
+
+    def columns(self):
+        return (self.ts[self.head:], self.values[self.head:])
+
+    #################################################################
+    # Independent copy of the live samples
+    #
+    def copy(self):
+        storage = ColumnStorage()
+        (storage.ts, storage.values) = self.columns()
+        return storage
+
+    #################################################################
+    # Read-only view of the current samples, see above. detach() gives
+    # the storage private columns before a change other than an append.
+    #
+    def view(self):
+        self.shared = True
+        return ColumnView(self.ts, self.values, self.head, len(self.ts))
+
+    def detach(self):
+        if self.shared:
+            (self.ts, self.values) = self.columns()
+            self.head = 0
+            self.shared = False
+
+
+#####################################################################
+# Columns [head, end) of ts and values, e.g. of a ColumnStorage or a
+# frame buffer channel
+#
+class ColumnView(ColumnStorage):
+
+    def __init__(self, ts, values, head, end):
+        self.ts = ts
+        self.values = values
+        self.head = head
+        self.end = end
+        self.shared = False
+
+    def __len__(self):
+        return self.end - self.head
+
+    def columns(self):
+        return (self.ts[self.head:self.end], self.values[self.head:self.end])
+
+    def view(self):
+        return self
+
+
+#####################################################################
+# Columns with older samples sealed into compressed chunks
+#
+# Samples are addressed by absolute position (head + idx). Chunk k holds
+# positions [offsets[k], offsets[k+1]) and the uncompressed tail starts
+# at tail_start. While the tail holds 2*CHUNK_SIZE samples or more,
+# each append seals its oldest CHUNK_SIZE, so at least CHUNK_SIZE recent
+# samples stay uncompressed for appends and queries near now. Loading
+# does not seal: a restored buffer is compressed over the next appends
+# (one chunk each) instead of stalling the start. Chunks are decoded on
+# access into a small LRU cache; changes inside a chunk re-encode it.
+#
+CHUNK_SIZE = 1024
+CHUNK_CACHE = 8
+
+class CompressedStorage:
+
+    kind = 'gorilla'
+
+    def __init__(self, items=None):
+        self.clear()
+        if items is not None:
+            self.load(items)
+
+    def clear(self):
+        self.chunks = []            # Encoded chunks
+        self.offsets = []           # Absolute position of first sample per chunk
+        self.last_ts = array('d')   # Last ts per chunk
+        self.ts = array('d')        # Uncompressed tail
+        self.values = array('d')
+        self.tail_start = 0
+        self.head = 0
+        self.cache = OrderedDict()  # Chunk offset -> decoded (ts, values), not modified
+        self.shared = False         # Containers shared with a view
+
+    def __len__(self):
+        return self.tail_start + len(self.ts) - self.head
+
+    #################################################################
+    # Bytes held by samples (chunks and tail)
+    #
+    def nbytes(self):
+        return sum(len(c) for c in self.chunks) + 16*len(self.ts)
+
+    #################################################################
+    # Decoded chunk k, cached
+    #
+    def decoded(self, k):
+        offset = self.offsets[k]
+        columns = self.cache.pop(offset, None)
+        if columns is None:
+            columns = decode_chunk(self.chunks[k])
+        self.cache[offset] = columns
+        if len(self.cache) > CHUNK_CACHE:
+            try:
+                self.cache.popitem(last=False)
+            except KeyError:
+                # Emptied by another reader of a shared snapshot
+                pass
+        return columns
+
+    #################################################################
+    # (columns, position within) for absolute position a
+    #
+    def locate(self, a):
+        if a >= self.tail_start:
+            return ((self.ts, self.values), a - self.tail_start)
+        k = bisect.bisect_right(self.offsets, a) - 1
+        return (self.decoded(k), a - self.offsets[k])
+
+    #################################################################
+    # Element access
+    #
+    def ts_at(self, idx):
+        a = self.head + idx
+        if a >= self.tail_start:
+            return self.ts[a - self.tail_start]
+        (columns, i) = self.locate(a)
+        return columns[0][i]
+
+    def value_at(self, idx):
+        a = self.head + idx
+        if a >= self.tail_start:
+            return self.values[a - self.tail_start]
+        (columns, i) = self.locate(a)
+        return columns[1][i]
+
+    def item(self, idx):
+        (columns, i) = self.locate(self.head + idx)
+        return [ts_out(columns[0][i]), columns[1][i]]
+
+    #################################################################
+    # First index in [lo, hi) with ts >= provided ts. The live samples
+    # are sorted, so the global position clamped to [lo, hi] is the
+    # answer. Expired samples before the head need not be (late inserts
+    # go in after them), so the search starts at the head.
+    #
+    def bisect_left(self, ts, lo=0, hi=None):
+        if hi is None:
+            hi = len(self)
+        k = bisect.bisect_left(self.last_ts, ts)
+        if k < len(self.chunks):
+            a = self.offsets[k] + bisect.bisect_left(self.decoded(k)[0], ts, max(self.head - self.offsets[k], 0))
+        else:
+            a = self.tail_start + bisect.bisect_left(self.ts, ts, max(self.head - self.tail_start, 0))
+        return min(max(a - self.head, lo), hi)
+
+    #################################################################
+    # Modification
+    #
+    def insert(self, idx, ts, value):
+        self.detach()
+        a = self.head + idx
+        if a >= self.tail_start:
+            self.ts.insert(a - self.tail_start, ts)
+            self.values.insert(a - self.tail_start, value)
+            return
+
+        k = bisect.bisect_right(self.offsets, a) - 1
+        (chunk_ts, chunk_values) = [array('d', c) for c in self.decoded(k)]
+        chunk_ts.insert(a - self.offsets[k], ts)
+        chunk_values.insert(a - self.offsets[k], value)
+        self.reseal(k, chunk_ts, chunk_values)
+        for j in range(k+1, len(self.offsets)):
+            self.offsets[j] += 1
+        self.tail_start += 1
+        self.cache.clear()
+
+    def replace(self, idx, ts, value):
+        self.detach()
+        a = self.head + idx
+        if a >= self.tail_start:
+            self.ts[a - self.tail_start] = ts
+            self.values[a - self.tail_start] = value
+            return
+
+        k = bisect.bisect_right(self.offsets, a) - 1
+        (chunk_ts, chunk_values) = [array('d', c) for c in self.decoded(k)]
+        chunk_ts[a - self.offsets[k]] = ts
+        chunk_values[a - self.offsets[k]] = value
+        self.reseal(k, chunk_ts, chunk_values)
+        self.cache[self.offsets[k]] = (chunk_ts, chunk_values)
+
+    def reseal(self, k, ts, values):
+        self.chunks[k] = encode_chunk(ts, values)
+        self.last_ts[k] = ts[-1]
+
+    def append(self, ts, value):
+        self.ts.append(ts)
+        self.values.append(value)
+        if len(self.ts) >= 2*CHUNK_SIZE:
+            self.seal()
+
+    #################################################################
+    # Seal the oldest CHUNK_SIZE tail samples into a chunk
+    #
+    def seal(self):
+        self.compact()
+        if len(self.ts) >= 2*CHUNK_SIZE:
+            self.chunks.append(encode_chunk(self.ts[:CHUNK_SIZE], self.values[:CHUNK_SIZE]))
+            self.offsets.append(self.tail_start)
+            self.last_ts.append(self.ts[CHUNK_SIZE-1])
+            del self.ts[:CHUNK_SIZE]
+            del self.values[:CHUNK_SIZE]
+            self.tail_start += CHUNK_SIZE
+
+    #################################################################
+    # Drop n oldest samples. Whole chunks are released as soon as the
+    # head passes them.
+    #
+    def drop_head(self, n):
+        self.head += min(max(n, 0), len(self))
+        k = bisect.bisect_right(self.offsets, self.head) - 1
+        if len(self.chunks) > 0 and self.head >= self.tail_start:
+            k = len(self.chunks)
+        if k > 0:
+            self.detach()
+            for offset in self.offsets[:k]:
+                self.cache.pop(offset, None)
+            del self.chunks[:k]
+            del self.offsets[:k]
+            del self.last_ts[:k]
+        dead = self.head - self.tail_start
+        if dead >= COMPACT_MIN and 2*dead >= len(self.ts):
+            self.compact()
+
+    def compact(self):
+        self.detach()
+        dead = self.head - self.tail_start
+        if dead > 0:
+            del self.ts[:dead]
+            del self.values[:dead]
+            self.tail_start = self.head
+
+    #################################################################
+    # Keep [from_idx, to_idx) only
+    #
+    def keep(self, from_idx, to_idx):
+        (ts, values) = self.columns()
+        self.load_columns(ts[from_idx:to_idx], values[from_idx:to_idx])
+
+    #################################################################
+    # Copy of [from_idx, to_idx) as list of [ts, value]
+    #
+    def slice(self, from_idx, to_idx):
+        return [[ts_out(t), v] for (t, v) in self.iter_items(from_idx, to_idx)]
+
+    def to_list(self):
+        return self.slice(0, len(self))
+
+    #################################################################
+    # Iterate (ts, value) over [from_idx, to_idx), decoding chunk by
+    # chunk
+    #
+    def iter_items(self, from_idx, to_idx):
+        a = self.head + from_idx
+        end = self.head + to_idx
+        if a >= end:
+            return iter(())
+        if a >= self.tail_start:
+            r = range(a - self.tail_start, end - self.tail_start)
+            return zip(map(self.ts.__getitem__, r), map(self.values.__getitem__, r))
+        return self.iter_chunks(a, end)
+
+    def iter_chunks(self, a, end):
+        while a < end:
+            (columns, i) = self.locate(a)
+            n = min(len(columns[0]) - i, end - a)
+            yield from zip(columns[0][i:i+n], columns[1][i:i+n])
+            a += n
+
+    def load(self, items):
+        self.load_columns(array('d', (e[0] for e in items)), array('d', (e[1] for e in items)))
+
+    #################################################################
+    # Column import/export, (ts, values)
+    #
+    def load_columns(self, ts, values):
+        self.clear()
+        self.ts = ts if isinstance(ts, array) else array('d', ts)
+        self.values = values if isinstance(values, array) else array('d', values)
+
+    def columns(self):
+        ts = array('d')
+        values = array('d')
+        for k in range(len(self.chunks)):
+            (chunk_ts, chunk_values) = self.decoded(k) if self.offsets[k] in self.cache else decode_chunk(self.chunks[k])
+            skip = max(self.head - self.offsets[k], 0)
+            ts.extend(chunk_ts[skip:])
+            values.extend(chunk_values[skip:])
+        skip = max(self.head - self.tail_start, 0)
+        end = self.tail_end()
+        ts.extend(self.ts[skip:end])
+        values.extend(self.values[skip:end])
+        return (ts, values)
+
+    def tail_end(self):
+        return len(self.ts)
+
+    #################################################################
+    # Independent copy. Chunks are immutable (re-encoding replaces
+    # them), so only the tail is copied.
+    #
+    def copy(self):
+        storage = CompressedStorage()
+        storage.chunks = list(self.chunks)
+        storage.offsets = list(self.offsets)
+        storage.last_ts = array('d', self.last_ts)
+        storage.ts = self.ts[:self.tail_end()]
+        storage.values = self.values[:self.tail_end()]
+        storage.tail_start = self.tail_start
+        storage.head = self.head
+        return storage
+
+    #################################################################
+    # Read-only view of the current samples, see above. Sealing,
+    # expiry of chunks and changes inside chunks or the tail detach()
+    # first: the storage gets private chunk lists, tail and cache. Until
+    # then the views share the cache, so a chunk is decoded once for
+    # all of them; chunks and decoded chunks are never modified.
+    #
+    def view(self):
+        self.shared = True
+        return CompressedView(self)
+
+    def detach(self):
+        if self.shared:
+            self.chunks = list(self.chunks)
+            self.offsets = list(self.offsets)
+            self.last_ts = array('d', self.last_ts)
+            self.ts = array('d', self.ts)
+            self.values = array('d', self.values)
+            self.cache = OrderedDict(self.cache)
+            self.shared = False
+
+
+class CompressedView(CompressedStorage):
+
+    def __init__(self, storage):
+        self.chunks = storage.chunks
+        self.offsets = storage.offsets
+        self.last_ts = storage.last_ts
+        self.ts = storage.ts
+        self.values = storage.values
+        self.tail_start = storage.tail_start
+        self.head = storage.head
+        self.cache = storage.cache
+        self.end = len(storage.ts)
+        self.shared = False
+
+    def __len__(self):
+        return self.tail_start + self.end - self.head
+
+    def tail_end(self):
+        return self.end
+
+    def view(self):
+        return self
+
+
+#####################################################################
+# Columns split into fixed time partitions
+#
+# Partition k holds the samples with ts in [keys[k]*PARTITION_SPAN,
+# (keys[k]+1)*PARTITION_SPAN), sorted, and starts at absolute position
+# starts[k]. Inserts only touch their own partition, expiry releases
+# whole partitions, and each partition keeps a lazily computed summary
+# (count, min, max, integral) so period queries can skip partitions
+# lying fully inside the window.
+#
+PARTITION_SPAN = 3600
+
+class PartitionedStorage:
+
+    kind = 'partitioned'
+
+    def __init__(self, items=None):
+        self.clear()
+        if items is not None:
+            self.load(items)
+
+    def clear(self):
+        self.keys = []              # Partition number (ts//PARTITION_SPAN)
+        self.parts = []             # (ts, values) array('d') columns
+        self.starts = []            # Absolute position of first sample
+        self.head = 0               # Expired samples in the first partition
+        self.summaries = {}         # Partition number -> summary
+        self.owned = set()          # Partition numbers not shared with a view
+
+    def __len__(self):
+        if len(self.parts) == 0:
+            return 0
+        return self.starts[-1] + self.part_len(-1) - self.head
+
+    def part_len(self, k):
+        return len(self.parts[k][0])
+
+    def restart(self, k=0):
+        pos = self.starts[k-1] + len(self.parts[k-1][0]) if k > 0 else 0
+        del self.starts[k:]
+        for part in self.parts[k:]:
+            self.starts.append(pos)
+            pos += len(part[0])
+
+    #################################################################
+    # (partition index, position within) for index idx
+    #
+    def locate(self, idx):
+        a = self.head + idx
+        k = bisect.bisect_right(self.starts, a) - 1
+        return (k, a - self.starts[k])
+
+    #################################################################
+    # Element access
+    #
+    def ts_at(self, idx):
+        (k, i) = self.locate(idx)
+        return self.parts[k][0][i]
+
+    def value_at(self, idx):
+        (k, i) = self.locate(idx)
+        return self.parts[k][1][i]
+
+    def item(self, idx):
+        (k, i) = self.locate(idx)
+        return [ts_out(self.parts[k][0][i]), self.parts[k][1][i]]
+
+    #################################################################
+    # First index in [lo, hi) with ts >= provided ts. The samples are
+    # sorted, so the global position clamped to [lo, hi] is the answer.
+    #
+    def bisect_left(self, ts, lo=0, hi=None):
+        if hi is None:
+            hi = len(self)
+        key = ts//PARTITION_SPAN
+        k = bisect.bisect_left(self.keys, key)
+        if k >= len(self.parts):
+            a = len(self) + self.head
+        elif self.keys[k] == key:
+            a = self.starts[k] + bisect.bisect_left(self.parts[k][0], ts)
+        else:
+            a = self.starts[k]
+        return min(max(a - self.head, lo), hi)
+
+    #################################################################
+    # Partition index for ts, created if missing
+    #
+    def partition(self, ts):
+        key = ts//PARTITION_SPAN
+        k = bisect.bisect_left(self.keys, key)
+
+        # head counts expired samples at the front of partition 0: drop
+        # them before anything goes into or in front of it
+        if k == 0 and self.head > 0:
+            self.compact()
+
+        if k >= len(self.keys) or self.keys[k] != key:
+            self.keys.insert(k, key)
+            self.parts.insert(k, (array('d'), array('d')))
+            self.starts.insert(k, 0)
+            self.owned.add(key)
+            self.restart(k)
+        self.summaries.pop(key, None)
+        return k
+
+    #################################################################
+    # Modification
+    #
+    def insert(self, idx, ts, value):
+        k = self.partition(ts)
+        self.own(k)
+        i = self.head + idx - self.starts[k]
+        self.parts[k][0].insert(i, ts)
+        self.parts[k][1].insert(i, value)
+        self.restart(k+1)
+
+    def replace(self, idx, ts, value):
+        (k, i) = self.locate(idx)
+        self.own(k)
+        self.parts[k][0][i] = ts
+        self.parts[k][1][i] = value
+        self.summaries.pop(self.keys[k], None)
+
+    def append(self, ts, value):
+        if len(self.keys) == 0 or ts//PARTITION_SPAN != self.keys[-1]:
+            self.partition(ts)
+        else:
+            self.summaries.pop(self.keys[-1], None)
+        self.parts[-1][0].append(ts)
+        self.parts[-1][1].append(value)
+
+    #################################################################
+    # Drop n oldest samples. Whole partitions are released as soon as
+    # the head passes them, O(1) per partition.
+    #
+    def drop_head(self, n):
+        self.head += min(max(n, 0), len(self))
+        k = 0
+        while k < len(self.parts) and self.head >= len(self.parts[k][0]):
+            self.head -= len(self.parts[k][0])
+            self.summaries.pop(self.keys[k], None)
+            k += 1
+        if k > 0:
+            self.owned.difference_update(self.keys[:k])
+            del self.keys[:k]
+            del self.parts[:k]
+            self.restart()
+        if self.head > 0:
+            self.summaries.pop(self.keys[0], None)
+
+    def compact(self):
+        if self.head > 0:
+            self.own(0)
+            del self.parts[0][0][:self.head]
+            del self.parts[0][1][:self.head]
+            self.head = 0
+            self.restart()
+
+    #################################################################
+    # Keep [from_idx, to_idx) only
+    #
+    def keep(self, from_idx, to_idx):
+        (ts, values) = self.columns()
+        self.load_columns(ts[from_idx:to_idx], values[from_idx:to_idx])
+
+    #################################################################
+    # Copy of [from_idx, to_idx) as list of [ts, value]
+    #
+    def slice(self, from_idx, to_idx):
+        return [[ts_out(t), v] for (t, v) in self.iter_items(from_idx, to_idx)]
+
+    def to_list(self):
+        return self.slice(0, len(self))
+
+    #################################################################
+    # Iterate (ts, value) over [from_idx, to_idx), partition by partition
+    #
+    def iter_items(self, from_idx, to_idx):
+        if to_idx <= from_idx:
+            return iter(())
+        return self.iter_parts(from_idx, to_idx)
+
+    def iter_parts(self, from_idx, to_idx):
+        (k, i) = self.locate(from_idx)
+        n = to_idx - from_idx
+        while n > 0:
+            (ts, values) = self.parts[k]
+            m = min(len(ts) - i, n)
+            yield from zip(ts[i:i+m], values[i:i+m])
+            n -= m
+            (k, i) = (k+1, 0)
+
+    def load(self, items):
+        self.load_columns(array('d', (e[0] for e in items)), array('d', (e[1] for e in items)))
+
+    #################################################################
+    # Column import/export, (ts, values)
+    #
+    def load_columns(self, ts, values):
+        self.clear()
+        i = 0
+        while i < len(ts):
+            key = ts[i]//PARTITION_SPAN
+            j = bisect.bisect_left(ts, (key+1)*PARTITION_SPAN, i)
+            self.keys.append(key)
+            self.parts.append((array('d', ts[i:j]), array('d', values[i:j])))
+            self.owned.add(key)
+            i = j
+        self.restart()
+
+    def columns(self):
+        ts = array('d')
+        values = array('d')
+        for (k, (part_ts, part_values)) in enumerate(self.parts):
+            skip = self.head if k == 0 else 0
+            n = self.part_len(k)
+            ts.extend(part_ts[skip:n])
+            values.extend(part_values[skip:n])
+        return (ts, values)
+
+    #################################################################
+    # (summary, n) for the partition holding index idx, where n is the
+    # number of samples from idx to the partition end. summary is
+    # [count, min, max, integral] (integral of the step function between
+    # the partition's own samples) when idx is the first live sample of
+    # the partition, else None.
+    #
+    def summary_at(self, idx):
+        (k, i) = self.locate(idx)
+        n = self.part_len(k)
+        if i > 0:
+            return (None, n - i)
+
+        key = self.keys[k]
+        s = self.summaries.get(key)
+        if s is None:
+            ts = self.parts[k][0][:n]
+            values = self.parts[k][1][:n]
+            integral = fsum(map(mul, values[:-1], map(sub, ts[1:], ts[:-1])))
+            s = [n, min(values), max(values), integral]
+            self.summaries[key] = s
+        return (s, n)
+
+    #################################################################
+    # Independent copy of the partitions
+    #
+    def copy(self):
+        storage = PartitionedStorage()
+        storage.keys = list(self.keys)
+        storage.parts = [(ts[:self.part_len(k)], values[:self.part_len(k)]) for (k, (ts, values)) in enumerate(self.parts)]
+        storage.starts = list(self.starts)
+        storage.head = self.head
+        storage.summaries = dict(self.summaries)
+        storage.owned = set(self.keys)
+        return storage
+
+    #################################################################
+    # Read-only view of the current samples, see above. The view has its
+    # own partition lists and shares the partition columns; a partition
+    # is copied before its first change other than an append after a
+    # view was taken (own()).
+    #
+    def view(self):
+        self.owned = set()
+        return PartitionedView(self)
+
+    def own(self, k):
+        key = self.keys[k]
+        if key not in self.owned:
+            (ts, values) = self.parts[k]
+            self.parts[k] = (array('d', ts), array('d', values))
+            self.owned.add(key)
+
+
+class PartitionedView(PartitionedStorage):
+
+    def __init__(self, storage):
+        self.keys = list(storage.keys)
+        self.parts = list(storage.parts)
+        self.starts = list(storage.starts)
+        self.head = storage.head
+        self.summaries = dict(storage.summaries)
+        self.owned = set()
+        self.last_len = len(self.parts[-1][0]) if len(self.parts) > 0 else 0
+
+    def part_len(self, k):
+        if k == -1 or k == len(self.parts) - 1:
+            return self.last_len
+        return len(self.parts[k][0])
+
+    def view(self):
+        return self
+
+
+#####################################################################
+# Read-only view of the samples [from_idx, to_idx) of a storage
+#
+# Nothing is copied; elements are read from the storage on access as
+# (ts, value) tuples. Like a dict view, it is only valid until the
+# buffer is modified.
+#
+class IntervalView:
+
+    def __init__(self, storage, from_idx, to_idx):
+        self.storage = storage
+        self.from_idx = from_idx
+        self.to_idx = max(from_idx, to_idx)
+
+    def __len__(self):
+        return self.to_idx - self.from_idx
+
+    def __iter__(self):
+        return self.storage.iter_items(self.from_idx, self.to_idx)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            (start, stop, step) = key.indices(len(self))
+            if step != 1:
+                raise ValueError('IntervalView does not support slice steps')
+            return IntervalView(self.storage, self.from_idx+start, self.from_idx+stop)
+
+        if key < 0:
+            key += len(self)
+        if key < 0 or key >= len(self):
+            raise IndexError('IntervalView index out of range')
+        return (self.storage.ts_at(self.from_idx+key), self.storage.value_at(self.from_idx+key))
+
+    def timestamps(self):
+        return map(self.storage.ts_at, range(self.from_idx, self.to_idx))
+
+    def values(self):
+        return map(self.storage.value_at, range(self.from_idx, self.to_idx))
+
+
+STORAGE_BACKENDS = {
+    ListStorage.kind: ListStorage,
+    ColumnStorage.kind: ColumnStorage,
+    CompressedStorage.kind: CompressedStorage,
+    PartitionedStorage.kind: PartitionedStorage,
+}
+
+#####################################################################
+# Create backend by name ('list', 'columns', 'gorilla' or 'partitioned')
+#
+def create_storage(kind='list', items=None):
+    try:
+        return STORAGE_BACKENDS[kind](items)
+    except KeyError:
+        raise ValueError('Unknown TimeBuffer storage backend: {}'.format(kind))
@@ -1,70 +1,225 @@
+import copy
 import logging
-from threading import Thread
+import threading
 import time
-import copy
-# import json
-import yaml
+from .storage import create_storage, IntervalView
+from .backup import create_backup, CROP_FROM, CROP_TO
+from .persistence import default_worker
+from .clock import default_clock
+
+#####################################################################
+# Live reads
+#
+# Set by single-threaded runs (the replay): nothing writes the buffers
+# while a query runs, so snapshot() returns the buffer itself instead
+# of publishing a view per version.
+#
+_live_reads = False
+
+def set_live_reads(live):
+    global _live_reads
+    _live_reads = live
+
+#####################################################################
+# Expiry slack
+#
+# Set by runs that append far more often than they query (the replay):
+# samples expire in batches, once the oldest one is this many seconds
+# past the age. Expiry hooks and index updates cost about the same for
+# a batch as for the single sample each append would expire. 0 (the
+# default) expires on every append.
+#
+_expiry_slack = 0
+
+def set_expiry_slack(seconds):
+    global _expiry_slack
+    _expiry_slack = seconds
+
+def expiry_slack():
+    return _expiry_slack
+
 
 class TimeBuffer:
 
-    def __init__(self, age=-1, backup_filename=None, backup_interval=60):
-        self.sorted_list = []
+    def __init__(self, age=-1, backup_filename=None, backup_interval=60, storage='list', persistence=None, backup_format='yaml'):
+        self.storage = create_storage(storage)
         self.age = age
         self.backup_interval=backup_interval
         self.backup_filename=backup_filename
+        self.backup = None
+        self.persistence = persistence
+        self.indexes = []           # Derived indexes, see index.py
+        self.expiry_hooks = []      # Called with a view of samples about to expire
+        self.lock = threading.RLock()   # Held by writers, see snapshot()
+        self.version = 0            # Bumped on every change
+        self.published = None       # Latest snapshot
         self.logger = logging.getLogger('timebuffer')
         if backup_filename is not None:
+            self.backup = create_backup(backup_format, backup_filename)
             self.restore()
 
     #################################################################
-    # Kicker tread loop
+    # List-of-lists view of the buffer ([[ts, value], ...])
     #
-    def save_runner(self):
-        if self.backup_filename is not None:
-            try:
-                with open(self.backup_filename, "w") as f:
-                    f.write(yaml.dump(self.sorted_list))
-#                    f.write(yaml.dump(json.loads(json.dumps(self.sorted_list))))
-            except Exception as e:
-                self.logger.warning('Could not write buffer backup {}: {}'.format(self.backup_filename, e))
+    # For the 'list' backend this is the live list, for 'columns' it is
+    # a copy. Assigning replaces the buffer content.
+    #
+    @property
+    def sorted_list(self):
+        with self.lock:
+            if self.storage.kind == 'list':
+                # Live list may be modified by the caller
+                self.storage.detach()
+                self.storage.compact()
+                self.invalidate_indexes()
+                return self.storage.items
+            else:
+                return self.storage.to_list()
+
+    @sorted_list.setter
+    def sorted_list(self, items):
+        with self.lock:
+            self.storage.load(items)
+            self.invalidate_indexes()
+            if self.backup is not None:
+                self.backup.record_reset()
 
+    def invalidate_indexes(self):
+        self.version += 1
+        for index in self.indexes:
+            index.invalidate()
 
     #################################################################
-    # Restore data from backup
+    # Consistent read-only view of the buffer
+    #
+    # Writers (insert_sorted, crop_interval, assigning sorted_list) hold
+    # self.lock. Readers in other threads query a snapshot instead of
+    # the live buffer: it is published under the lock once per version
+    # and shared until the next change. A snapshot shares the sample
+    # columns and index arrays with the buffer, bounded to the samples
+    # at the time (see view() in storage.py); only changes other than
+    # appends make the buffer copy them, so publishing is O(1) in the
+    # buffer length. A snapshot does not expire, back up or notify, and
+    # must not be modified. With live reads (see set_live_reads) it is
+    # the buffer itself.
+    #
+    def snapshot(self):
+        if _live_reads:
+            return self
+        with self.lock:
+            published = self.published
+            if published is None or published.version != self.version:
+                published = self.clone()
+                self.published = published
+            return published
+
+    def clone(self):
+        buffer = copy.copy(self)
+        buffer.storage = self.storage.view()
+        buffer.indexes = []
+        buffer.expiry_hooks = []
+        buffer.age = -1
+        buffer.backup = None
+        buffer.backup_filename = None
+        buffer.lock = threading.RLock()
+        buffer.published = None
+
+        # Attributes referring to an index (e.g. FloatTimeBuffer.integral)
+        # or to a dict of them (FloatTimeBuffer.aggregates) get the
+        # clone's copy
+        clones = {id(index): index.clone(buffer) for index in self.indexes}
+        for (name, value) in vars(self).items():
+            if id(value) in clones:
+                setattr(buffer, name, clones[id(value)])
+            elif isinstance(value, dict) and any(id(v) in clones for v in value.values()):
+                setattr(buffer, name, {k: clones.get(id(v), v) for (k, v) in value.items()})
+        return buffer
+
+    #################################################################
+    # Write backup now (called by the persistence worker). Returns
+    # bytes written
+    #
+    def flush(self):
+        if self.backup is None:
+            return 0
+        # Snapshot and pending backup records are taken together, the
+        # (slow) write runs without the lock
+        with self.lock:
+            storage = self.snapshot().storage
+            batch = self.backup.take()
+        return self.backup.write(storage, batch)
+
+    #################################################################
+    # Restore data from backup, replaying any journal on top
     #
     def restore(self):
-        if self.backup_filename is not None:
-            try:
-                with open(self.backup_filename, "r") as f:
-                    restore_list = yaml.safe_load(f)
-                    if type(restore_list) is list:
-                        self.sorted_list = restore_list
-            except Exception as e:
-                self.logger.warning('Could not read buffer backup {}: {}'.format(self.backup_filename, e))
+        if self.backup is not None:
+            with self.lock:
+                self.load_backup()
+
+    def load_backup(self):
+        try:
+            (columns, journal) = self.backup.load()
+            if columns is not None:
+                self.storage.load_columns(columns[0], columns[1])
+            for (ts, value) in journal:
+                if ts == CROP_FROM:
+                    self.storage.keep(self.get_index(value), len(self.storage))
+                elif ts == CROP_TO:
+                    self.storage.keep(0, self.get_interval_index(to_ts=value)[1])
+                else:
+                    self.insert(ts, value)
+            self.invalidate_indexes()
+        except Exception as e:
+            self.logger.warning('Could not read buffer backup {}: {}'.format(self.backup_filename, e))
 
     #################################################################
-    # Save data to backup
+    # Schedule backup, written behind by the persistence worker
     #
     def save(self):
-        t = Thread(target=self.save_runner, daemon=True)
-        t.start()
+        if self.backup_filename is not None:
+            if self.persistence is None:
+                self.persistence = default_worker()
+            self.persistence.mark_dirty(self)
 
     #################################################################
     # Auto crop data to max age
     #
+    # Keeps [now-age-1, now+1] like crop_interval, but aged-out samples
+    # leave through the storage head so the common case is O(1). With an
+    # expiry slack (see set_expiry_slack) they stay up to that much
+    # longer and leave in batches.
+    #
     def auto_crop(self):
-        if self.age > 0 and self.sorted_list[0][0] < time.time()-self.age:
-            self.crop_interval(from_ts=time.time()-self.age-1, to_ts=int(time.time()+1))
+        now = default_clock().time()
+        if self.age > 0 and len(self.storage) > 0 and self.storage.ts_at(0) < now-self.age-_expiry_slack:
+            n = self.storage.bisect_left(now-self.age-1)
+            for hook in self.expiry_hooks:
+                hook(IntervalView(self.storage, 0, n))
+            self.storage.drop_head(n)
+            self.version += 1
+            for index in self.indexes:
+                index.on_drop_head(n)
+
+        # Samples from the future (clock skew) are cropped as well
+        to_ts = int(now+1)
+        if self.age > 0 and len(self.storage) > 0 and self.storage.ts_at(len(self.storage)-1) > to_ts:
+            (from_idx, to_idx) = self.get_interval_index(from_ts=0, to_ts=to_ts)
+            self.storage.keep(0, to_idx)
+            self.invalidate_indexes()
+            if self.backup is not None:
+                self.backup.record_crop(to_ts=to_ts)
 
     #################################################################
     # Return last tuple in list. None if empty
     #
     def get_last_tuple(self):
         # Empty list:
-        if len(self.sorted_list) <= 0:
+        n = len(self.storage)
+        if n <= 0:
             return None
         else:
-            return self.sorted_list[-1]
+            return self.storage.item(n-1)
 
     #################################################################
     # Find index for tuple with ts >= provided ts
@@ -72,93 +227,179 @@ class TimeBuffer:
     def get_index(self, ts: int, from_idx=0, to_idx=None, valid_read_index=False):
 
         # Empty list:
-        if len(self.sorted_list) <= 0:
+        n = len(self.storage)
+        if n <= 0:
             return 0
 
         # Clamp indexes, default: whole list
-        from_idx = min(max(from_idx, 0), len(self.sorted_list)-1)
+        from_idx = min(max(from_idx, 0), n-1)
         if to_idx is None:
-            to_idx = len(self.sorted_list) - 1
+            to_idx = n - 1
         else:
-            to_idx = max(min(to_idx, len(self.sorted_list)-1), 0)
+            to_idx = max(min(to_idx, n-1), 0)
 
-        # Before first element
-        if ts <= self.sorted_list[from_idx][0]:
-            return from_idx
+        # Binary search in [from_idx, to_idx]
+        idx = self.storage.bisect_left(ts, from_idx, to_idx+1)
 
         # After last element
-        elif ts > self.sorted_list[to_idx][0]:
-            if not valid_read_index:
-                return to_idx + 1
-            else:
-                return to_idx
-
-        # Smallest possible interval (int)
-        elif to_idx - from_idx <= 1:
+        if idx > to_idx and valid_read_index:
             return to_idx
-
-        # Recurse, binary search
         else:
+            return idx
+
+    #################################################################
+    # Insert a element and keep list sorted by ts
+    #
+    def insert_sorted(self, ts: int, value, overwrite=True):
+        with self.lock:
+            self.insert(ts, value, overwrite=overwrite)
+            if self.backup is not None:
+                self.backup.record(ts, value)
 
-            # Middle index
-            m_idx = from_idx + int((to_idx - from_idx)/2)
+            self.auto_crop()
+        self.save()
 
-            # Spot on
-            if ts == self.sorted_list[m_idx][0]:
-                return m_idx
+    #################################################################
+    # Insert many (ts, value) at once, e.g. for backfill and replay.
+    # Same result as insert_sorted per sample, but the batch is sorted
+    # and merged in one O(n + m) pass, and expiry, indexes and backup
+    # are handled once for the whole batch.
+    #
+    def insert_many(self, ts_values, overwrite=True):
+        batch = list(ts_values)
+        if len(batch) == 0:
+            return
+
+        # Equal ts: with overwrite the last one wins, without, each one
+        # goes in front of the earlier ones like insert does
+        if len(batch) > 1:
+            order = sorted(range(len(batch)), key=lambda i: (batch[i][0], i if overwrite else -i))
+            batch = [batch[i] for i in order]
+            if overwrite:
+                batch = [e for (e, e_next) in zip(batch, batch[1:] + [None]) if e_next is None or e_next[0] != e[0]]
+
+        with self.lock:
+            n = len(self.storage)
+            if n == 0 or batch[0][0] > self.storage.ts_at(n-1):
+                # In-order: plain appends, indexes follow incrementally
+                for (ts, value) in batch:
+                    self.append(ts, value)
+                    if self.backup is not None:
+                        self.backup.record(ts, value)
+            else:
+                self.storage.load(self.merge(batch, overwrite))
+                self.invalidate_indexes()
+                if self.backup is not None:
+                    self.backup.record_reset()
 
-            # Lower half
-            elif ts < self.sorted_list[m_idx][0]:
-                return self.get_index(ts, from_idx=from_idx, to_idx=m_idx, valid_read_index=valid_read_index)
+            self.auto_crop()
+        self.save()
 
-            # Upper half
-            elif ts > self.sorted_list[m_idx][0]:
-                return self.get_index(ts, from_idx=m_idx, to_idx=to_idx, valid_read_index=valid_read_index)
+    #################################################################
+    # Buffer content merged with sorted batch, as list of (ts, value)
+    #
+    def merge(self, batch, overwrite):
+        merged = []
+        items = self.storage.iter_items(0, len(self.storage))
+        e = next(items, None)
+        for (ts, value) in batch:
+            while e is not None and e[0] < ts:
+                merged.append(e)
+                e = next(items, None)
+            merged.append((ts, value))
+            if overwrite and e is not None and e[0] == ts:
+                e = next(items, None)
+        if e is not None:
+            merged.append(e)
+            merged.extend(items)
+        return merged
 
     #################################################################
-    # Insert a element and keep list sorted by ts
+    # Insert without expiry and backup
     #
-    def insert_sorted(self, ts: int, value, overwrite=True):
-        vt = [ts, value]        # Use list as a tuple to make it yaml-comp
+    def insert(self, ts: int, value, overwrite=True):
+        n = len(self.storage)
+
+        # Fast path: in-order append
+        if n == 0 or ts > self.storage.ts_at(n-1):
+            self.append(ts, value)
+            return
+
         idx = self.get_index(ts)
 
         if overwrite and \
-            len(self.sorted_list) > 0 and \
-            idx < len(self.sorted_list) and \
+            len(self.storage) > 0 and \
+            idx < len(self.storage) and \
             idx >= 0 and \
-            self.sorted_list[idx][0] == ts:
-            self.sorted_list[idx] = vt
+            self.storage.ts_at(idx) == ts:
+            self.storage.replace(idx, ts, value)
         else:
-            self.sorted_list.insert(idx, vt)
+            self.storage.insert(idx, ts, value)
 
-        self.auto_crop()
-        self.save()
+        self.invalidate_indexes()
 
     #################################################################
-    # Return list [from, to], including
+    # Append after the last sample (caller checks order)
+    #
+    def append(self, ts: int, value):
+        self.storage.append(ts, value)
+        self.version += 1
+        for index in self.indexes:
+            index.on_append()
+
+    #################################################################
+    # Return list [from, to], including. A copy, use interval_view or
+    # iter_interval for read-only access
     #
     def get_interval(self, from_ts=0, to_ts=0):
-        if len(self.sorted_list) <= 0:
-            return []
+        (from_idx, to_idx) = self.get_interval_index(from_ts=from_ts, to_ts=to_ts)
+        return self.storage.slice(from_idx, to_idx)
+
+    #################################################################
+    # Read-only view of [from, to], including. Nothing is copied; the
+    # view is valid until the buffer is modified
+    #
+    def interval_view(self, from_ts=0, to_ts=0):
+        (from_idx, to_idx) = self.get_interval_index(from_ts=from_ts, to_ts=to_ts)
+        return IntervalView(self.storage, from_idx, to_idx)
+
+    #################################################################
+    # Iterate (ts, value) over [from, to], including, without copying
+    #
+    def iter_interval(self, from_ts=0, to_ts=0):
+        (from_idx, to_idx) = self.get_interval_index(from_ts=from_ts, to_ts=to_ts)
+        return self.storage.iter_items(from_idx, to_idx)
+
+    #################################################################
+    # Return index range [from_idx, to_idx) for list [from, to], including
+    #
+    def get_interval_index(self, from_ts=0, to_ts=0):
+        if len(self.storage) <= 0:
+            return (0, 0)
 
         # Default: whole list
         if to_ts <= 0:
-            to_ts = self.sorted_list[-1:][0][0]
+            to_ts = self.storage.ts_at(len(self.storage)-1)
 
         from_idx = self.get_index(ts=from_ts)
         to_idx = self.get_index(ts=to_ts)
 
         # If to_ts is at last element of range, include last element
-        if to_idx < len(self.sorted_list) and to_ts == self.sorted_list[to_idx][0]:
+        if to_idx < len(self.storage) and to_ts == self.storage.ts_at(to_idx):
             to_idx += 1
 
-        return copy.deepcopy(self.sorted_list[from_idx:to_idx])
+        return (from_idx, max(from_idx, to_idx))
 
     #################################################################
     # Crop list [from, to], including
     #
     def crop_interval(self, from_ts=0, to_ts=0):
-        self.sorted_list = self.get_interval(from_ts=from_ts, to_ts=to_ts)
+        with self.lock:
+            (from_idx, to_idx) = self.get_interval_index(from_ts=from_ts, to_ts=to_ts)
+            self.storage.keep(from_idx, to_idx)
+            self.invalidate_indexes()
+            if self.backup is not None:
+                self.backup.record_crop(from_ts=from_ts, to_ts=to_ts if to_ts > 0 else None)
 
 
 if __name__ == '__main__':
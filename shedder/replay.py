@@ -0,0 +1,389 @@
+import ast
+import json
+import re
+from data.local_calendar import default_calendar
+
+###########################################################
+# Deterministic replay of recorded measurements
+#
+# Recorded MQTT messages, one per line as input() gets them ({'topic',
+# 'payload', 'timestamp'}, JSON or Python literal like the examples at
+# the bottom of shedder.py), are fed through input() in order on a
+# ReplayClock moved to each message's receive time. Every loop_sleep
+# seconds of recorded time the control step runs as in the service
+# loop, against MockVehicles instead of the Tesla API.
+#
+# The recording is the site without the vehicles: their charging power
+# is added to the recorded power (and its energy to the registers), so
+# the decisions show in the hourly energies and the capacity tariff
+# figures. Same recording, settings and seed give the same result.
+#
+
+###########################################################
+# Messages of a recording. Lines may be commented out ('# {...}'),
+# blank lines are skipped.
+#
+def read_recording(filename):
+    with open(filename, 'r') as f:
+        for line in f:
+            line = line.strip().lstrip('#').strip()
+            if not line:
+                continue
+            yield parse_message(line)
+
+###########################################################
+# Message from a JSON or Python literal line. Python literals without
+# double quotes and backslashes are read as JSON once their quotes and
+# None/True/False are translated (ast.literal_eval takes ~6 times as
+# long); anything JSON rejects (tuples, non-string keys, inf, ...) is
+# left to literal_eval.
+#
+PYTHON_TOKEN = re.compile(r"'([^']*)'|\b(None|True|False)\b")
+JSON_WORDS = {'None': 'null', 'True': 'true', 'False': 'false'}
+
+def json_token(m):
+    if m.group(1) is not None:
+        return '"' + m.group(1) + '"'
+    return JSON_WORDS[m.group(2)]
+
+def parse_message(line):
+    try:
+        return json.loads(line)
+    except ValueError:
+        pass
+    if '"' not in line and '\\' not in line:
+        if 'None' in line or 'True' in line or 'False' in line:
+            text = PYTHON_TOKEN.sub(json_token, line)
+        else:
+            text = line.replace("'", '"')
+        try:
+            return json.loads(text)
+        except ValueError:
+            pass
+    return ast.literal_eval(line)
+
+###########################################################
+# Receive time of a message (s): the 'timestamp' (ms) input() messages
+# get on arrival, else the measurement's own timestamp
+#
+def receive_ts(message, timestamp_element='timestamp'):
+    if message.get('timestamp') is not None:
+        return message.get('timestamp')/1000
+    return message.get('payload', {}).get(timestamp_element)
+
+
+###########################################################
+# Vehicle with the parts of teslapy.Vehicle ChargeController uses
+#
+# Home (and plugged in) from arrive_hour to depart_hour local time,
+# arriving with a battery level drawn from arrival_level. Charges at
+# charge_amps whenever charging, from arrival on or at the scheduled
+# charging time if one is set (SCHEDULED_CHARGING). A sun_mode vehicle
+# has its schedule at xx:30, which ChargeController reads as sun
+# charging enabled.
+#
+class MockVehicle(dict):
+
+    VOLTAGE = 230
+    EFFICIENCY = 0.9
+
+    def __init__(self, vin, clock, rng, home_location, max_current=16, phases=3, capacity=75.0,
+                 charge_limit_soc=80, arrive_hour=17, depart_hour=7, arrival_level=(30, 60), sun_mode=False):
+        super().__init__()
+        self.clock = clock
+        self.rng = rng
+        self.home_location = home_location
+        self.capacity = capacity
+        self.arrive_hour = arrive_hour
+        self.depart_hour = depart_hour
+        self.arrival_level = arrival_level
+        self.timestamp = 0
+        self.ts = clock.time()
+        self.resume_at = None       # Scheduled charging start while stopped
+        self.energy = 0.0           # kWh charged
+        self.update({
+            'vin': vin,
+            'display_name': vin,
+            'vehicle_state': {'vehicle_name': vin},
+            'drive_state': {},
+            'charge_state': {
+                'charging_state': 'Disconnected',
+                'charge_amps': max_current,
+                'charge_current_request': max_current,
+                'charge_current_request_max': max_current,
+                'charger_phases': phases,
+                'charger_power': 0,
+                'charge_rate': 0,
+                'battery_level': arrival_level[1],
+                'charge_limit_soc': charge_limit_soc,
+                'scheduled_charging_mode': 'StartAt' if sun_mode else 'Off',
+                'scheduled_charging_start_time_app': 30 if sun_mode else 0,
+                'timestamp': 0,
+            },
+        })
+        self.set_home(self.is_home(self.ts))
+        if self.is_home(self.ts):
+            self.arrive(self.ts)
+
+    #################################################################
+    # Charging power drawn (W)
+    #
+    def power(self):
+        cs = self['charge_state']
+        if cs['charging_state'] != 'Charging':
+            return 0
+        return cs['charge_amps']*self.VOLTAGE*cs['charger_phases']
+
+    def is_home(self, ts):
+        hour = default_calendar().local(ts).hour
+        if self.arrive_hour > self.depart_hour:
+            return hour >= self.arrive_hour or hour < self.depart_hour
+        return self.arrive_hour <= hour < self.depart_hour
+
+    def set_home(self, home):
+        if home:
+            self['drive_state'] = {'latitude': self.home_location.get('lat'), 'longitude': self.home_location.get('lon')}
+        else:
+            self['drive_state'] = {'latitude': self.home_location.get('lat') + 0.1, 'longitude': self.home_location.get('lon')}
+
+    #################################################################
+    # Move the vehicle state on to ts: charge, arrive, leave, start
+    # scheduled charging. Steps through at most one event at a time.
+    #
+    def advance(self, ts):
+        while self.ts < ts:
+            t = min(ts, self.next_event(self.ts))
+            self.charge(t - self.ts)
+            home = self.is_home(t)
+            if home != (self['charge_state']['charging_state'] != 'Disconnected'):
+                if home:
+                    self.arrive(t)
+                else:
+                    self.leave()
+            elif self.resume_at is not None and t >= self.resume_at:
+                self.resume_at = None
+                self.start()
+            self.ts = t
+        self['charge_state']['timestamp'] = int(1000*ts)
+
+    #################################################################
+    # Next full hour or scheduled start after ts
+    #
+    def next_event(self, ts):
+        t = 3600*(int(ts)//3600 + 1)
+        if self.resume_at is not None and ts < self.resume_at < t:
+            return self.resume_at
+        return t
+
+    def charge(self, seconds):
+        cs = self['charge_state']
+        power = self.power()
+        cs['charger_power'] = round(power/1000)
+        if power <= 0 or seconds <= 0:
+            return
+        energy = power*seconds/3.6e6
+        self.energy += energy
+        cs['battery_level'] = min(cs['charge_limit_soc'], cs['battery_level'] + 100*energy*self.EFFICIENCY/self.capacity)
+        if cs['battery_level'] >= cs['charge_limit_soc']:
+            cs['charging_state'] = 'Complete'
+            cs['charger_power'] = 0
+
+    def arrive(self, ts):
+        cs = self['charge_state']
+        self.set_home(True)
+        cs['battery_level'] = self.rng.uniform(*self.arrival_level)
+        cs['charging_state'] = 'Stopped'
+        if cs['scheduled_charging_mode'] != 'Off':
+            self.resume_at = self.scheduled_start(ts)
+        else:
+            self.start()
+
+    def leave(self):
+        self.set_home(False)
+        self.resume_at = None
+        self['charge_state']['charging_state'] = 'Disconnected'
+        self['charge_state']['charger_power'] = 0
+
+    def start(self):
+        cs = self['charge_state']
+        if cs['charging_state'] != 'Disconnected' and cs['battery_level'] < cs['charge_limit_soc']:
+            cs['charging_state'] = 'Charging'
+
+    #################################################################
+    # Next local time after ts at the scheduled minute of day
+    #
+    def scheduled_start(self, ts):
+        minute = self['charge_state']['scheduled_charging_start_time_app']
+        (day_from, day_to) = default_calendar().day_bounds(ts)
+        start = day_from + 60*minute
+        return start if start > ts else default_calendar().add_days(start, 1)
+
+    #################################################################
+    # teslapy.Vehicle interface
+    #
+    def get_vehicle_summary(self):
+        self.advance(self.clock.time())
+        self.timestamp = self.clock.time()
+
+    def available(self):
+        return True
+
+    def sync_wake_up(self):
+        pass
+
+    def api(self, name, **kwargs):
+        self.advance(self.clock.time())
+        return {'response': dict(self)}
+
+    def command(self, name, **kwargs):
+        self.advance(self.clock.time())
+        cs = self['charge_state']
+        if name == 'CHARGING_AMPS':
+            cs['charge_amps'] = min(kwargs.get('charging_amps'), cs['charge_current_request_max'])
+            cs['charge_current_request'] = cs['charge_amps']
+        elif name == 'START_CHARGE':
+            self.resume_at = None
+            self.start()
+        elif name == 'STOP_CHARGE':
+            if cs['charging_state'] == 'Charging':
+                cs['charging_state'] = 'Stopped'
+        elif name == 'SCHEDULED_CHARGING':
+            cs['scheduled_charging_mode'] = 'StartAt' if kwargs.get('enable') else 'Off'
+            cs['scheduled_charging_start_time_app'] = kwargs.get('time', 0) % 1440
+            if kwargs.get('enable'):
+                self.resume_at = self.scheduled_start(self.clock.time())
+        else:
+            raise ValueError('Unknown command {}'.format(name))
+        cs['charger_power'] = round(self.power()/1000)
+        return True
+
+
+###########################################################
+# Replay driver
+#
+# input(message) and flush(now) are the service's ingest, step() one
+# pass of its control loop returning the decisions taken, calculator
+# the site import calculator. elements are the payload names of
+# timestamp, import/export power and import/export registers.
+#
+class Replay:
+
+    def __init__(self, clock, input, flush, step, calculator, vehicles, loop_sleep=5, elements=None, trace=None):
+        self.clock = clock
+        self.input = input
+        self.flush = flush
+        self.step = step
+        self.calculator = calculator
+        self.vehicles = vehicles
+        self.loop_sleep = loop_sleep
+        self.elements = dict({'timestamp': 'timestamp', 'p_pos': 'P_pos', 'p_neg': 'P_neg', 'e_pos': 'A_pos', 'e_neg': 'A_neg'}, **(elements or {}))
+        self.trace = trace          # trace(record) per decision, if given
+        self.decisions = 0
+        self.messages = 0
+        self.next_step = None
+        self.month = None           # (from, to) of the month being replayed
+        self.months = []
+        self.added = (0.0, 0.0)     # Vehicle power added to import/export (W)
+        self.added_ts = None
+        self.added_energy = [0.0, 0.0]  # kWh added to the import/export registers
+
+    #################################################################
+    # Replay messages, returns the summary
+    #
+    def run(self, messages):
+        for message in messages:
+            ts = receive_ts(message, self.elements['timestamp'])
+            if ts is None:
+                continue
+            self.run_until(ts)
+            self.clock.advance_to(ts)
+            self.input(self.add_vehicles(message))
+            self.messages += 1
+
+        self.run_until(self.clock.time() + self.loop_sleep)
+        if self.month is not None:
+            self.close_month()
+        return self.summary()
+
+    #################################################################
+    # Control steps due up to ts, the first one a loop after the first
+    # message
+    #
+    def run_until(self, ts):
+        if self.next_step is None:
+            self.next_step = ts + self.loop_sleep
+        while self.next_step <= ts:
+            self.clock.advance_to(self.next_step)
+            now = self.clock.time()
+            self.check_month(now)
+            for v in self.vehicles:
+                v.advance(now)
+            self.flush(now)
+            for d in self.step():
+                self.decisions += 1
+                if self.trace is not None:
+                    self.trace(dict(ts=now, time=default_calendar().iso(int(now)), **d))
+            self.next_step = self.clock.time() + self.loop_sleep
+
+    #################################################################
+    # Recorded measurement plus the vehicles' charging. Power is netted
+    # (charging covers export first), the added energy accumulates into
+    # the registers.
+    #
+    def add_vehicles(self, message):
+        payload = message.get('payload', {})
+        ts = payload.get(self.elements['timestamp'])
+        p_pos = payload.get(self.elements['p_pos'])
+        if ts is None or (p_pos is None and payload.get(self.elements['e_pos']) is None):
+            return message
+
+        if self.added_ts is not None and ts > self.added_ts:
+            for k in (0, 1):
+                self.added_energy[k] += self.added[k]*(ts - self.added_ts)/3.6e6
+        self.added_ts = ts
+
+        payload = dict(payload)
+        if p_pos is not None:
+            p_neg = payload.get(self.elements['p_neg']) or 0
+            for v in self.vehicles:
+                v.advance(ts)
+            net = p_pos - p_neg + sum(v.power() for v in self.vehicles)
+            payload[self.elements['p_pos']] = max(net, 0)
+            payload[self.elements['p_neg']] = max(-net, 0)
+            self.added = (max(net, 0) - p_pos, max(-net, 0) - p_neg)
+        for (k, element) in enumerate((self.elements['e_pos'], self.elements['e_neg'])):
+            if payload.get(element) is not None:
+                payload[element] += self.added_energy[k]
+        return dict(message, payload=payload)
+
+    #################################################################
+    # Month results are taken when the replay leaves the month, while
+    # the energy buffer still holds all of it
+    #
+    def check_month(self, now):
+        if self.month is None:
+            self.month = default_calendar().month_bounds(now)
+        elif now >= self.month[1]:
+            self.close_month()
+            self.month = default_calendar().month_bounds(now)
+
+    def close_month(self):
+        (ts_from, ts_to) = self.month
+        hours = self.calculator.hourly_energy(ts_from, ts_to)
+        status = self.calculator.monthly_status(ts_from)['this_month']
+        self.months.append({
+            'month': default_calendar().ymd(ts_from)[:7],
+            'max3_avg': status['max3_avg'],
+            'max_values': status['max_values'],
+            'energy': sum(hours.values()),
+            'hourly_energy': [[default_calendar().ymd_hms(h), round(e, 3)] for (h, e) in sorted(hours.items())],
+        })
+
+    def summary(self):
+        return {
+            'messages': self.messages,
+            'decisions': self.decisions,
+            'added_energy': {'import': self.added_energy[0], 'export': self.added_energy[1]},
+            'vehicles': [{'vin': v.get('vin'), 'energy': v.energy, 'battery_level': v['charge_state']['battery_level']} for v in self.vehicles],
+            'months': self.months,
+        }
@@ -5,13 +5,27 @@ import configparser
 import argparse
 import random
 import copy
+import json
+import shutil
+import tempfile
+import itertools
 from pathlib import Path
 import os
 import sys
+import signal
 import yaml
 import requests
 from integration.mqtt import MQTTClient
 from data.energy_calc import EnergyCalculator
+from data.persistence import default_worker, PersistenceWorker
+from data.ingest import ReorderBuffer
+from data.frame_buffer import FrameBuffer
+from data.site import MeterShards, SiteCalculator, meter_key
+from data.export import ColumnarExporter
+from data.local_calendar import default_calendar
+from data.clock import default_clock, set_default_clock, ReplayClock
+from data.timebuffer import set_live_reads, set_expiry_slack
+from replay import Replay, MockVehicle, read_recording, receive_ts
 from charge_controller import ChargeController
 import teslapy
 from oauthlib.oauth2.rfc6749.errors import LoginRequired, InvalidGrantError
@@ -31,9 +45,11 @@ __version__ = '0.0.1c'
 APP_NAME = os.path.basename(__file__).split('.')[0]
 DEFAULT_CFG_DIR = "/etc/opt/jofo/{}".format(APP_NAME)
 settings = {}
+loop_settings = {}
 dynamic_settings = {}
 calculator_export = None
 calculator_import = None
+meters = None
 cfg_dir = DEFAULT_CFG_DIR
 state_dir = DEFAULT_CFG_DIR
 MIN_CURRENT = 5
@@ -45,6 +61,21 @@ def get_arguments(args_=None):
     parser = argparse.ArgumentParser()
     parser.add_argument("--cfg_dir", help="Location of cfg files", default=DEFAULT_CFG_DIR)
     parser.add_argument("-v", "--version", action="version", version=__version__)
+    commands = parser.add_subparsers(dest="command")
+    export = commands.add_parser("export", help="Export buffers and rollups to Parquet/Arrow files and exit")
+    export.add_argument("--export_dir", help="Export directory (default: [export] dir)")
+    export.add_argument("--format", choices=["parquet", "arrow"], help="File format (default: [export] format)")
+    month = commands.add_parser("month", help="Print the monthly max/min hours of each meter from the long-term store and exit")
+    month.add_argument("month", help="Month as YYYY-MM")
+    replay = commands.add_parser("replay", help="Replay recorded measurements through the control loop on simulated time and exit")
+    replay.add_argument("recording", help="Recorded MQTT messages, one per line")
+    replay.add_argument("--trace", help="Write the decision trace to this file (JSON lines)")
+    replay.add_argument("--output", help="Write the summary to this file (JSON) instead of stdout")
+    replay.add_argument("--seed", type=int, default=1, help="Seed of the mock vehicles and the random vehicle choice")
+    replay.add_argument("--max_current", type=int, default=16, help="Max charging current of the mock vehicles (A)")
+    replay.add_argument("--sun_mode", action="store_true", help="Mock vehicles have sun charging enabled")
+    replay.add_argument("--loop_sleep", type=int, help="Seconds of recorded time between control steps (default: [times] loop_sleep)")
+    replay.add_argument("--log_level", default="WARNING", help="Log level during the replay")
     arguments = parser.parse_args(args_)
 
     return arguments
@@ -122,7 +153,25 @@ def get_settings(cfg_dir):
             'adjust_period': 30,
             'calculation_period_duration': 3600,
             'loop_sleep': 5,
-            'max_offline_time': 600
+            'max_offline_time': 600,
+            'backup_interval': 60
+        },
+        'buffers': {
+            'power_storage': 'columns',
+            'energy_storage': 'gorilla',
+            'energy_days': 32,
+            'reorder_window': 4,
+            'reorder_max_pending': 256,
+            'frames': 'false',
+            'per_meter': 'false',
+            'long_term_db': '',
+            'power_channels': 'P_pos, P_neg, Q_pos, Q_neg, I1, I2, I3, U1, U2, U3',
+            'energy_channels': 'A_pos, A_neg, R_pos, R_neg'
+        },
+        'export': {
+            'dir': '',
+            'format': 'parquet',
+            'interval': 3600
         },
         'mqtt_server': {
             'host': 'mqtt_host',
@@ -183,6 +232,27 @@ def get_settings(cfg_dir):
 
     return settings
 
+###########################################################
+# Static settings used for every message and control step, looked up
+# once (configparser lookups are slow at the replay's message rate)
+#
+def get_loop_settings(settings):
+    return {
+        'control_topic': f"{settings.get('mqtt_client', 'root_topic')}/{APP_NAME}/{settings.get('mqtt_client', 'control_topic')}",
+        'elements': {
+            'timestamp': settings.get('mqtt_client', 'timestamp_element'),
+            'p_pos': settings.get('mqtt_client', 'power_element_pos'),
+            'p_neg': settings.get('mqtt_client', 'power_element_neg'),
+            'e_pos': settings.get('mqtt_client', 'energy_element_pos'),
+            'e_neg': settings.get('mqtt_client', 'energy_element_neg')},
+        'per_meter': settings.getboolean('buffers', 'per_meter'),
+        'calculation_period_duration': settings.getint('times', 'calculation_period_duration'),
+        'max_offline_time': settings.getint('times', 'max_offline_time'),
+        'adjust_period': settings.getint('times', 'adjust_period'),
+        'energy_deadband_down': settings.getint('control', 'energy_deadband_down'),
+        'energy_deadband_up': settings.getint('control', 'energy_deadband_up'),
+    }
+
 ###########################################################
 # Override file settings from the environment.
 #
@@ -263,28 +333,339 @@ def ping_healthcheck(base_url, suffix='', data=None, timeout=10):
 # MQTT subscription callbasck
 #
 def input(message):
-    full_control_topic = f"{settings.get('mqtt_client', 'root_topic')}/{APP_NAME}/{settings.get('mqtt_client', 'control_topic')}"
+    elements = loop_settings['elements']
 
-    if message.get('topic').startswith(full_control_topic):
+    if message.get('topic').startswith(loop_settings['control_topic']):
         control = message.get('payload', {})
         dynamic_settings['control'].update(control)
         store_dynamic_settings(state_dir, dynamic_settings)
 
     else:
-        ts = message.get('payload', {}).get(settings.get('mqtt_client', 'timestamp_element'))
-        p_positive = message.get('payload', {}).get(settings.get('mqtt_client', 'power_element_pos'))
-        p_negative = message.get('payload', {}).get(settings.get('mqtt_client', 'power_element_neg'))
-        e_export = message.get('payload', {}).get(settings.get('mqtt_client', 'energy_element_neg'))
-        e_import = message.get('payload', {}).get(settings.get('mqtt_client', 'energy_element_pos'))
-        if p_positive is not None  and ts is not None:
-            calculator_import.insert_power(ts=ts, value=p_positive)
-        if e_import is not None and ts is not None:
-            calculator_import.insert_energy(ts=ts, value=e_import)
-
-        if p_negative is not None and ts is not None:
-            calculator_export.insert_power(ts=ts, value=p_negative)
-        if e_export is not None and ts is not None:
-            calculator_export.insert_energy(ts=ts, value=e_export)
+        ts = message.get('payload', {}).get(elements['timestamp'])
+        p_positive = message.get('payload', {}).get(elements['p_pos'])
+        p_negative = message.get('payload', {}).get(elements['p_neg'])
+        e_export = message.get('payload', {}).get(elements['e_neg'])
+        e_import = message.get('payload', {}).get(elements['e_pos'])
+        if ts is not None:
+            meter = meters.get(meter_id(message))
+            frame = {'p_pos': p_positive, 'p_neg': p_negative, 'e_pos': e_import, 'e_neg': e_export}
+            if meter['frames'] is not None:
+                # All channels of the frame, keyed by element name
+                for buffer in meter['frames']:
+                    frame.update({c: message.get('payload', {}).get(c) for c in buffer.channels})
+            meter['ingest'].add(ts, frame)
+
+################################################################
+# Meter (gateway) of a measurement: tags.id_string of the payload, else
+# the topic level matching '+' in the measurement topic. '' when meters
+# are not kept apart ([buffers] per_meter).
+#
+def meter_id(message):
+    if not loop_settings['per_meter']:
+        return ''
+
+    tags = message.get('payload', {}).get('tags')
+    if isinstance(tags, dict) and tags.get('id_string') is not None:
+        return meter_key(tags.get('id_string'))
+
+    levels = message.get('topic', '').split('/')
+    for (level, pattern) in zip(levels, settings.get('mqtt_client', 'measurement_topic').split('/')):
+        if pattern == '+':
+            return meter_key(level)
+    return ''
+
+################################################################
+# Sorted batch of measurement frames of meter from its reorder buffer
+#
+def insert_frames(meter, batch):
+    if meter['frames'] is not None:
+        insert_frame_buffers(meter, batch)
+        return
+
+    ts = [t for (t, frame) in batch]
+    meter['import'].insert_columns(
+        ts,
+        power=[frame.get('p_pos') for (t, frame) in batch],
+        energy=[frame.get('e_pos') for (t, frame) in batch])
+    meter['export'].insert_columns(
+        ts,
+        power=[frame.get('p_neg') for (t, frame) in batch],
+        energy=[frame.get('e_neg') for (t, frame) in batch])
+
+################################################################
+# Late measurement frame (behind the reorder window)
+#
+def insert_late_frame(meter, ts, frame):
+    if meter['frames'] is not None:
+        insert_frame_buffers(meter, [(ts, frame)])
+    else:
+        if frame.get('p_pos') is not None:
+            meter['import'].insert_power(ts=ts, value=frame.get('p_pos'))
+        if frame.get('e_pos') is not None:
+            meter['import'].insert_energy(ts=ts, value=frame.get('e_pos'))
+
+        if frame.get('p_neg') is not None:
+            meter['export'].insert_power(ts=ts, value=frame.get('p_neg'))
+        if frame.get('e_neg') is not None:
+            meter['export'].insert_energy(ts=ts, value=frame.get('e_neg'))
+
+    # Cached totals of closed hours it falls in are stale now
+    if frame.get('p_pos') is not None:
+        meter['import'].power_late([ts])
+    if frame.get('p_neg') is not None:
+        meter['export'].power_late([ts])
+
+################################################################
+# Batch of frames into the frame buffers, one insert per frame for
+# all channels. The calculators read their channels.
+#
+def insert_frame_buffers(meter, batch):
+    (power_frames, energy_frames) = meter['frames']
+    power_frames.insert_frames(batch)
+    energy_frames.insert_frames(batch)
+    meter['import'].energy_inserted([t for (t, frame) in batch if frame.get('e_pos') is not None])
+    meter['export'].energy_inserted([t for (t, frame) in batch if frame.get('e_neg') is not None])
+
+################################################################
+# Buffers of a meter: import and export calculators, frame buffers
+# (None unless [buffers] frames) and the reorder buffer feeding them.
+# Backup files of meter '' keep their names from before per_meter.
+#
+def create_meter(meter_id):
+    postfix = '' if meter_id == '' else '_' + meter_id
+    backup_interval = settings.getint('times', 'backup_interval')
+    meter = {'id': meter_id, 'frames': None}
+
+    # Optionally all channels of a frame go into two multi-channel buffers
+    # (see data/frame_buffer.py), the calculators read their channels
+    power_channels = {}
+    energy_channels = {}
+    if settings.getboolean('buffers', 'frames'):
+        power_frames = FrameBuffer(
+            {c.strip(): False for c in settings.get('buffers', 'power_channels').split(',')},
+            age=7*3600,
+            backup_filename=str(Path(log_dir) / f'power_frames{postfix}.tsf'),
+            backup_interval=backup_interval,
+            persistence=persistence)
+        energy_frames = FrameBuffer(
+            {c.strip(): True for c in settings.get('buffers', 'energy_channels').split(',')},
+            age=24*3600*settings.getint('buffers', 'energy_days'),
+            backup_filename=str(Path(log_dir) / f'energy_frames{postfix}.tsf'),
+            backup_interval=backup_interval,
+            persistence=persistence)
+        meter['frames'] = (power_frames, energy_frames)
+        power_channels = {
+            'import': power_frames.channel(settings.get('mqtt_client', 'power_element_pos')),
+            'export': power_frames.channel(settings.get('mqtt_client', 'power_element_neg'))}
+        energy_channels = {
+            'import': energy_frames.channel(settings.get('mqtt_client', 'energy_element_pos')),
+            'export': energy_frames.channel(settings.get('mqtt_client', 'energy_element_neg'))}
+
+    for direction in ['import', 'export']:
+        meter[direction] = EnergyCalculator(
+            log_dir=log_dir,
+            postfix=f'_{direction}{postfix}',
+            backup_interval=backup_interval,
+            persistence=persistence,
+            power_storage=settings.get('buffers', 'power_storage'),
+            energy_storage=settings.get('buffers', 'energy_storage'),
+            energy_days=settings.getint('buffers', 'energy_days'),
+            power_buffer=power_channels.get(direction),
+            energy_buffer=energy_channels.get(direction),
+            long_term_db=settings.get('buffers', 'long_term_db') or None)
+
+    # Measurement frames from several gateways arrive late, duplicated or
+    # out of order; they are sorted in a short window before the buffers
+    meter['ingest'] = ReorderBuffer(
+        sink=lambda batch: insert_frames(meter, batch),
+        late=lambda ts, frame: insert_late_frame(meter, ts, frame),
+        window=settings.getint('buffers', 'reorder_window'),
+        max_pending=settings.getint('buffers', 'reorder_max_pending'))
+    return meter
+
+################################################################
+# Meters with backups from earlier runs, so the site view has them
+# before their first measurement
+#
+def known_meters():
+    if not settings.getboolean('buffers', 'per_meter'):
+        return ['']
+    ids = set()
+    for prefix in ['energy_buffer_import_', 'energy_frames_']:
+        for path in Path(log_dir).glob(prefix + '*'):
+            ids.add(path.name[len(prefix):].split('.')[0])
+    return sorted(ids)
+
+################################################################
+# Period status of import and export for the control step
+#
+def period_statuses():
+    period_status_import = calculator_import.period_status(
+        max_energy=dynamic_settings.get('control').get('max_energy'),
+        duration=loop_settings['calculation_period_duration'],
+        max_offline_time=loop_settings['max_offline_time'])
+
+    period_status_export = calculator_export.period_status(
+        max_energy=16000,
+        duration=loop_settings['calculation_period_duration'],
+        max_offline_time=loop_settings['max_offline_time'])
+
+    return (period_status_import, period_status_export)
+
+################################################################
+# One control step on the period status of import and export: adjust
+# the charging current of the vehicles of cc. state keeps the times of
+# the last adjustments ('last_adjust', 'last_adjust_sun'). Returns the
+# adjustments made (for the replay trace, see replay.py).
+#
+def control(cc, period_status_import, period_status_export, state):
+    clock = default_clock()
+    decisions = []
+
+    # Beregn og finn gjenværende effekt
+    remaining_max_power = period_status_import.get('remaining_max_power')
+    power = period_status_import.get('power_avg_1m')
+    power_import_instant = period_status_import.get('power')
+    power_export_instant = period_status_export.get('power')
+
+    # Dersom faktisk effekt > gjenværende tillatt max, gjør noe!
+    if period_status_import.get('metering_offline'):
+
+        logger.debug('Adjusting DOWN when energy/power metering is offline')
+
+        # Finn kjøretøy med høyest effekt (som skal justeres NED)
+        # cc.adjust(cc.get_max_vehicle(), up=False)
+        v = cc.get_random_vehicle()
+        decisions.append(decision('offline', False, v, cc.adjust(v, up=False), power, remaining_max_power))
+        state['last_adjust'] = clock.time()
+        state['last_adjust_sun'] = clock.time()
+    else:
+
+        # Counting polls the vehicles, only worth it when logged
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                f"At location/sun mode/sun enabled: {cc.count_at_location()}/{cc.count_sun_mode_at_location()}/{cc.sun_charge_enabled()}"
+            )
+
+        if cc.sun_charge_enabled():
+
+            # Eksporterer strøm (use instant power)
+            if power_import_instant <= 0:
+                if power_export_instant >= dynamic_settings.get('control').get('sun_export_charge_level'):
+
+                    # Start lading hvis produksjon overstiger grense
+                    if power_export_instant >= dynamic_settings.get('control').get('sun_export_charge_trigger'):
+                        cc.sun_charge_start_minimum()
+
+                    logger.debug(f'SUN MODE Adjusting UP (export {power_export_instant:.1f}W, import {power_import_instant:.1f}W)')
+
+                    # Finn kjøretøy med lavest effekt (som skal justeres OPP)
+                    #  cc.adjust(cc.get_min_vehicle(), up=True)
+                    amps = (power_export_instant - dynamic_settings.get('control').get('sun_export_charge_level')) / 400
+                    v = cc.get_random_vehicle(sun_mode=True)
+                    decisions.append(decision('sun', True, v, cc.adjust(v, up=True, amps=int(amps)), power_export_instant, dynamic_settings.get('control').get('sun_export_charge_level')))
+                    state['last_adjust_sun'] = clock.time()
+                else:
+                    logger.debug(f'SUN MODE Adjusting DOWN (export {power_export_instant:.1f}W, import {power_import_instant:.1f}W)')
+
+                    # Finn kjøretøy med høyest effekt (som skal justeres NED)
+                    # cc.adjust(cc.get_max_vehicle(), up=False)
+                    amps = (power_import_instant - dynamic_settings.get("control").get("sun_export_charge_level")) / 400
+                    v = cc.get_random_vehicle(sun_mode=True)
+                    decisions.append(decision('sun', False, v, cc.adjust(v, up=False, amps=int(amps)), power_export_instant, dynamic_settings.get('control').get('sun_export_charge_level')))
+                    state['last_adjust_sun'] = clock.time()
+            else:
+                logger.debug(f'SUN MODE Adjusting DOWN to cut-off (export {power_export_instant:.1f}W, import {power_import_instant:.1f}W)')
+
+                #                            current_current = cc.adjust(cc.get_max_vehicle(), up=False)
+                amps = (power_import_instant - dynamic_settings.get("control").get("sun_export_charge_level")) / 400
+                v = cc.get_random_vehicle(sun_mode=True)
+                current_current = cc.adjust(v, up=False, amps=int(amps))
+                decisions.append(decision('sun', False, v, current_current, power_import_instant, 0))
+                state['last_adjust_sun'] = clock.time()
+
+                # # Stopp lading hvis produksjon  går under 0
+                # if current_current <= cc.MIN_CURRENT:
+                #     cc.sun_charge_stop()
+
+        # Normal charge for all NOT in sun mode
+        if not cc.sun_charge_enabled() or cc.count_at_location() > cc.count_sun_mode_at_location():
+
+            # Over usage: Reduce
+            if power > remaining_max_power + loop_settings['energy_deadband_down'] and \
+                clock.time()-state['last_adjust'] > loop_settings['adjust_period']:
+
+                logger.debug('Adjusting DOWN ({:.1f}W > {:.1f}W + db)'.format(power, remaining_max_power))
+
+                # Finn kjøretøy med høyest effekt (som skal justeres NED)
+                # cc.adjust(cc.get_max_vehicle(), up=False)
+                v = cc.get_random_vehicle()
+                decisions.append(decision('normal', False, v, cc.adjust(v, up=False), power, remaining_max_power))
+                state['last_adjust'] = clock.time()
+
+            # Under usage -> increase
+            elif power < remaining_max_power - loop_settings['energy_deadband_up'] \
+                and clock.time()-state['last_adjust'] > loop_settings['adjust_period']:
+
+                logger.debug('Adjusting UP ({:.1f}W < {:.1f}W + db)'.format(power, remaining_max_power))
+
+                # Finn kjøretøy med lavest effekt (som skal justeres OPP)
+                # cc.adjust(cc.get_min_vehicle(), up=True)
+                v = cc.get_random_vehicle()
+                decisions.append(decision('normal', True, v, cc.adjust(v, up=True), power, remaining_max_power))
+                state['last_adjust'] = clock.time()
+
+    return decisions
+
+################################################################
+# Trace record of an adjustment: mode ('offline', 'sun', 'normal'),
+# direction, vehicle (None if none was charging), resulting current
+# and the power compared against limit
+#
+def decision(mode, up, vehicle, current, power, limit):
+    return {
+        'mode': mode,
+        'action': 'up' if up else 'down',
+        'vin': vehicle.get('vin') if vehicle is not None else None,
+        'current': current,
+        'power': power,
+        'limit': limit
+    }
+
+################################################################
+# Buffers and rollup tiers of all meters by export channel name. With
+# frame buffers every channel of the frames is exported.
+#
+def export_sources():
+    sources = {}
+    for m in meters.values():
+        postfix = '' if m['id'] == '' else '_' + m['id']
+        if m['frames'] is not None:
+            for frames in m['frames']:
+                for channel in frames.channels:
+                    sources[f'{channel}{postfix}'] = frames.channel(channel)
+        for direction in ['import', 'export']:
+            calculator = m[direction]
+            if m['frames'] is None:
+                sources[f'power_{direction}{postfix}'] = calculator.power_buffer
+                sources[f'energy_{direction}{postfix}'] = calculator.energy_buffer
+            sources[f'power_minutes_{direction}{postfix}'] = calculator.power_minutes
+            sources[f'power_hours_{direction}{postfix}'] = calculator.power_hours
+    return sources
+
+################################################################
+# Columnar exporter (see data/export.py) into export_dir, relative to
+# the log dir
+#
+def create_exporter(export_dir, format):
+    if not export_dir:
+        raise ValueError('No export directory configured ([export] dir)')
+    return ColumnarExporter(
+        Path(log_dir) / export_dir,
+        sources=export_sources,
+        calendar=default_calendar(),
+        format=format,
+        interval=settings.getint('export', 'interval'))
 
 
 ################################################################
@@ -306,6 +687,14 @@ if __name__ == '__main__':
 
     dynamic_settings = get_dynamic_settings(cfg_dir=state_dir)
 
+    # Replays start from empty buffers in a scratch directory, which also
+    # takes the logs and control messages of the recording
+    if args.command == 'replay':
+        state_dir = log_dir = tempfile.mkdtemp(prefix=f'{APP_NAME}_replay_')
+        settings.set('logging', 'log_level', args.log_level)
+        settings.set('buffers', 'long_term_db', '')
+    loop_settings = get_loop_settings(settings)
+
     create_logger(
         name='timebuffer',
         level=settings.get('logging', 'log_level'),
@@ -316,8 +705,150 @@ if __name__ == '__main__':
         level=settings.get('logging', 'log_level'),
         log_dir=log_dir)
 
-    calculator_import = EnergyCalculator(log_dir=log_dir, postfix='_import')
-    calculator_export = EnergyCalculator(log_dir=log_dir, postfix='_export')
+    # 'export' subcommand: one export run of the buffers as restored from
+    # their backups. The persistence worker is not started, so nothing is
+    # written back to the backups the service may be using.
+    if args.command == 'export':
+        persistence = PersistenceWorker()
+        meters = MeterShards(create_meter)
+        for m in known_meters():
+            meters.get(m)
+        try:
+            exporter = create_exporter(
+                args.export_dir or settings.get('export', 'dir'),
+                args.format or settings.get('export', 'format'))
+        except (RuntimeError, ValueError) as e:
+            sys.stderr.write('Export failed: {}\n'.format(e))
+            sys.exit(1)
+        files = exporter.run()
+        logger.info('Exported {} files to {}: {}'.format(files, exporter.export_dir, exporter.metrics()))
+        sys.exit(0 if exporter.metrics()['errors'] == 0 else 1)
+
+    # 'month' subcommand: month status of each meter from its long-term
+    # store, also for months gone from the energy buffer (e.g. for
+    # tariff disputes). Nothing is written back, as for 'export'.
+    if args.command == 'month':
+        if not settings.get('buffers', 'long_term_db'):
+            sys.stderr.write('No long-term store, set [buffers] long_term_db\n')
+            sys.exit(1)
+        try:
+            month_start = datetime.datetime.strptime(args.month, '%Y-%m').replace(tzinfo=default_calendar().zone)
+        except ValueError:
+            sys.stderr.write('Invalid month {}, expected YYYY-MM\n'.format(args.month))
+            sys.exit(1)
+        persistence = PersistenceWorker()
+        meters = MeterShards(create_meter)
+        for m in known_meters():
+            meters.get(m)
+        ts = int(month_start.timestamp())
+        print(json.dumps({m_id: m['import'].archived_month_status(ts) for (m_id, m) in meters.items()}, indent=2))
+        sys.exit(0)
+
+    # 'replay' subcommand: the recording through input(), the buffers and
+    # the control step on a ReplayClock, with a mock vehicle per included
+    # car (see replay.py). Nothing is written but the trace and summary.
+    if args.command == 'replay':
+        messages = read_recording(args.recording)
+        first = next(messages, None)
+        if first is None:
+            sys.stderr.write('Empty recording {}\n'.format(args.recording))
+            sys.exit(1)
+        clock = ReplayClock(receive_ts(first, loop_settings['elements']['timestamp']))
+        set_default_clock(clock)
+        set_live_reads(True)
+        set_expiry_slack(60)
+        rng = random.Random(args.seed)
+
+        persistence = PersistenceWorker()
+        meters = MeterShards(create_meter)
+        calculator_import = SiteCalculator(lambda: [m['import'] for m in meters.values()])
+        calculator_export = SiteCalculator(lambda: [m['export'] for m in meters.values()])
+
+        home_location = {'lat': settings.getfloat('location', 'lat'), 'lon': settings.getfloat('location', 'lon')}
+        vehicles = [
+            MockVehicle(vin, clock, rng, home_location, max_current=args.max_current, sun_mode=args.sun_mode)
+            for vin in dynamic_settings.get('control').get('included_cars')]
+        cc = ChargeController(
+            vehicles=vehicles,
+            settings=dynamic_settings,
+            home_location=home_location,
+            update_period=settings.getint('tesla_client', 'update_period'),
+            log_dir=log_dir,
+            log_level=args.log_level,
+            clock=clock,
+            rng=rng
+        )
+        control_state = {'last_adjust': clock.time(), 'last_adjust_sun': clock.time()}
+
+        def step():
+            (period_status_import, period_status_export) = period_statuses()
+            if not dynamic_settings.get('control').get('enabled'):
+                return []
+            return control(cc, period_status_import, period_status_export, control_state)
+
+        def flush(now):
+            for m in meters.values():
+                m['ingest'].flush(now)
+
+        trace_file = open(args.trace, 'w') if args.trace else None
+        replay = Replay(
+            clock,
+            input=input,
+            flush=flush,
+            step=step,
+            calculator=calculator_import,
+            vehicles=vehicles,
+            loop_sleep=args.loop_sleep or settings.getint('times', 'loop_sleep'),
+            elements=loop_settings['elements'],
+            trace=(lambda record: trace_file.write(json.dumps(record) + '\n')) if trace_file else None)
+
+        t0 = time.perf_counter()
+        summary = replay.run(itertools.chain([first], messages))
+        summary['duration'] = time.perf_counter() - t0
+        if trace_file:
+            trace_file.close()
+
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(summary, f, indent=2)
+        else:
+            print(json.dumps(summary, indent=2))
+        shutil.rmtree(log_dir, ignore_errors=True)
+        sys.exit(0)
+
+    # One write-behind worker flushes all buffer backups (see data/persistence.py)
+    persistence = default_worker()
+
+    # Buffers per meter (see create_meter), the control loop sees the
+    # site as the sum of the meters
+    meters = MeterShards(create_meter)
+    for m in known_meters():
+        meters.get(m)
+    calculator_import = SiteCalculator(
+        lambda: [m['import'] for m in meters.values()],
+        backup_filename=str(Path(log_dir) / 'capacity_site_import.yaml'),
+        backup_interval=settings.getint('times', 'backup_interval'),
+        persistence=persistence)
+    calculator_export = SiteCalculator(
+        lambda: [m['export'] for m in meters.values()],
+        backup_filename=str(Path(log_dir) / 'capacity_site_export.yaml'),
+        backup_interval=settings.getint('times', 'backup_interval'),
+        persistence=persistence)
+
+    # Periodic columnar export of the buffers and rollups, if configured
+    exporter = None
+    if settings.get('export', 'dir'):
+        try:
+            exporter = create_exporter(settings.get('export', 'dir'), settings.get('export', 'format'))
+            exporter.start()
+        except (RuntimeError, ValueError) as e:
+            logger.warning('Columnar export disabled: {}'.format(e))
+
+    # `docker stop` sends SIGTERM: leave through the normal shutdown path so the
+    # buffers get their final flush
+    def on_sigterm(signum, frame):
+        raise KeyboardInterrupt()
+    signal.signal(signal.SIGTERM, on_sigterm)
 
     mqtt_client = MQTTClient(
         client_id=APP_NAME,
@@ -329,10 +860,9 @@ if __name__ == '__main__':
         keepalive=60,
         log_dir=log_dir)
 
-    full_control_topic = f"{settings.get('mqtt_client', 'root_topic')}/{APP_NAME}/{settings.get('mqtt_client', 'control_topic')}"
     topics = [
         settings.get('mqtt_client', 'measurement_topic'),
-        full_control_topic
+        loop_settings['control_topic']
     ]
     mqtt_client.set_input(input=input, topics=topics)
     mqtt_client.start()
@@ -406,32 +936,33 @@ if __name__ == '__main__':
     ##############################################################################
     ##############################################################################
     try:
-        last_adjust = time.time()
-        last_adjust_sun = time.time()
+        control_state = {'last_adjust': time.time(), 'last_adjust_sun': time.time()}
         # Tesla-auth heartbeat throttle for healthchecks.io. Seed it to "now" so
         # the first re-verification happens ping_period after the startup ping.
         last_healthcheck = time.time()
         hc_ping_period = settings.getint('healthcheck', 'ping_period', fallback=900)
 
         while True:
-            included_cars = dynamic_settings.get('control').get('included_cars')
-            period_status_import = calculator_import.period_status(
-                max_energy=dynamic_settings.get('control').get('max_energy'),
-                duration=settings.getint('times', 'calculation_period_duration'),
-                max_offline_time=settings.getint('times', 'max_offline_time'))
+            # Release frames the gateways have stopped sending after
+            for m in meters.values():
+                m['ingest'].flush(time.time())
 
-            period_status_export = calculator_export.period_status(
-                max_energy=16000,
-                duration=settings.getint('times', 'calculation_period_duration'),
-                max_offline_time=settings.getint('times', 'max_offline_time'))
+            included_cars = dynamic_settings.get('control').get('included_cars')
+            (period_status_import, period_status_export) = period_statuses()
 
             mqtt_status = {
                 'enabled': dynamic_settings.get('control').get('enabled'),
                 'energy_status_import': period_status_import,
                 'energy_status_export': period_status_export,
                 'monthly_status_import': calculator_import.monthly_status(),
+                'load_status_import': calculator_import.load_status(),
+                'load_status_export': calculator_export.load_status(),
                 'cars': cc.get_car_status(),
-                'included_cars': included_cars
+                'included_cars': included_cars,
+                'persistence': persistence.metrics(),
+                'export': exporter.metrics() if exporter is not None else None,
+                'status_cache': {m_id: {'import': m['import'].status_cache.metrics(), 'export': m['export'].status_cache.metrics()} for (m_id, m) in meters.items()},
+                'ingest': {m_id: m['ingest'].metrics() for (m_id, m) in meters.items()}
             }
             mqtt_client.publish(
                 topic=settings.get('mqtt_client', 'status_topic'),
@@ -445,90 +976,7 @@ if __name__ == '__main__':
                 payload=control_status)
 
             if dynamic_settings.get('control').get('enabled'):
-
-                # Beregn og finn gjenværende effekt
-                remaining_max_power = period_status_import.get('remaining_max_power')
-                power = period_status_import.get('power_avg_1m')
-                power_import_instant = period_status_import.get('power')
-                power_export_instant = period_status_export.get('power')
-
-                # Dersom faktisk effekt > gjenværende tillatt max, gjør noe!
-                if period_status_import.get('metering_offline'):
-
-                    logger.debug('Adjusting DOWN when energy/power metering is offline')
-
-                    # Finn kjøretøy med høyest effekt (som skal justeres NED)
-                    # cc.adjust(cc.get_max_vehicle(), up=False)
-                    cc.adjust(cc.get_random_vehicle(), up=False)
-                    last_adjust = time.time()
-                    last_adjust_sun = time.time()
-                else:
-
-                    logger.debug(
-                        f"At location/sun mode/sun enabled: {cc.count_at_location()}/{cc.count_sun_mode_at_location()}/{cc.sun_charge_enabled()}"
-                    )
-
-                    if cc.sun_charge_enabled():
-
-                        # Eksporterer strøm (use instant power)
-                        if power_import_instant <= 0:
-                            if power_export_instant >= dynamic_settings.get('control').get('sun_export_charge_level'):
-
-                                # Start lading hvis produksjon overstiger grense
-                                if power_export_instant >= dynamic_settings.get('control').get('sun_export_charge_trigger'):
-                                    cc.sun_charge_start_minimum()
-
-                                logger.debug(f'SUN MODE Adjusting UP (export {power_export_instant:.1f}W, import {power_import_instant:.1f}W)')
-
-                                # Finn kjøretøy med lavest effekt (som skal justeres OPP)
-                                #  cc.adjust(cc.get_min_vehicle(), up=True)
-                                amps = (power_export_instant - dynamic_settings.get('control').get('sun_export_charge_level')) / 400
-                                cc.adjust(cc.get_random_vehicle(sun_mode=True), up=True, amps=int(amps))
-                                last_adjust_sun = time.time()
-                            else:
-                                logger.debug(f'SUN MODE Adjusting DOWN (export {power_export_instant:.1f}W, import {power_import_instant:.1f}W)')
-
-                                # Finn kjøretøy med høyest effekt (som skal justeres NED)
-                                # cc.adjust(cc.get_max_vehicle(), up=False)
-                                amps = (power_import_instant - dynamic_settings.get("control").get("sun_export_charge_level")) / 400
-                                cc.adjust(cc.get_random_vehicle(sun_mode=True), up=False, amps=int(amps))
-                                last_adjust_sun = time.time()
-                        else:
-                            logger.debug(f'SUN MODE Adjusting DOWN to cut-off (export {power_export_instant:.1f}W, import {power_import_instant:.1f}W)')
-
-                            #                            current_current = cc.adjust(cc.get_max_vehicle(), up=False)
-                            amps = (power_import_instant - dynamic_settings.get("control").get("sun_export_charge_level")) / 400
-                            current_current = cc.adjust(cc.get_random_vehicle(sun_mode=True), up=False, amps=int(amps))
-                            last_adjust_sun = time.time()
-
-                            # # Stopp lading hvis produksjon  går under 0
-                            # if current_current <= cc.MIN_CURRENT:
-                            #     cc.sun_charge_stop()
-
-                    # Normal charge for all NOT in sun mode
-                    if not cc.sun_charge_enabled() or cc.count_at_location() > cc.count_sun_mode_at_location():
-
-                        # Over usage: Reduce
-                        if power > remaining_max_power + settings.getint('control', 'energy_deadband_down') and \
-                            time.time()-last_adjust > settings.getint('times', 'adjust_period'):
-
-                            logger.debug('Adjusting DOWN ({:.1f}W > {:.1f}W + db)'.format(power, remaining_max_power))
-
-                            # Finn kjøretøy med høyest effekt (som skal justeres NED)
-                            # cc.adjust(cc.get_max_vehicle(), up=False)
-                            cc.adjust(cc.get_random_vehicle(), up=False)
-                            last_adjust = time.time()
-
-                        # Under usage -> increase
-                        elif power < remaining_max_power - settings.getint('control', 'energy_deadband_up') \
-                            and time.time()-last_adjust > settings.getint('times', 'adjust_period'):
-
-                            logger.debug('Adjusting UP ({:.1f}W < {:.1f}W + db)'.format(power, remaining_max_power))
-
-                            # Finn kjøretøy med lavest effekt (som skal justeres OPP)
-                            # cc.adjust(cc.get_min_vehicle(), up=True)
-                            cc.adjust(cc.get_random_vehicle(), up=True)
-                            last_adjust = time.time()
+                control(cc, period_status_import, period_status_export, control_state)
 
             # Periodic Tesla-auth heartbeat for healthchecks.io. A cheap
             # authenticated call (PRODUCT_LIST — the same one used at startup, and
@@ -549,6 +997,11 @@ if __name__ == '__main__':
     except KeyboardInterrupt:
         pass
 
+    for m in meters.values():
+        m['ingest'].flush()
+    if exporter is not None:
+        exporter.stop()
+    persistence.stop()
     tesla.close()
     sys.exit(1)
 
@@ -1,10 +1,8 @@
-import datetime
+from data.local_calendar import default_calendar
 
 ###########################################################
 #
 #
 def ts2iso(ts):
-    local_zone = datetime.datetime.now().astimezone().tzinfo
-    ts_iso = datetime.datetime.fromtimestamp(ts, local_zone).isoformat()
-    return ts_iso
+    return default_calendar().iso(ts)
 